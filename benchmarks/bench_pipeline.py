@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Benchmarks for turning Gerrit responses into a Slack message.
+
+The changes are generated by repeating the changes in gerrit_responses/
+with new change numbers. Every step is measured for every size, the
+time is the best of multiple runs, the peak memory is from tracemalloc.
+
+    python benchmarks/bench_pipeline.py              # run and compare with the baseline
+    python benchmarks/bench_pipeline.py --save       # save the results as the new baseline
+    python benchmarks/bench_pipeline.py --sizes 10 100
+
+The times depend on the machine, so the baseline is not committed, it has to
+be measured on the same machine as the change. To check a change for
+regressions, save the baseline on the commit before it, then run it again
+with the change:
+
+    git stash
+    python benchmarks/bench_pipeline.py --save
+    git stash pop
+    python benchmarks/bench_pipeline.py
+
+The baseline is saved to benchmarks/baseline.json by default, use --baseline
+to keep more of them.
+"""
+import sys
+import json
+import time
+import argparse
+import itertools
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import gerrit  # noqa: E402
+import slack  # noqa: E402
+from message import PostableChange, make_attachments  # noqa: E402
+
+
+GERRIT_URL = "https://review.example.com"
+FIXTURE = ROOT / "gerrit_responses" / "best_changes_DETAILED_ACCOUNTS.json"
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+DEFAULT_SIZES = (10, 100, 1_000, 10_000, 100_000)
+# Slower than this compared to the baseline is reported as a regression
+DEFAULT_TOLERANCE = 0.25
+
+
+def make_json_changes(size):
+    fixture_changes = gerrit.parse_response(FIXTURE.read_bytes())
+    repeated = itertools.islice(itertools.cycle(fixture_changes), size)
+    return [dict(c, _number=i) for i, c in enumerate(repeated, start=1)]
+
+
+def make_steps(size):
+    """Every step gets the output of the previous step, prepared once."""
+    json_changes = make_json_changes(size)
+    labels = [c["labels"] for c in json_changes]
+    changes = [gerrit.Change(GERRIT_URL, c) for c in json_changes]
+    postable_changes = [PostableChange(c) for c in changes]
+    messages = [(c.color, c.full_message(), c.url) for c in postable_changes]
+    attachments = make_attachments(postable_changes)
+    summary = slack.make_link(GERRIT_URL, f"{size} patch vár review-ra:")
+    payload = slack.make_message("C12345678", summary, attachments)
+
+    def classify():
+        for label in labels:
+            gerrit._parse_code_review(label)
+            gerrit._parse_verified(label)
+
+    return {
+        "change": lambda: [gerrit.Change(GERRIT_URL, c) for c in json_changes],
+        "classify": classify,
+        "postable_change": lambda: [PostableChange(c) for c in changes],
+        "full_message": lambda: [c.full_message() for c in postable_changes],
+        "make_attachment": lambda: [slack.make_attachment(*m) for m in messages],
+        "serialize": lambda: json.dumps(payload),
+    }
+
+
+def measure_time(func, size):
+    # less repeats for the bigger sizes, so the whole run stays under a minute
+    repeat = max(1, min(7, 100_000 // size))
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(sizes):
+    results = {}
+    for size in sizes:
+        for step, func in make_steps(size).items():
+            seconds = measure_time(func, size)
+            peak = measure_peak_memory(func)
+            results.setdefault(step, {})[str(size)] = {"time": seconds, "peak": peak}
+            print(
+                f"{step:>16} {size:>7} changes: {seconds * 1000:10.3f} ms "
+                f"{seconds / size * 1e6:8.2f} us/change {peak / 1024:10.1f} KiB peak"
+            )
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for step, sizes in results.items():
+        for size, result in sizes.items():
+            base = baseline.get(step, {}).get(size)
+            if base is None:
+                continue
+            for metric in ("time", "peak"):
+                if result[metric] > base[metric] * (1 + tolerance):
+                    ratio = result[metric] / base[metric]
+                    regressions.append(f"{step} {size} {metric}: {ratio:.2f}x")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--save", action="store_true", help="save as the baseline")
+    args = parser.parse_args()
+
+    results = run(args.sizes)
+
+    if args.save:
+        args.baseline.write_text(json.dumps(results, indent=2, sort_keys=True))
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not args.baseline.exists():
+        print(
+            f"No baseline in {args.baseline}, measure one with --save first, "
+            "see the docstring of this script."
+        )
+        return
+
+    baseline = json.loads(args.baseline.read_text())
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("Regressions compared to the baseline:", *regressions, sep="\n  ")
+        sys.exit(1)
+    print("No regressions compared to the baseline.")
+
+
+if __name__ == "__main__":
+    main()
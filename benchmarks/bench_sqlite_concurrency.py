@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""Benchmark of concurrent readers and writers on the slackbot SQLite tables.
+
+Writer processes insert review requests one by one, like rtm.py does for
+every message, reader processes look them up by channel and query, like
+CronJob and rtm.ReviewRequestIndex do. Every mode runs on a new database
+filled with the same rows:
+
+    before: rollback journal, synchronous=FULL, no indexes (before migration 0003)
+    after:  WAL, synchronous=NORMAL, busy_timeout and the indexes of migration 0003
+
+    python benchmarks/bench_sqlite_concurrency.py
+    python benchmarks/bench_sqlite_concurrency.py --readers 4 --writers 2 --seconds 5
+"""
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import multiprocessing
+from pathlib import Path
+
+
+DEFAULT_ROWS = 20_000
+DEFAULT_CHANNELS = 200
+DEFAULT_READERS = 3
+DEFAULT_WRITERS = 2
+DEFAULT_SECONDS = 3
+# the timeout of Python's sqlite3 and Django, when it's not set in OPTIONS
+DEFAULT_TIMEOUT = 5
+
+SCHEMA = """
+CREATE TABLE slackbot_reviewrequest (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    ts varchar(30) NOT NULL,
+    slack_user_id varchar(30) NOT NULL,
+    channel_id varchar(30) NOT NULL,
+    gerrit_url varchar(200) NOT NULL,
+    gerrit_query varchar(255) NOT NULL,
+    crontab_id integer NULL
+);
+CREATE INDEX slackbot_reviewrequest_crontab_id ON slackbot_reviewrequest (crontab_id);
+"""
+INDEXES = """
+CREATE INDEX slackbot_reviewrequest_channel_id ON slackbot_reviewrequest (channel_id);
+CREATE INDEX slackbot_reviewrequest_gerrit_query ON slackbot_reviewrequest (gerrit_query);
+"""
+INSERT = (
+    "INSERT INTO slackbot_reviewrequest "
+    "(ts, slack_user_id, channel_id, gerrit_url, gerrit_query, crontab_id) "
+    "VALUES (?, ?, ?, ?, ?, NULL)"
+)
+SELECT_CHANNEL = (
+    "SELECT id, gerrit_query FROM slackbot_reviewrequest WHERE channel_id = ?"
+)
+SELECT_QUERIES = (
+    "SELECT gerrit_query, ts FROM slackbot_reviewrequest "
+    "WHERE gerrit_query IN (?, ?, ?) ORDER BY id"
+)
+
+MODES = {
+    "before": {"pragmas": [], "indexes": False, "timeout": DEFAULT_TIMEOUT},
+    "after": {
+        "pragmas": [
+            "PRAGMA journal_mode=WAL",
+            "PRAGMA synchronous=NORMAL",
+            "PRAGMA busy_timeout=20000",
+        ],
+        "indexes": True,
+        "timeout": 20,
+    },
+}
+
+
+def make_row(number, channels):
+    url = f"https://review.example.com/c/project/+/{number}"
+    return (f"{number}.000100", "U12345678", f"C{number % channels:08d}", url, number)
+
+
+def create_database(path, mode, rows, channels):
+    db = sqlite3.connect(str(path))
+    db.executescript(SCHEMA)
+    if mode["indexes"]:
+        db.executescript(INDEXES)
+    db.executemany(INSERT, (make_row(n, channels) for n in range(rows)))
+    db.commit()
+    db.close()
+
+
+def connect(path, mode):
+    db = sqlite3.connect(str(path), timeout=mode["timeout"])
+    for pragma in mode["pragmas"]:
+        db.execute(pragma)
+    return db
+
+
+def write(path, mode, rows, channels, seconds, results):
+    db = connect(path, mode)
+    number = rows + random.randrange(1_000_000_000)
+    done = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        number += 1
+        try:
+            with db:
+                db.execute(INSERT, make_row(number, channels))
+            done += 1
+        except sqlite3.OperationalError:
+            # database is locked
+            errors += 1
+    results.put(("write", done, errors))
+
+
+def read(path, mode, rows, channels, seconds, results):
+    db = connect(path, mode)
+    done = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            channel_id = f"C{random.randrange(channels):08d}"
+            db.execute(SELECT_CHANNEL, (channel_id,)).fetchall()
+            numbers = [str(random.randrange(rows)) for _ in range(3)]
+            db.execute(SELECT_QUERIES, numbers).fetchall()
+            done += 1
+        except sqlite3.OperationalError:
+            errors += 1
+    results.put(("read", done, errors))
+
+
+def run(mode_name, args):
+    mode = MODES[mode_name]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "db.sqlite3"
+        create_database(path, mode, args.rows, args.channels)
+        results = multiprocessing.Queue()
+        workers = [(write, args.writers), (read, args.readers)]
+        processes = [
+            multiprocessing.Process(
+                target=target,
+                args=(path, mode, args.rows, args.channels, args.seconds, results),
+            )
+            for target, count in workers
+            for _ in range(count)
+        ]
+        for process in processes:
+            process.start()
+        totals = {"read": [0, 0], "write": [0, 0]}
+        for _ in processes:
+            kind, done, errors = results.get()
+            totals[kind][0] += done
+            totals[kind][1] += errors
+        for process in processes:
+            process.join()
+
+    for kind, (done, errors) in totals.items():
+        print(
+            f"{mode_name:>6} {kind:>5}: {done / args.seconds:10.1f}/s "
+            f"{errors:6} locked errors"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS)
+    parser.add_argument("--channels", type=int, default=DEFAULT_CHANNELS)
+    parser.add_argument("--readers", type=int, default=DEFAULT_READERS)
+    parser.add_argument("--writers", type=int, default=DEFAULT_WRITERS)
+    parser.add_argument("--seconds", type=float, default=DEFAULT_SECONDS)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    args = parser.parse_args()
+
+    for mode_name in args.modes:
+        run(mode_name, args)
+
+
+if __name__ == "__main__":
+    main()
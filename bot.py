@@ -3,91 +3,42 @@
 import json
 import time
 import asyncio
-import textwrap
-import datetime as dt
 import threading
-import aiohttp
-from concurrent.futures import ThreadPoolExecutor
 import uwsgi
 from django.conf import settings
+from django.core.cache import caches
 from constance import config
 import slack
 import gerrit
+import sessions
+import metrics
+import scheduler
+from scheduler import ReloadAction
 import django
+from message import PostableChange, make_attachments
 from slackbot.models import Crontab, SentMessage, ReviewRequest
-
-
-class PostableChange:
-    def __init__(self, gerrit_change):
-        self._gerrit_change = gerrit_change
-
-    @property
-    def cr(self):
-        return self._gerrit_change.code_review
-
-    @property
-    def ver(self):
-        return self._gerrit_change.verified
-
-    @property
-    def url(self):
-        return self._gerrit_change.url
-
-    @property
-    def username(self):
-        return self._gerrit_change.username
-
-    @property
-    def subject(self):
-        return slack.escape(self._gerrit_change.subject)
-
-    @property
-    def code_review_icon(self):
-        if self.cr == gerrit.CodeReview.PLUS_ONE:
-            return slack.Emoji.PLUS_ONE
-        elif self.cr == gerrit.CodeReview.PLUS_TWO:
-            return slack.Emoji.PLUS_ONE * 2
-        elif self.cr == gerrit.CodeReview.MISSING:
-            return slack.Emoji.EXCLAMATION
-        elif self.cr == gerrit.CodeReview.MINUS_ONE:
-            return slack.Emoji.POOP
-        elif self.cr == gerrit.CodeReview.MINUS_TWO:
-            return slack.Emoji.JS
-
-    @property
-    def verified_icon(self):
-        if self.ver == gerrit.Verified.MISSING:
-            return ""
-        elif self.ver == gerrit.Verified.VERIFIED:
-            return slack.Emoji.WHITE_CHECK_MARK
-        elif self.ver == gerrit.Verified.FAILED:
-            return slack.Emoji.X
-
-    @property
-    def color(self):
-        if self.cr == gerrit.CodeReview.PLUS_TWO:
-            return "#36a64f"
-        elif (
-            self.cr == gerrit.CodeReview.PLUS_ONE
-            and self.ver == gerrit.Verified.VERIFIED
-        ):
-            return "#DBF32D"
-        else:
-            return "#EC1313"
-
-    def full_message(self):
-        text = f"CR: {self.code_review_icon} V: {self.verified_icon} {self.username}: {self.subject}"
-        # we count every icon as one character long
-        icon_lenghts = len(self.code_review_icon) + len(self.verified_icon)
-        # Slack wraps lines around this width, so if we cut out here explicitly,
-        # every patch will fit in one line.
-        return textwrap.shorten(text, width=76 + icon_lenghts - 2, placeholder="…")
+from slackbot.models import delete_sent_message_rows
 
 
 class CronJob:
-    def __init__(self, gerrit_url, bot_access_token, crontab, loop, session):
+    def __init__(
+        self,
+        gerrit_url,
+        bot_access_token,
+        crontab,
+        loop,
+        session,
+        max_gerrit_requests=gerrit.DEFAULT_MAX_CONCURRENT_REQUESTS,
+        gerrit_verify_ssl=False,
+    ):
         self._loop = loop
-        self._gerrit = gerrit.AsyncApi(gerrit_url, session)
+        self._gerrit = gerrit.AsyncApi(
+            gerrit_url,
+            session,
+            max_gerrit_requests,
+            caches["gerrit"],
+            gerrit_verify_ssl,
+        )
         self._slack = slack.AsyncApi(bot_access_token, session)
 
         self._crontab = crontab
@@ -101,17 +52,38 @@ class CronJob:
         return f"CronJob(query='{self._crontab.gerrit_query}', channel='{self._channel_id}')"
 
     async def run(self):
-        await self._delete_previous_messages()
-        await self._handle_crontab()
-        await self._handle_review_requests()
+        sent_messages = list(
+            SentMessage.objects.filter(crontab=self._crontab).order_by("pk")
+        )
+        if self._crontab.update_in_place:
+            # the last message of every kind will be updated, the others are outdated,
+            # e.g. messages sent before update_in_place has been turned on
+            previous_messages = {sm.kind: sm for sm in sent_messages if sm.kind}
+            outdated_messages = [
+                sm for sm in sent_messages if sm not in previous_messages.values()
+            ]
+        else:
+            previous_messages = {}
+            outdated_messages = sent_messages
 
-    async def _delete_previous_messages(self):
-        for sent_message in SentMessage.objects.filter(crontab=self._crontab):
-            # we need to delete one by one, because it's posting chat.delete to slack
-            await self._loop.run_in_executor(None, sent_message.delete)
+        await self._delete_messages(outdated_messages)
+        await self._handle_crontab(previous_messages.get(SentMessage.CRONTAB))
+        await self._handle_review_requests(
+            previous_messages.get(SentMessage.REVIEW_REQUESTS)
+        )
+
+    async def _delete_messages(self, sent_messages):
+        if not sent_messages:
+            return
+        results = await self._slack.delete_messages(
+            [(sm.channel_id, sm.ts) for sm in sent_messages]
+        )
+        delete_sent_message_rows(sent_messages, results)
 
-    async def _handle_crontab(self):
+    async def _handle_crontab(self, previous_message):
         if self._crontab.for_review_request_only:
+            # the query has been cleared since the message was sent
+            await self._delete_messages([previous_message] if previous_message else [])
             return
         crontab_gerrit_changes = await self._gerrit.get_changes(
             self._crontab.gerrit_query
@@ -120,37 +92,49 @@ class CronJob:
 
         if not crontab_changes:
             print("No crontab changes")
+            await self._delete_messages([previous_message] if previous_message else [])
             return
 
-        json_res = await self._post_to_slack(
+        await self._post_to_slack(
+            SentMessage.CRONTAB,
+            previous_message,
             f"{len(crontab_changes)} patch vár review-ra:",
             self._crontab_changes_url,
             crontab_changes,
         )
-        self._save_message(json_res)
 
-    async def _handle_review_requests(self):
+    async def _handle_review_requests(self, previous_message):
         rrs_and_changes = await self._get_review_request_changes()
         remaining_changes = self._delete_plus_two_rrs(rrs_and_changes)
         review_request_changes = [PostableChange(c) for c in remaining_changes]
 
         if not review_request_changes:
             print("No new review request changes")
+            await self._delete_messages([previous_message] if previous_message else [])
             return
 
-        json_res = await self._post_to_slack(
+        await self._post_to_slack(
+            SentMessage.REVIEW_REQUESTS,
+            previous_message,
             f"{len(review_request_changes)} külső patch vár review-ra:",
             config.GERRIT_URL,
             review_request_changes,
         )
-        self._save_message(json_res)
 
     async def _get_review_request_changes(self):
+        review_requests = list(
+            ReviewRequest.objects.filter(channel_id=self._channel_id)
+        )
+        results = await self._gerrit.get_changes_many(
+            [rr.gerrit_query for rr in review_requests]
+        )
+
         rrs_and_changes = []
-        for rr in ReviewRequest.objects.filter(channel_id=self._channel_id):
-            # TODO: These can be awaited and returned at once at the end,
-            # don't need to wait for every request one by one
-            gerrit_changes = await self._gerrit.get_changes(rr.gerrit_query)
+        for rr, gerrit_changes in zip(review_requests, results):
+            # Skip it for now, but don't delete it, we will try again next time
+            if isinstance(gerrit_changes, Exception):
+                print(f"Couldn't get changes for {rr}: {gerrit_changes!r}")
+                continue
             rrs_and_changes.append((rr, gerrit_changes))
         return rrs_and_changes
 
@@ -168,18 +152,43 @@ class CronJob:
 
         return remaining_changes
 
-    async def _post_to_slack(self, summary_text, changes_url, changes):
+    async def _post_to_slack(
+        self, kind, previous_message, summary_text, changes_url, changes
+    ):
         summary_link = slack.make_link(changes_url, summary_text)
-        attachments = [
-            slack.make_attachment(c.color, c.full_message(), c.url) for c in changes
-        ]
-        return await self._slack.post_message(
-            self._channel_id, summary_link, attachments
-        )
+        attachments = make_attachments(changes)
+
+        if previous_message is None:
+            json_res = await self._slack.post_message(
+                self._channel_id, summary_link, attachments
+            )
+            self._save_message(kind, json_res)
 
-    def _save_message(self, json_res):
+        elif is_same_message(previous_message, summary_link, attachments):
+            print("Nothing changed since the last message", previous_message)
+
+        else:
+            json_res = await self._slack.update_message(
+                previous_message.channel_id,
+                previous_message.ts,
+                summary_link,
+                attachments,
+            )
+            if json_res["ok"]:
+                previous_message.message = json.dumps(json_res["message"])
+                previous_message.save()
+            else:
+                # e.g. somebody deleted it from Slack in the meantime
+                await self._delete_messages([previous_message])
+                json_res = await self._slack.post_message(
+                    self._channel_id, summary_link, attachments
+                )
+                self._save_message(kind, json_res)
+
+    def _save_message(self, kind, json_res):
         sm = SentMessage(
             crontab=self._crontab,
+            kind=kind,
             ts=json_res["message"]["ts"],
             channel_id=json_res["channel"],
             message=json.dumps(json_res["message"]),
@@ -188,11 +197,96 @@ class CronJob:
         return sm
 
 
+def _attachment_fields(attachment):
+    # Slack strips the "#" from colors in the messages it sends back
+    return (
+        attachment.get("color", "").lstrip("#").lower(),
+        attachment.get("author_name"),
+        attachment.get("author_link"),
+    )
+
+
+def is_same_message(sent_message, text, attachments):
+    message = json.loads(sent_message.message)
+    sent_attachments = message.get("attachments", [])
+    return message.get("text") == text and (
+        [_attachment_fields(a) for a in sent_attachments]
+        == [_attachment_fields(a) for a in attachments]
+    )
+
+
 class MuleMessage:
+    # reloads everything, the same as a config change
     RELOAD = b"reload"
 
 
-should_reload = threading.Event()
+# time to wait for more reload messages after the first one, to apply them together
+RELOAD_COALESCE_SECONDS = 1
+
+
+def make_reload_message(action, crontab_pk=None):
+    return json.dumps({"reload": action, "crontab": crontab_pk}).encode()
+
+
+def parse_reload_message(message):
+    """Return the action and crontab pk in message or None if it's something else."""
+    if message == MuleMessage.RELOAD:
+        return ReloadAction.CONFIG_CHANGED, None
+    try:
+        data = json.loads(message)
+        return data["reload"], data["crontab"]
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+# name of the mule farm in uwsgi.ini running this file
+BOT_FARM = "bot"
+
+
+def _as_str(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def bot_mule_ids():
+    """Mule ids in the bot farm or None if the bot runs in a single mule."""
+    farms = uwsgi.opt.get("farm", [])
+    if not isinstance(farms, list):
+        farms = [farms]
+    for farm in map(_as_str, farms):
+        name, _, mule_ids = farm.partition(":")
+        if name == BOT_FARM:
+            return [int(mule_id) for mule_id in mule_ids.split(",")]
+    return None
+
+
+def send_reload(crontab_pk, action):
+    """Tell the mule which owns the crontab that it has been saved or deleted."""
+    message = make_reload_message(action, crontab_pk)
+    mule_ids = bot_mule_ids()
+    if mule_ids is None:
+        uwsgi.mule_msg(message)
+    else:
+        mule_id = mule_ids[scheduler.shard(crontab_pk, len(mule_ids))]
+        uwsgi.mule_msg(message, mule_id)
+
+
+def send_reload_all(action=ReloadAction.CONFIG_CHANGED):
+    """Tell every bot mule to reload all of their crontabs."""
+    message = make_reload_message(action)
+    mule_ids = bot_mule_ids()
+    if mule_ids is None:
+        uwsgi.mule_msg(message)
+    else:
+        for mule_id in mule_ids:
+            uwsgi.mule_msg(message, mule_id)
+
+
+def get_shard():
+    """Index of this mule in the bot farm and the number of mules in it."""
+    mule_ids = bot_mule_ids()
+    if mule_ids is None or uwsgi.mule_id() not in mule_ids:
+        return 0, 1
+    return mule_ids.index(uwsgi.mule_id()), len(mule_ids)
 
 
 def pause():
@@ -211,60 +305,134 @@ def block_if_paused():
     uwsgi.unlock()
     if was_locked:
         print("Resuming...")
+    return was_locked
 
 
 class WaitForMessages(threading.Thread):
     daemon = True
 
+    def __init__(self, cron_scheduler, reloads):
+        super().__init__()
+        self._scheduler = cron_scheduler
+        self._reloads = reloads
+
     def run(self):
         while True:
             print("Waiting for messages...")
             message = uwsgi.mule_get_msg()
             print(f"Got {message!s} message.")
-            if message == MuleMessage.RELOAD:
-                should_reload.set()
-
-
-def make_cronjobs(loop, session):
-    print("Loading settings and crontabs from db...")
+            reload = parse_reload_message(message)
+            if reload is not None:
+                self._reloads.push(*reload)
+                self._scheduler.wakeup()
+
+
+def make_cronjob(loop, session, crontab):
+    return CronJob(
+        config.GERRIT_URL,
+        config.BOT_ACCESS_TOKEN,
+        crontab,
+        loop,
+        session,
+        config.GERRIT_MAX_CONCURRENT_REQUESTS,
+        config.GERRIT_VERIFY_SSL,
+    )
+
+
+def make_cronjobs(loop, session, shard_index=0, shard_count=1):
+    print(f"Loading settings and crontabs of shard {shard_index}/{shard_count}...")
     gerrit_url = config.GERRIT_URL
     bot_access_token = config.BOT_ACCESS_TOKEN
+    max_gerrit_requests = config.GERRIT_MAX_CONCURRENT_REQUESTS
+    gerrit_verify_ssl = config.GERRIT_VERIFY_SSL
 
     cronjobs = []
     for crontab in Crontab.objects.all():
-        cronjob = CronJob(gerrit_url, bot_access_token, crontab, loop, session)
+        if scheduler.shard(crontab.pk, shard_count) != shard_index:
+            continue
+        cronjob = CronJob(
+            gerrit_url,
+            bot_access_token,
+            crontab,
+            loop,
+            session,
+            max_gerrit_requests,
+            gerrit_verify_ssl,
+        )
         cronjobs.append((crontab, cronjob))
 
     print("Cronjobs:", cronjobs)
     return cronjobs
 
 
-def get_rounded_now():
-    now = dt.datetime.now(dt.timezone.utc)
-    print(now, "Checking crontabs to run...")
-    return now.replace(second=0, microsecond=0)
+def apply_reloads(loop, session, cron_scheduler, reloads, shard_index, shard_count):
+    """Return True if every crontab has been reloaded."""
+    full_reload, changes = reloads.pop_all()
+
+    if full_reload:
+        print("Reloading every crontab...")
+        old_pks = cron_scheduler.keys()
+        cron_scheduler.clear()
+        for crontab, cronjob in make_cronjobs(loop, session, shard_index, shard_count):
+            cron_scheduler.add(crontab, cronjob, crontab.pk)
+        for pk in old_pks:
+            if pk not in cron_scheduler:
+                scheduler.remove_job_metrics(pk)
+        return True
+
+    saved_pks = [pk for pk, action in changes.items() if action == ReloadAction.SAVED]
+    saved_crontabs = Crontab.objects.in_bulk(saved_pks)
+    for pk, action in changes.items():
+        crontab = saved_crontabs.get(pk)
+        # it might have been deleted since it was saved
+        if crontab is None or scheduler.shard(pk, shard_count) != shard_index:
+            print(f"Removing crontab {pk}...")
+            cron_scheduler.remove(pk)
+            scheduler.remove_job_metrics(pk)
+        else:
+            print(f"Reloading crontab {pk}...")
+            cron_scheduler.add(crontab, make_cronjob(loop, session, crontab), pk)
+    return False
 
 
-async def run_crontabs(loop, session):
-    should_reload.set()
+async def run_crontabs(loop, session, cron_scheduler, reloads):
+    shard_index, shard_count = get_shard()
+    dispatcher = scheduler.Dispatcher(loop)
+    metrics.add_collector(
+        lambda: metrics.stats_gauges("dispatcher_", dispatcher.stats())
+    )
+    metrics.add_collector(lambda: [("scheduled_crontabs", len(cron_scheduler), {})])
+    reloads.push(ReloadAction.CONFIG_CHANGED)
 
     while True:
-        block_if_paused()
-
-        if should_reload.is_set():
-            print("Reloading...")
-            cronjobs = make_cronjobs(loop, session)
-            should_reload.clear()
-
-        now = get_rounded_now()
-
-        for crontab, cronjob in cronjobs:
-            if crontab.next == now:
-                print("Running job...", cronjob)
-                loop.create_task(cronjob.run())
-                crontab.calc_next()
+        was_paused = block_if_paused()
+
+        if reloads:
+            full_reload = apply_reloads(
+                loop, session, cron_scheduler, reloads, shard_index, shard_count
+            )
+            if full_reload:
+                dispatcher.configure(
+                    config.MAX_CONCURRENT_CRONJOBS, config.CRONJOB_SPREAD_SECONDS
+                )
+
+        now = scheduler.utcnow()
+        due_runs = cron_scheduler.pop_due_runs(now)
+
+        if was_paused and due_runs:
+            # Don't flood the channels with every message we missed during the pause
+            print("Skipping jobs missed while paused:", [r.job for r in due_runs])
+        else:
+            for due_run in due_runs:
+                print("Dispatching job...", due_run.job)
+                dispatcher.dispatch(due_run)
 
-        await asyncio.sleep(3)
+        print(now, "Next run at:", cron_scheduler.next_run())
+        print("Dispatcher:", dispatcher.stats())
+        await cron_scheduler.wait()
+        if reloads:
+            # a crontab edit or a chatty channel sends many messages at once
+            await asyncio.sleep(RELOAD_COALESCE_SECONDS)
 
 
 def wait_for_setup():
@@ -288,13 +456,17 @@ https://<this-machine-ip>/admin/constance/config/
     wait_for_setup()
 
     print(Crontab.objects.all())
-    WaitForMessages().start()
 
     loop = asyncio.get_event_loop()
-    loop.set_default_executor(ThreadPoolExecutor(max_workers=1))
-    session = aiohttp.ClientSession(loop=loop)
+    executor = metrics.CountingExecutor(max_workers=1)
+    loop.set_default_executor(executor)
+    metrics.add_collector(lambda: metrics.executor_gauges("bot", executor))
+    session = sessions.make_session(loop)
+    cron_scheduler = scheduler.Scheduler(loop)
+    reloads = scheduler.ReloadQueue()
+    WaitForMessages(cron_scheduler, reloads).start()
     try:
-        loop.run_until_complete(run_crontabs(loop, session))
+        loop.run_until_complete(run_crontabs(loop, session, cron_scheduler, reloads))
     finally:
         loop.run_until_complete(session.close())
 
@@ -0,0 +1,72 @@
+"""Slack Events API mode, an alternative to the RTM connection of rtm.py.
+
+Slack sends the messages to slackbot.views.slack_events, which can run in any
+number of uWSGI workers. The view answers right away and hands the message to
+the background loop of the worker (see slack.get_background_loop), which
+processes it the same way as the RTM mule does.
+"""
+import asyncio
+import threading
+from django.core.cache import cache
+from constance import config
+import slack
+import rtm
+import metrics
+
+
+# Slack sends an event again if it didn't get an answer in 3 seconds, then
+# after 1 and 5 minutes
+EVENT_ID_TIMEOUT = 60 * 60
+EVENT_ID_KEY_PREFIX = "slack_event:"
+
+
+def is_new_event(event_id):
+    """True only for the first delivery of the event. The retries might be sent
+    to any worker, so the event ids are in the cache shared by all of them.
+    """
+    return cache.add(EVENT_ID_KEY_PREFIX + event_id, True, EVENT_ID_TIMEOUT)
+
+
+class EventProcessor:
+    def __init__(self):
+        background_loop = slack.get_background_loop()
+        self._loop = background_loop.loop
+        self._session = background_loop.session
+        # other workers save review requests too, the index can't trust misses
+        self._review_requests = rtm.ReviewRequestIndex(trust_misses=False)
+        self._review_requests.load()
+
+    def submit(self, event_id, event):
+        """Process the event in the background, can be called from any thread."""
+        if not is_new_event(event_id):
+            print(f"Skipping event {event_id}, it has been processed already.")
+            metrics.inc("events_api_duplicates")
+            return None
+        metrics.inc("events_api_events", type=event.get("type"))
+        # read the settings here, so the event loop doesn't wait for the database
+        api = slack.AsyncApi(config.BOT_ACCESS_TOKEN, self._session)
+        events_api = slack._EventsApi(config.BOT_USER_ID, api)
+        return asyncio.run_coroutine_threadsafe(
+            self._process(api, events_api, event), self._loop
+        )
+
+    async def _process(self, api, events_api, event):
+        with metrics.timer("events_api_processing_seconds"):
+            try:
+                await rtm.process_message(
+                    api, events_api, event, self._loop, self._review_requests
+                )
+            except Exception as exc:
+                print(f"Couldn't process event {event!r}: {exc!r}")
+
+
+_processor = None
+_processor_lock = threading.Lock()
+
+
+def get_processor():
+    global _processor
+    with _processor_lock:
+        if _processor is None:
+            _processor = EventProcessor()
+        return _processor
@@ -2,7 +2,24 @@ import re
 import enum
 import json
 import asyncio
+import hashlib
+from json.decoder import WHITESPACE
+from urllib.parse import urlsplit
 import aiohttp
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+# Gerrit returns at most 500 changes for a query by default, but some proxies
+# refuse long URLs way before we could reach that limit.
+CHANGE_NUMBERS_PER_QUERY = 50
+# Change it when the cached value format changes
+CACHE_KEY_PREFIX = "gerrit:changes:v2:"
 
 
 class CodeReview(enum.Enum):
@@ -19,49 +36,67 @@ class Verified(enum.Enum):
     MISSING = None
 
 
+def _parse_code_review(labels):
+    cr = labels["Code-Review"]
+    if "approved" in cr:
+        return CodeReview.PLUS_TWO
+    elif "value" not in cr:
+        return CodeReview.MISSING
+    elif cr["value"] == 1:
+        return CodeReview.PLUS_ONE
+    elif cr["value"] == -1:
+        return CodeReview.MINUS_ONE
+    elif cr["value"] == -2:
+        return CodeReview.MINUS_TWO
+
+
+def _parse_verified(labels):
+    ver = labels["Verified"]
+    if not ver:
+        return Verified.MISSING
+    elif "approved" in ver:
+        return Verified.VERIFIED
+    else:
+        return Verified.FAILED
+
+
 class Change:
+    """Only the fields of a Gerrit change the bot needs, so we don't keep the
+    whole JSON response (accounts, labels details) in memory. Immutable.
+    """
+
+    __slots__ = ("number", "url", "username", "subject", "code_review", "verified")
+
     def __init__(self, gerrit_url, json_change):
-        self._gerrit_url = gerrit_url
-        self._change = json_change
-
-    @property
-    def url(self):
-        change_number = self._change["_number"]
-        return f"{self._gerrit_url}/#/c/{change_number}"
-
-    @property
-    def username(self):
-        # it is the username because it takes less characters, so
-        # more valuable information can fit in one line
-        return self._change["owner"]["username"]
-
-    @property
-    def subject(self):
-        return self._change["subject"]
-
-    @property
-    def code_review(self):
-        cr = self._change["labels"]["Code-Review"]
-        if "approved" in cr:
-            return CodeReview.PLUS_TWO
-        elif "value" not in cr:
-            return CodeReview.MISSING
-        elif cr["value"] == 1:
-            return CodeReview.PLUS_ONE
-        elif cr["value"] == -1:
-            return CodeReview.MINUS_ONE
-        elif cr["value"] == -2:
-            return CodeReview.MINUS_TWO
-
-    @property
-    def verified(self):
-        ver = self._change["labels"]["Verified"]
-        if not ver:
-            return Verified.MISSING
-        elif "approved" in ver:
-            return Verified.VERIFIED
-        else:
-            return Verified.FAILED
+        number = json_change["_number"]
+        labels = json_change["labels"]
+        values = (
+            number,
+            f"{gerrit_url}/#/c/{number}",
+            # it is the username because it takes less characters, so
+            # more valuable information can fit in one line
+            json_change["owner"]["username"],
+            json_change["subject"],
+            _parse_code_review(labels),
+            _parse_verified(labels),
+        )
+        self.__setstate__(values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        return f"Change(number={self.number}, subject={self.subject!r})"
 
 
 def parse_query(url):
@@ -74,16 +109,84 @@ def parse_query(url):
     # https://review.balabit/#/q/topic:f/matez+(status:open)
     # https://review.balabit/#/c/39170/
     # https://review.balabit/39170
-    m = re.search(r"/#/q/(.+)|/#/c/([0-9]+)|/([0-9]+)", url)
+    # search only after the host, it can start with numbers too, like an IP address
+    path = "/" + url.partition("://")[2].partition("/")[2]
+    m = re.search(r"/#/q/(.+)|/#/c/([0-9]+)|/([0-9]+)", path)
+    if m is None:
+        raise ValueError("Invalid URL")
     try:
         return next(g for g in m.groups() if g is not None)
     except StopIteration:
         raise ValueError("Invalid URL")
 
 
+# There is a )]}' sequence at the start of each response, to prevent XSSI.
+# We can't process it simply as JSON because of that.
+XSSI_PREFIX = b")]}'"
+_json_decoder = json.JSONDecoder()
+
+
+def parse_response(body):
+    """Parse the JSON response body bytes without copying it."""
+    start = len(XSSI_PREFIX) if body.startswith(XSSI_PREFIX) else 0
+    if orjson is not None:
+        return orjson.loads(memoryview(body)[start:])
+
+    # The json module can't parse bytes from an offset, so we have to decode
+    # it once, but we don't need to make another copy by slicing the string.
+    text = body.decode("utf-8")
+    start = WHITESPACE.match(text, start).end()
+    result, end = _json_decoder.raw_decode(text, start)
+    if WHITESPACE.match(text, end).end() != len(text):
+        raise json.JSONDecodeError("Extra data", text, end)
+    return result
+
+
+def normalize_query(gerrit_query):
+    # "+" is an URL encoded space, "status:open+owner:self" is the same as
+    # "status:open owner:self"
+    return " ".join(gerrit_query.replace("+", " ").split())
+
+
+def is_change_number(gerrit_query):
+    return gerrit_query.isdigit()
+
+
+def make_change_numbers_query(change_numbers):
+    # "+" is an URL encoded space, the same way queries look in Gerrit URLs
+    return "+OR+".join(f"change:{n}" for n in change_numbers)
+
+
+def _api_method(url):
+    """Last part of the REST API path, like "changes", for the metrics."""
+    return urlsplit(url).path.rstrip("/").rpartition("/")[2]
+
+
 class AsyncApi:
-    def __init__(self, gerrit_url, session):
+    # Shared between instances, so the limit is for the whole Gerrit host,
+    # not only for one CronJob.
+    _semaphores = {}
+    # Queries being fetched right now, so concurrent CronJobs with the same
+    # query can wait for the same response instead of sending it again.
+    _in_flight = {}
+
+    def __init__(
+        self,
+        gerrit_url,
+        session,
+        max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+        cache=None,
+        verify_ssl=False,
+    ):
+        """cache is a Django cache, where the results are stored with its
+        default timeout, so other processes can use them too.
+        """
         self._gerrit_url = gerrit_url
+        # None means the default checks of the session
+        self._ssl = None if verify_ssl else False
+        self._cache = cache
+        self._host = urlsplit(gerrit_url).netloc
+        self._max_concurrent_requests = max_concurrent_requests
         # For +1 and -1 information, LABELS option has to be requested. See:
         # https://gerrit-review.googlesource.com/Documentation/rest-api-changes.html#detailed-labels
         # for owner name, DETAILED_ACCOUNTS:
@@ -91,18 +194,99 @@ class AsyncApi:
         self._changes_api_url = f"{gerrit_url}/changes/?o=LABELS&o=DETAILED_ACCOUNTS&q="
         self._session = session
 
+    def _get_semaphore(self):
+        """None if the number of concurrent requests is not limited."""
+        if self._max_concurrent_requests <= 0:
+            return None
+        # semaphores can only be used in the loop they were created in
+        loop = asyncio.get_event_loop()
+        key = (loop, self._host, self._max_concurrent_requests)
+        try:
+            return self._semaphores[key]
+        except KeyError:
+            semaphore = asyncio.Semaphore(self._max_concurrent_requests)
+            self._semaphores[key] = semaphore
+            return semaphore
+
     async def _get(self, url):
-        async with self._session.get(url, ssl=False) as res:
-            res_body = await res.text()
+        semaphore = self._get_semaphore()
+        if semaphore is None:
+            res_body = await self._read(url)
+        else:
+            async with semaphore:
+                res_body = await self._read(url)
+        return parse_response(res_body)
 
-        # There is a )]}' sequence at the start of each response.
-        # We can't process it simply as JSON because of that.
-        fixed_body = res_body[4:]
-        return json.loads(fixed_body)
+    async def _read(self, url):
+        with metrics.timer("gerrit_request_duration_seconds") as labels:
+            labels.update(method=_api_method(url), status="error")
+            async with self._session.get(url, ssl=self._ssl) as res:
+                labels["status"] = res.status
+                return await res.read()
 
-    async def get_changes(self, gerrit_query):
+    def _make_cache_key(self, gerrit_query):
+        # uWSGI cache keys have a size limit, so we don't store the query itself
+        query = f"{self._gerrit_url} {normalize_query(gerrit_query)}"
+        return CACHE_KEY_PREFIX + hashlib.sha1(query.encode()).hexdigest()
+
+    async def _fetch_changes(self, cache_key, gerrit_query):
         gerrit_change_list = await self._get(self._changes_api_url + gerrit_query)
-        return [Change(self._gerrit_url, c) for c in gerrit_change_list]
+        changes = [Change(self._gerrit_url, c) for c in gerrit_change_list]
+        if self._cache is not None:
+            self._cache.set(cache_key, changes)
+        return changes
+
+    async def get_changes(self, gerrit_query):
+        cache_key = self._make_cache_key(gerrit_query)
+        if self._cache is not None:
+            changes = self._cache.get(cache_key)
+            if changes is not None:
+                return list(changes)
+
+        in_flight_key = (asyncio.get_event_loop(), cache_key)
+        future = self._in_flight.get(in_flight_key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch_changes(cache_key, gerrit_query))
+            self._in_flight[in_flight_key] = future
+            future.add_done_callback(lambda f: self._in_flight.pop(in_flight_key))
+
+        # if one of the waiters is cancelled, the others still need the result
+        changes = await asyncio.shield(future)
+        return list(changes)
+
+    async def get_changes_many(self, gerrit_queries):
+        """Run the queries concurrently and return the results in the same order.
+        Queries for a single change number are looked up together in a few
+        "change:1 OR change:2 ..." queries instead of one request each.
+        If a query failed, the exception is returned in place of its changes.
+        """
+        numbers = sorted({int(q) for q in gerrit_queries if is_change_number(q)})
+        number_chunks = [
+            numbers[i : i + CHANGE_NUMBERS_PER_QUERY]
+            for i in range(0, len(numbers), CHANGE_NUMBERS_PER_QUERY)
+        ]
+        other_queries = list(
+            dict.fromkeys(q for q in gerrit_queries if not is_change_number(q))
+        )
+
+        coros = [self.get_changes(make_change_numbers_query(c)) for c in number_chunks]
+        coros += [self.get_changes(q) for q in other_queries]
+        results = await asyncio.gather(*coros, return_exceptions=True)
+
+        number_results = {}
+        for chunk, gerrit_changes in zip(number_chunks, results):
+            if isinstance(gerrit_changes, Exception):
+                number_results.update((n, gerrit_changes) for n in chunk)
+                continue
+            found = {c.number: c for c in gerrit_changes}
+            number_results.update((n, [found[n]] if n in found else []) for n in chunk)
+
+        query_results = dict(zip(other_queries, results[len(number_chunks) :]))
+
+        return [
+            number_results[int(q)] if is_change_number(q) else query_results[q]
+            for q in gerrit_queries
+        ]
 
     def changes_url(self, gerrit_query):
         return f"{self._gerrit_url}/#/q/{gerrit_query}"
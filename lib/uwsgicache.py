@@ -1,6 +1,9 @@
 """uWSGI cache backend"""
 __version__ = "1.0.1"
 
+import zlib
+import collections
+
 try:
     from django.utils.encoding import force_bytes as stringify
 except ImportError:
@@ -30,6 +33,51 @@ except ImportError:
         )
 
 
+# Values bigger than this are compressed, if it makes them smaller
+COMPRESS_MIN_LENGTH = 1024
+# Compressed values start with this, pickles with protocol 2 or higher with b"\x80"
+COMPRESSED_PREFIX = b"Z"
+
+
+def dumps(value):
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if len(data) > COMPRESS_MIN_LENGTH:
+        compressed = COMPRESSED_PREFIX + zlib.compress(data)
+        if len(compressed) < len(data):
+            return compressed
+    return data
+
+
+def loads(data):
+    if data.startswith(COMPRESSED_PREFIX):
+        data = zlib.decompress(data[len(COMPRESSED_PREFIX) :])
+    return pickle.loads(data)
+
+
+def parse_cache2_options(cache2_options, name):
+    """Options of the named cache from the cache2 options of uwsgi.opt."""
+    if not isinstance(cache2_options, list):
+        cache2_options = [cache2_options]
+    for options in cache2_options:
+        if isinstance(options, bytes):
+            options = options.decode()
+        parsed = dict(
+            option.partition("=")[::2] for option in options.split(",") if option
+        )
+        if parsed.get("name") == name:
+            return parsed
+    return {}
+
+
+def max_value_size(options):
+    """Biggest value fitting in a cache with these options, None if unknown."""
+    # the defaults of uWSGI
+    blocksize = int(options.get("blocksize", 65536))
+    if options.get("bitmap") in ("1", "true"):
+        return blocksize * int(options.get("blocks", options.get("items", 0)))
+    return blocksize
+
+
 if uwsgi:
 
     class UWSGICache(BaseCache):
@@ -37,55 +85,120 @@ if uwsgi:
             BaseCache.__init__(self, params)
             self._cache = uwsgi
             self._server = server
+            self._options = parse_cache2_options(uwsgi.opt.get("cache2", []), server)
+            self._max_value_size = max_value_size(self._options)
+            self._stats = collections.Counter()
 
         def exists(self, key):
             return self._cache.cache_exists(stringify(key), self._server)
 
         def add(self, key, value, timeout=True, version=None):
             full_key = self.make_key(key, version=version)
-            if self.exists(full_key):
-                return False
-            self._set(full_key, value, timeout)
-            return True
+            # cache_set doesn't overwrite an existing key, so only one process adds it
+            return self._set(full_key, value, timeout, overwrite=False)
+
+        def _get(self, full_key):
+            val = self._cache.cache_get(stringify(full_key), self._server)
+            if val is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            return val
 
         def get(self, key, default=None, version=None):
             full_key = self.make_key(key, version=version)
-            val = self._cache.cache_get(stringify(full_key), self._server)
+            val = self._get(full_key)
             if val is None:
                 return default
-            val = stringify(val)
-            return pickle.loads(val)
+            return loads(stringify(val))
+
+        def get_many(self, keys, version=None):
+            rv = {}
+            for key in keys:
+                val = self._get(self.make_key(key, version=version))
+                if val is not None:
+                    rv[key] = loads(stringify(val))
+            return rv
 
-        def _set(self, full_key, value, timeout):
+        def _uwsgi_timeout(self, timeout):
             if timeout is True or timeout == DEFAULT_TIMEOUT:
                 timeout = self.default_timeout
 
             if timeout is None or timeout is False:
                 # Django 1.6+: Explicitly passing in timeout=None will set a non-expiring timeout.
-                uwsgi_timeout = 0
+                return 0
             elif timeout == 0:
                 # Django 1.6+: Passing in timeout=0 will set-and-expire-immediately the value.
-                uwsgi_timeout = -1
+                return -1
             else:
-                uwsgi_timeout = timeout
-            self._cache.cache_update(
-                stringify(full_key), pickle.dumps(value), uwsgi_timeout, self._server
+                return timeout
+
+        def _set(self, full_key, value, timeout, data=None, overwrite=True):
+            """Return False and log the reason if the value couldn't be stored."""
+            if data is None:
+                data = dumps(value)
+            store = self._cache.cache_update if overwrite else self._cache.cache_set
+            stored = store(
+                stringify(full_key),
+                data,
+                self._uwsgi_timeout(timeout),
+                self._server,
             )
+            if stored:
+                self._stats["sets"] += 1
+                self._stats["bytes_set"] += len(data)
+                return True
+            if not overwrite and self.exists(full_key):
+                return False
+
+            self._stats["set_failures"] += 1
+            if self._max_value_size and len(data) > self._max_value_size:
+                reason = (
+                    f"value is {len(data)} bytes, but the cache can store "
+                    f"{self._max_value_size} bytes, check blocksize in uwsgi.ini"
+                )
+            else:
+                reason = "cache is full or the key is too long"
+            print(f'Couldn\'t store "{full_key}" in the {self._server} cache: {reason}')
+            return False
 
         def set(self, key, value, timeout=True, version=None):
             full_key = self.make_key(key, version=version)
             self._set(full_key, value, timeout)
 
+        def set_many(self, data, timeout=True, version=None):
+            """Return the keys which couldn't be stored."""
+            failed_keys = []
+            for key, value in data.items():
+                full_key = self.make_key(key, version=version)
+                if not self._set(full_key, value, timeout):
+                    failed_keys.append(key)
+            return failed_keys
+
         def delete(self, key, version=None):
             full_key = self.make_key(key, version=version)
             self._cache.cache_del(stringify(full_key), self._server)
 
+        def delete_many(self, keys, version=None):
+            for key in keys:
+                self.delete(key, version=version)
+
         def close(self, **kwargs):
             pass
 
         def clear(self):
             self._cache.cache_clear(self._server)
 
+        def stats(self):
+            """Counters of this process and the size of the cache shared by all."""
+            stats = dict(self._stats)
+            stats["max_items"] = int(self._options.get("items", 0)) or None
+            stats["max_value_size"] = self._max_value_size
+            # not available in every uWSGI version
+            if hasattr(self._cache, "cache_keys"):
+                stats["items"] = len(self._cache.cache_keys(self._server))
+            return stats
+
 
 else:
     from django.core.cache.backends.locmem import (
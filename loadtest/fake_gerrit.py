@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Gerrit stand-in for the /changes/ endpoint, serving gerrit_responses/.
+
+Queries for change numbers ("123" or "change:1 OR change:2") get one change
+for every number, generated from the fixture. Any other query gets every
+change in the fixture.
+"""
+
+import re
+import sys
+import json
+import argparse
+from pathlib import Path
+from aiohttp import web
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import gerrit  # noqa: E402
+import standin  # noqa: E402
+
+FIXTURE = ROOT / "gerrit_responses" / "best_changes_DETAILED_ACCOUNTS.json"
+
+
+def load_fixture_changes():
+    return gerrit.parse_response(FIXTURE.read_bytes())
+
+
+def make_response(changes):
+    body = ")]}'\n" + json.dumps(changes)
+    return web.Response(body=body.encode(), content_type="application/json")
+
+
+async def changes(request):
+    fixture_changes = request.app["changes"]
+    query = request.query.get("q", "")
+    numbers = [int(n) for n in re.findall(r"(?:^|change:)([0-9]+)", query)]
+    if not numbers:
+        return make_response(fixture_changes)
+
+    # the same change number always gets the same change from the fixture
+    return make_response(
+        [dict(fixture_changes[n % len(fixture_changes)], _number=n) for n in numbers]
+    )
+
+
+def make_app(faults):
+    app = standin.make_app(faults)
+    app["changes"] = load_fixture_changes()
+    app.router.add_get("/changes/", changes)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gerrit stand-in server")
+    standin.add_fault_arguments(parser)
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    web.run_app(make_app(standin.faults_from_args(args)), port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""Slack Web API and RTM websocket stand-in for the methods the bot uses.
+
+Messages sent to the RTM websocket clients can be pushed with send_event().
+Every received API call is recorded with its time in calls, so the load
+harness can find out when a message has been processed.
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import collections
+from pathlib import Path
+import aiohttp
+from aiohttp import web
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import standin  # noqa: E402
+
+OAUTH_ACCESS = json.loads((ROOT / "slack_messages" / "oauth.access.json").read_text())
+BOT_USER_ID = "UBOTBOTBOT"
+CHANNELS_PER_PAGE = 200
+
+
+class FakeSlack:
+    def __init__(self, faults, channel_count=1000):
+        self.app = standin.make_app(faults)
+        self.app.router.add_route("*", "/api/{method}", self.handle_api)
+        self.app.router.add_get("/rtm", self.handle_rtm)
+        self.base_url = None
+        # {method: [(time.monotonic(), payload)]}
+        self.calls = collections.defaultdict(list)
+        # messages sent to the RTM websocket, like replies in threads
+        self.rtm_received = []
+        self._websockets = set()
+        self._ts = itertools.count(int(time.time()) * 1000000)
+        self._channels = [
+            {"id": f"C{n:08d}", "name": f"channel-{n}"} for n in range(channel_count)
+        ]
+        self._handlers = {
+            "chat.postMessage": self._post_message,
+            "chat.update": self._update_message,
+            "chat.delete": self._delete_message,
+            "chat.getPermalink": self._get_permalink,
+            "conversations.list": self._list_conversations,
+            "reactions.add": lambda payload: {"ok": True},
+            "users.info": self._user_info,
+            "rtm.connect": self._rtm_connect,
+            "oauth.access": lambda payload: OAUTH_ACCESS,
+            "auth.revoke": lambda payload: {"ok": True, "revoked": True},
+        }
+
+    def _next_ts(self):
+        ts = next(self._ts)
+        return f"{ts // 1000000}.{ts % 1000000:06d}"
+
+    def _make_message(self, payload, ts):
+        # Slack sends the colors back without the "#"
+        attachments = [
+            dict(a, id=n, color=a.get("color", "").lstrip("#"))
+            for n, a in enumerate(payload.get("attachments") or [], start=1)
+        ]
+        return {
+            "type": "message",
+            "user": BOT_USER_ID,
+            "text": payload.get("text", ""),
+            "attachments": attachments,
+            "ts": ts,
+        }
+
+    def _post_message(self, payload):
+        ts = self._next_ts()
+        message = self._make_message(payload, ts)
+        return {"ok": True, "channel": payload["channel"], "ts": ts, "message": message}
+
+    def _update_message(self, payload):
+        ts = payload["ts"]
+        message = self._make_message(payload, ts)
+        return {"ok": True, "channel": payload["channel"], "ts": ts, "message": message}
+
+    def _delete_message(self, payload):
+        return {"ok": True, "channel": payload["channel"], "ts": payload["ts"]}
+
+    def _get_permalink(self, payload):
+        channel_id, ts = payload["channel"], payload["message_ts"]
+        permalink = f"{self.base_url}/archives/{channel_id}/p{ts.replace('.', '')}"
+        return {"ok": True, "channel": channel_id, "permalink": permalink}
+
+    def _list_conversations(self, payload):
+        start = int(payload.get("cursor") or 0)
+        end = start + CHANNELS_PER_PAGE
+        next_cursor = str(end) if end < len(self._channels) else ""
+        return {
+            "ok": True,
+            "channels": self._channels[start:end],
+            "response_metadata": {"next_cursor": next_cursor},
+        }
+
+    def _user_info(self, payload):
+        user_id = payload["user"]
+        return {
+            "ok": True,
+            "user": {"id": user_id, "profile": {"display_name": user_id}},
+        }
+
+    def _rtm_connect(self, payload):
+        ws_url = self.base_url.replace("http", "ws", 1) + "/rtm"
+        return {
+            "ok": True,
+            "url": ws_url,
+            "self": {"id": BOT_USER_ID, "name": "slackbot"},
+            "team": {"id": OAUTH_ACCESS["team_id"], "name": OAUTH_ACCESS["team_name"]},
+        }
+
+    async def _read_payload(self, request):
+        payload = dict(request.query)
+        if request.method == "POST":
+            if request.content_type == "application/json":
+                payload.update(await request.json())
+            else:
+                payload.update(await request.post())
+        return payload
+
+    async def handle_api(self, request):
+        method = request.match_info["method"]
+        payload = await self._read_payload(request)
+        self.calls[method].append((time.monotonic(), payload))
+        try:
+            handler = self._handlers[method]
+        except KeyError:
+            return web.json_response({"ok": False, "error": "unknown_method"})
+        return web.json_response(handler(payload))
+
+    async def handle_rtm(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self._websockets.add(ws)
+        await ws.send_json({"type": "hello"})
+        try:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    self.rtm_received.append(json.loads(msg.data))
+        finally:
+            self._websockets.discard(ws)
+        return ws
+
+    @property
+    def rtm_connected(self):
+        return bool(self._websockets)
+
+    async def send_event(self, event):
+        """Send an RTM event to every connected client."""
+        for ws in list(self._websockets):
+            await ws.send_json(event)
+
+    async def start(self, host="127.0.0.1", port=0):
+        runner, self.base_url = await standin.start(self.app, host, port)
+        return runner
+
+
+def make_message_event(channel_id, user_id, text, ts):
+    return {
+        "type": "message",
+        "channel": channel_id,
+        "user": user_id,
+        "text": text,
+        "ts": ts,
+        "client_msg_id": str(random.getrandbits(64)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Slack stand-in server")
+    standin.add_fault_arguments(parser)
+    parser.add_argument("--port", type=int, default=8082)
+    args = parser.parse_args()
+
+    fake_slack = FakeSlack(standin.faults_from_args(args))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(fake_slack.start(port=args.port))
+    print(f"Serving Slack stand-in on {fake_slack.base_url}")
+    loop.run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Stand-in for the uwsgi module, so bot.py and rtm.py can run outside of uWSGI.
+Mule messages are only recorded, nobody receives them. The caches are kept
+in the memory of this process.
+"""
+
+import time
+import threading
+import collections
+
+opt = {}
+numproc = 1
+mule_messages = []
+_lock = threading.Lock()
+# {cache name: {key: (value, expires at or None)}}
+_caches = collections.defaultdict(dict)
+_caches_lock = threading.Lock()
+
+
+def lock():
+    _lock.acquire()
+
+
+def unlock():
+    _lock.release()
+
+
+def is_locked():
+    return _lock.locked()
+
+
+def mule_id():
+    return 1
+
+
+def worker_id():
+    return 0
+
+
+def mule_msg(message, mule_id=None):
+    mule_messages.append((mule_id, message))
+    return True
+
+
+def mule_get_msg():
+    # there are no other processes which could send a message
+    threading.Event().wait()
+
+
+def _get(key, cache):
+    try:
+        value, expires_at = _caches[cache][key]
+    except KeyError:
+        return None
+    if expires_at is not None and expires_at <= time.monotonic():
+        del _caches[cache][key]
+        return None
+    return value
+
+
+def cache_get(key, cache=None):
+    with _caches_lock:
+        return _get(key, cache)
+
+
+def cache_exists(key, cache=None):
+    with _caches_lock:
+        return _get(key, cache) is not None
+
+
+def _update(key, value, expires, cache):
+    # 0 means it never expires, like in uWSGI
+    expires_at = time.monotonic() + expires if expires else None
+    _caches[cache][key] = (bytes(value), expires_at)
+    return True
+
+
+def cache_update(key, value, expires=0, cache=None):
+    with _caches_lock:
+        return _update(key, value, expires, cache)
+
+
+def cache_set(key, value, expires=0, cache=None):
+    """Doesn't overwrite an existing key, like in uWSGI."""
+    with _caches_lock:
+        if _get(key, cache) is not None:
+            return None
+        return _update(key, value, expires, cache)
+
+
+def cache_del(key, cache=None):
+    with _caches_lock:
+        return _caches[cache].pop(key, None) is not None
+
+
+def cache_clear(cache=None):
+    with _caches_lock:
+        _caches[cache].clear()
+
+
+def cache_keys(cache=None):
+    with _caches_lock:
+        return list(_caches[cache])
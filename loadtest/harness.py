@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""End-to-end load test of bot.CronJob and rtm.process_message.
+
+Starts the Gerrit and Slack stand-in servers, creates crontabs and review
+requests in a throwaway database, then runs them through the real code:
+
+  1. every CronJob.run concurrently,
+  2. RTM messages with Gerrit links sent on the stand-in websocket to
+     rtm.wait_messages; a message is done when its reaction arrives.
+
+Prints the throughput and latency percentiles for both.
+
+    python loadtest/harness.py --crontabs 2000 --rtm-messages 5000 \\
+        --gerrit-latency 0.05 --slack-latency 0.02 --slack-rate-limit-rate 0.01
+"""
+
+import os
+import io
+import sys
+import time
+import random
+import itertools
+import collections
+import asyncio
+import argparse
+import contextlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = Path(__file__).resolve().parent
+ROOT = HERE.parent
+sys.path[:0] = [str(HERE), str(ROOT), str(ROOT / "web"), str(ROOT / "lib")]
+
+import fake_uwsgi  # noqa: E402
+
+sys.modules["uwsgi"] = fake_uwsgi
+os.environ["DJANGO_SETTINGS_MODULE"] = "settings"
+# the bot calls the ORM from coroutines, newer Django versions refuse that
+os.environ.setdefault("DJANGO_ALLOW_ASYNC_UNSAFE", "true")
+
+import django  # noqa: E402
+import sessions  # noqa: E402
+import standin  # noqa: E402
+import fake_gerrit  # noqa: E402
+from fake_slack import FakeSlack, make_message_event  # noqa: E402
+
+BOT_ACCESS_TOKEN = "xoxb-loadtest"
+CRONTAB_QUERIES = ["status:open", "status:open+project:scb", "is:starred", "owner:self"]
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return float("nan")
+    index = round(percent / 100 * (len(sorted_values) - 1))
+    return sorted_values[index]
+
+
+def report(name, latencies, elapsed, errors=0):
+    latencies = sorted(latencies)
+    print(
+        f"{name}: {len(latencies)} done, {errors} failed in {elapsed:.2f}s, "
+        f"{len(latencies) / elapsed:.1f}/s, "
+        f"p50 {percentile(latencies, 50) * 1000:.1f} ms, "
+        f"p99 {percentile(latencies, 99) * 1000:.1f} ms, "
+        f"max {latencies[-1] * 1000 if latencies else float('nan'):.1f} ms"
+    )
+
+
+def setup_django(db_path):
+    os.environ["LOADTEST_DB"] = str(db_path)
+    if db_path.exists():
+        db_path.unlink()
+    django.setup()
+    from django.core.management import call_command
+
+    call_command("migrate", verbosity=0)
+
+
+def create_crontabs(count, review_requests_per_crontab, update_in_place):
+    from slackbot.models import Crontab, ReviewRequest
+
+    Crontab.objects.bulk_create(
+        Crontab(
+            channel_name=f"#channel-{n}",
+            channel_id=f"C{n:08d}",
+            gerrit_query=CRONTAB_QUERIES[n % len(CRONTAB_QUERIES)],
+            crontab="0 9 * * 1-5",
+            update_in_place=update_in_place,
+        )
+        for n in range(count)
+    )
+    change_numbers = iter(range(10000, 10**9))
+    ReviewRequest.objects.bulk_create(
+        ReviewRequest(
+            crontab=crontab,
+            ts="1.0",
+            slack_user_id="UREQUESTER",
+            channel_id=crontab.channel_id,
+            gerrit_url=f"https://review.example.com/#/c/{number}",
+            gerrit_query=str(number),
+        )
+        for crontab in Crontab.objects.all()
+        for number in itertools.islice(change_numbers, review_requests_per_crontab)
+    )
+    return list(Crontab.objects.all())
+
+
+async def run_cronjobs(crontabs, gerrit_url, session, loop, concurrency, rounds):
+    import bot
+
+    cronjobs = [
+        bot.CronJob(gerrit_url, BOT_ACCESS_TOKEN, crontab, loop, session)
+        for crontab in crontabs
+    ]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def run(cronjob):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await cronjob.run()
+            except Exception as exc:
+                errors += 1
+                print("CronJob failed:", repr(exc), file=sys.__stderr__)
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await asyncio.gather(*(run(c) for c in cronjobs))
+    return latencies, time.perf_counter() - start, errors
+
+
+async def run_rtm(fake_slack, session, loop, message_count, rate, gerrit_url):
+    import rtm
+    import slack
+
+    api = slack.AsyncApi(BOT_ACCESS_TOKEN, session)
+    rtm_api = await api.rtm_connect()
+    rtm_task = loop.create_task(rtm.wait_messages(rtm_api, api, loop))
+    while not fake_slack.rtm_connected:
+        await asyncio.sleep(0.01)
+
+    sent_at = {}
+    start = time.perf_counter()
+    for n in range(message_count):
+        ts = f"{1500000000 + n}.000100"
+        if n % 10 == 9:
+            # every tenth link is a duplicate of an earlier one, in another form
+            number = 10**8 + random.randrange(n) // 10 * 10
+            text = f"please review <{gerrit_url}/{number}>"
+        else:
+            number = 10**8 + n
+            text = f"please review <{gerrit_url}/#/c/{number}/>"
+        event = make_message_event(f"C{n % 100:08d}", f"U{n % 50:08d}", text, ts)
+        sent_at[ts] = time.monotonic()
+        await fake_slack.send_event(event)
+        # typing noise, the bot should throw these away
+        await fake_slack.send_event(
+            {"type": "user_typing", "channel": event["channel"]}
+        )
+        if rate:
+            await asyncio.sleep(1 / rate)
+
+    def finished():
+        return {p["timestamp"]: t for t, p in fake_slack.calls["reactions.add"]}
+
+    deadline = time.monotonic() + 60
+    while len(finished()) < message_count and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    done = finished()
+    latencies = [done[ts] - sent_at[ts] for ts in sent_at if ts in done]
+    await rtm_api.close()
+    await rtm_task
+    return latencies, elapsed, message_count - len(latencies)
+
+
+def limit_slack(no_rate_limits):
+    import slack
+
+    if no_rate_limits:
+        # only the stand-in server's 429 responses slow us down
+        unlimited = slack.RateLimiter(
+            method_limits={}, default_limit=10**9, channel_limits={}
+        )
+        slack._rate_limiters[BOT_ACCESS_TOKEN] = unlimited
+
+
+async def main_async(args, loop):
+    fake_gerrit_app = fake_gerrit.make_app(standin.faults_from_args(args, "gerrit-"))
+    gerrit_runner, gerrit_url = await standin.start(fake_gerrit_app)
+    fake_slack = FakeSlack(standin.faults_from_args(args, "slack-"))
+    slack_runner = await fake_slack.start()
+
+    import slack
+    from constance import config
+
+    slack.SLACK_API_URL = fake_slack.base_url + "/api"
+    config.GERRIT_URL = gerrit_url
+    config.BOT_ACCESS_TOKEN = BOT_ACCESS_TOKEN
+    limit_slack(args.no_slack_rate_limits)
+
+    session = sessions.make_session()
+    results = []
+    try:
+        crontabs = create_crontabs(
+            args.crontabs, args.review_requests, args.update_in_place
+        )
+        results.append(
+            (
+                "CronJob.run",
+                await run_cronjobs(
+                    crontabs, gerrit_url, session, loop, args.concurrency, args.rounds
+                ),
+            )
+        )
+        if args.rtm_messages:
+            results.append(
+                (
+                    "RTM messages",
+                    await run_rtm(
+                        fake_slack,
+                        session,
+                        loop,
+                        args.rtm_messages,
+                        args.rtm_rate,
+                        gerrit_url,
+                    ),
+                )
+            )
+    finally:
+        await session.close()
+        await gerrit_runner.cleanup()
+        await slack_runner.cleanup()
+
+    stats = [
+        ("Gerrit requests", dict(fake_gerrit_app["stats"])),
+        ("Slack requests", dict(fake_slack.app["stats"])),
+        ("Slack rate limiter", slack.get_rate_limiter(BOT_ACCESS_TOKEN).stats()),
+        ("Connections", sessions.connection_stats()),
+        (
+            "Reactions",
+            collections.Counter(
+                p["name"] for _, p in fake_slack.calls["reactions.add"]
+            ),
+        ),
+    ]
+    return results, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.splitlines()[1:]),
+    )
+    parser.add_argument("--crontabs", type=int, default=1000)
+    parser.add_argument("--review-requests", type=int, default=5, help="per crontab")
+    parser.add_argument("--rounds", type=int, default=2, help="runs of every crontab")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--update-in-place", action="store_true")
+    parser.add_argument("--rtm-messages", type=int, default=1000)
+    parser.add_argument(
+        "--rtm-rate", type=float, default=0, help="messages per second, 0 is no limit"
+    )
+    parser.add_argument(
+        "--no-slack-rate-limits",
+        action="store_true",
+        help="don't hold back requests to the real Slack rate limits",
+    )
+    parser.add_argument(
+        "--db", type=Path, default=Path("/tmp/slackbot-loadtest.sqlite3")
+    )
+    parser.add_argument("--verbose", action="store_true", help="show the bot's output")
+    standin.add_fault_arguments(parser, "gerrit-")
+    standin.add_fault_arguments(parser, "slack-")
+    args = parser.parse_args()
+
+    setup_django(args.db)
+    loop = asyncio.get_event_loop()
+    # own executor, so we can wait for the database writes of the bot to finish
+    executor = ThreadPoolExecutor()
+    loop.set_default_executor(executor)
+    bot_output = io.StringIO() if not args.verbose else sys.stdout
+    with contextlib.redirect_stdout(bot_output):
+        results, stats = loop.run_until_complete(main_async(args, loop))
+        executor.shutdown(wait=True)
+
+    for name, result in results:
+        report(name, *result)
+    for name, stat in stats:
+        print(f"{name}:", stat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""Django settings for the load test: a throwaway database and no uWSGI caches."""
+
+import os
+import tempfile
+
+os.environ.setdefault("SECRET_KEY", "loadtest")
+
+from web.settings import *  # noqa: E402,F401,F403
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.environ.get(
+            "LOADTEST_DB",
+            os.path.join(tempfile.gettempdir(), "slackbot-loadtest.sqlite3"),
+        ),
+    }
+}
+
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "gerrit": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "gerrit",
+        "TIMEOUT": 60,
+    },
+    "metrics": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "metrics",
+    },
+}
+
+CONSTANCE_BACKEND = "constance.backends.memory.MemoryBackend"
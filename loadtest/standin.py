@@ -0,0 +1,90 @@
+"""Common parts of the Gerrit and Slack stand-in servers."""
+
+import random
+import asyncio
+import collections
+from aiohttp import web
+
+
+class Faults:
+    """What goes wrong and how slow a stand-in server is.
+    The rates are the probability of the fault for every request.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        rate_limit_rate=0.0,
+        retry_after=1,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+
+    def delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+
+@web.middleware
+async def faults_middleware(request, handler):
+    faults = request.app["faults"]
+    stats = request.app["stats"]
+
+    # websockets are long lived, latency doesn't make sense for them
+    if request.headers.get("Upgrade", "").lower() == "websocket":
+        return await handler(request)
+
+    await asyncio.sleep(faults.delay())
+
+    if random.random() < faults.rate_limit_rate:
+        response = web.json_response(
+            {"ok": False, "error": "ratelimited"},
+            status=429,
+            headers={"Retry-After": str(faults.retry_after)},
+        )
+    elif random.random() < faults.error_rate:
+        response = web.Response(status=500, text="Stand-in server error")
+    else:
+        response = await handler(request)
+
+    stats[request.path, response.status] += 1
+    return response
+
+
+def add_fault_arguments(parser, prefix=""):
+    parser.add_argument(f"--{prefix}latency", type=float, default=0.0)
+    parser.add_argument(f"--{prefix}jitter", type=float, default=0.0)
+    parser.add_argument(f"--{prefix}error-rate", type=float, default=0.0)
+    parser.add_argument(f"--{prefix}rate-limit-rate", type=float, default=0.0)
+
+
+def faults_from_args(args, prefix=""):
+    prefix = prefix.replace("-", "_")
+    return Faults(
+        latency=getattr(args, f"{prefix}latency"),
+        jitter=getattr(args, f"{prefix}jitter"),
+        error_rate=getattr(args, f"{prefix}error_rate"),
+        rate_limit_rate=getattr(args, f"{prefix}rate_limit_rate"),
+    )
+
+
+def make_app(faults):
+    app = web.Application(middlewares=[faults_middleware])
+    app["faults"] = faults
+    # {(path, status): count}
+    app["stats"] = collections.Counter()
+    return app
+
+
+async def start(app, host="127.0.0.1", port=0):
+    """Start serving the app and return the runner and the base URL."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
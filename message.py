@@ -0,0 +1,65 @@
+import textwrap
+import slack
+import gerrit
+
+
+CODE_REVIEW_ICONS = {
+    gerrit.CodeReview.PLUS_ONE: slack.Emoji.PLUS_ONE,
+    gerrit.CodeReview.PLUS_TWO: slack.Emoji.PLUS_ONE * 2,
+    gerrit.CodeReview.MISSING: slack.Emoji.EXCLAMATION,
+    gerrit.CodeReview.MINUS_ONE: slack.Emoji.POOP,
+    gerrit.CodeReview.MINUS_TWO: slack.Emoji.JS,
+}
+
+VERIFIED_ICONS = {
+    gerrit.Verified.MISSING: "",
+    gerrit.Verified.VERIFIED: slack.Emoji.WHITE_CHECK_MARK,
+    gerrit.Verified.FAILED: slack.Emoji.X,
+}
+
+
+class PostableChange:
+    # Everything is calculated once, because a change is rendered multiple times
+    __slots__ = (
+        "cr",
+        "ver",
+        "url",
+        "username",
+        "subject",
+        "code_review_icon",
+        "verified_icon",
+        "color",
+    )
+
+    def __init__(self, gerrit_change):
+        self.cr = gerrit_change.code_review
+        self.ver = gerrit_change.verified
+        self.url = gerrit_change.url
+        self.username = gerrit_change.username
+        self.subject = slack.escape(gerrit_change.subject)
+        self.code_review_icon = CODE_REVIEW_ICONS.get(self.cr)
+        self.verified_icon = VERIFIED_ICONS.get(self.ver)
+        self.color = self._get_color()
+
+    def _get_color(self):
+        if self.cr == gerrit.CodeReview.PLUS_TWO:
+            return "#36a64f"
+        elif (
+            self.cr == gerrit.CodeReview.PLUS_ONE
+            and self.ver == gerrit.Verified.VERIFIED
+        ):
+            return "#DBF32D"
+        else:
+            return "#EC1313"
+
+    def full_message(self):
+        text = f"CR: {self.code_review_icon} V: {self.verified_icon} {self.username}: {self.subject}"
+        # we count every icon as one character long
+        icon_lenghts = len(self.code_review_icon) + len(self.verified_icon)
+        # Slack wraps lines around this width, so if we cut out here explicitly,
+        # every patch will fit in one line.
+        return textwrap.shorten(text, width=76 + icon_lenghts - 2, placeholder="…")
+
+
+def make_attachments(changes):
+    return [slack.make_attachment(c.color, c.full_message(), c.url) for c in changes]
@@ -0,0 +1,304 @@
+"""Metrics of the web workers and the mules in the Prometheus text format.
+
+Every process records its metrics in its own registry. Under uWSGI, a thread
+stores a snapshot of it in the "metrics" cache every PUBLISH_INTERVAL
+seconds, with the worker or mule id in the key, and the /metrics view
+renders the snapshots of every process.
+"""
+import os
+import time
+import bisect
+import threading
+import collections
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+
+PREFIX = "slackbot_"
+# seconds, from a cached Gerrit query to a Slack request waiting for the rate limit
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PUBLISH_INTERVAL = 10
+CACHE_NAME = "metrics"
+CACHE_KEY_PREFIX = "metrics:"
+
+
+def _labels_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Registry:
+    """Counters, gauges and histograms of one process, can be used from any thread.
+    Collectors are called for every snapshot and return (name, value, labels)
+    gauges, for the stats which are already counted somewhere else.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._gauges = {}
+        # {(name, labels): [count of every bucket and +Inf, sum, count]}
+        self._histograms = {}
+        self._collectors = []
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[name, _labels_key(labels)] += value
+
+    def gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[name, _labels_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = name, _labels_key(labels)
+        with self._lock:
+            try:
+                histogram = self._histograms[key]
+            except KeyError:
+                histogram = self._histograms[key] = [0] * (len(DEFAULT_BUCKETS) + 3)
+            histogram[bisect.bisect_left(DEFAULT_BUCKETS, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe how long the block took, the labels can be changed in it."""
+        started_at = time.monotonic()
+        try:
+            yield labels
+        finally:
+            self.observe(name, time.monotonic() - started_at, **labels)
+
+    def remove(self, name, **labels):
+        """Remove the series with these labels, e.g. of a deleted crontab."""
+        key = name, _labels_key(labels)
+        with self._lock:
+            self._counters.pop(key, None)
+            self._gauges.pop(key, None)
+            self._histograms.pop(key, None)
+
+    def add_collector(self, collect):
+        with self._lock:
+            self._collectors.append(collect)
+
+    def _collect(self):
+        gauges = {}
+        for collect in list(self._collectors):
+            try:
+                for name, value, labels in collect():
+                    gauges[name, _labels_key(labels)] = value
+            except Exception as exc:
+                print(f"Couldn't collect metrics from {collect}: {exc!r}")
+        return gauges
+
+    def snapshot(self):
+        gauges = self._collect()
+        with self._lock:
+            gauges.update(self._gauges)
+            return {
+                "counters": dict(self._counters),
+                "gauges": gauges,
+                "histograms": {k: list(h) for k, h in self._histograms.items()},
+            }
+
+
+def stats_gauges(prefix, stats, label_name="kind"):
+    """Gauges of a stats dict, like MessageQueue.stats(). The numbers of a
+    nested dict are labelled with its keys, other values are left out.
+    """
+    for key, value in stats.items():
+        if isinstance(value, bool) or value is None:
+            continue
+        if isinstance(value, (int, float)):
+            yield prefix + key, value, {}
+        elif isinstance(value, dict):
+            for label, nested_value in value.items():
+                if isinstance(nested_value, (int, float)):
+                    yield prefix + key, nested_value, {label_name: label}
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor which counts the submitted, started and finished calls,
+    it has no public API for the number of waiting calls.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._counts_lock = threading.Lock()
+        self.submitted = 0
+        self.started = 0
+        self.finished = 0
+
+    def _count(self, name):
+        with self._counts_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _call(self, fn, *args, **kwargs):
+        self._count("started")
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._count("finished")
+
+    def submit(self, fn, *args, **kwargs):
+        # before submitting, so a started call is always counted as submitted
+        self._count("submitted")
+        return super().submit(self._call, fn, *args, **kwargs)
+
+    def stats(self):
+        with self._counts_lock:
+            return {
+                "queue_depth": self.submitted - self.started,
+                "running": self.started - self.finished,
+                "finished": self.finished,
+            }
+
+
+def executor_gauges(name, executor):
+    for key, value, labels in stats_gauges("executor_", executor.stats()):
+        yield key, value, dict(labels, executor=name)
+
+
+registry = Registry()
+add_collector = registry.add_collector
+remove = registry.remove
+
+
+def inc(name, value=1, **labels):
+    start_publishing()
+    registry.inc(name, value, **labels)
+
+
+def gauge(name, value, **labels):
+    start_publishing()
+    registry.gauge(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    start_publishing()
+    registry.observe(name, value, **labels)
+
+
+def timer(name, **labels):
+    start_publishing()
+    return registry.timer(name, **labels)
+
+
+def process_name():
+    """Name of this uWSGI worker or mule, None outside of them."""
+    if uwsgi is None:
+        return None
+    mule_id = uwsgi.mule_id()
+    if mule_id:
+        return f"mule{mule_id}"
+    worker_id = uwsgi.worker_id()
+    # the master has no metrics worth publishing
+    return f"worker{worker_id}" if worker_id else None
+
+
+def process_names():
+    """Every worker and mule name, which could have published a snapshot."""
+    mules = uwsgi.opt.get("mule", [])
+    mule_count = len(mules) if isinstance(mules, list) else 1
+    return [f"worker{n}" for n in range(1, uwsgi.numproc + 1)] + [
+        f"mule{n}" for n in range(1, mule_count + 1)
+    ]
+
+
+def _publish_forever(name):
+    from django.core.cache import caches
+
+    cache = caches[CACHE_NAME]
+    while True:
+        time.sleep(PUBLISH_INTERVAL)
+        try:
+            cache.set(CACHE_KEY_PREFIX + name, registry.snapshot())
+        except Exception as exc:
+            print(f"Couldn't publish metrics: {exc!r}")
+
+
+_publisher_pid = None
+_publisher_lock = threading.Lock()
+
+
+def start_publishing():
+    """Start publishing the snapshots of this process, if it's not running yet.
+    Called on every recorded metric, so workers start it after the fork.
+    """
+    global _publisher_pid
+    # threads don't survive a fork, a forked uWSGI worker needs its own
+    if uwsgi is None or _publisher_pid == os.getpid():
+        return
+    name = process_name()
+    if name is None:
+        return
+    with _publisher_lock:
+        if _publisher_pid == os.getpid():
+            return
+        _publisher_pid = os.getpid()
+        thread = threading.Thread(target=_publish_forever, args=(name,), daemon=True)
+        thread.start()
+
+
+def load_snapshots():
+    """{process name: snapshot} of every process, the snapshot of this one is fresh."""
+    snapshots = {}
+    if uwsgi is not None:
+        from django.core.cache import caches
+
+        keys = [CACHE_KEY_PREFIX + name for name in process_names()]
+        for key, snapshot in caches[CACHE_NAME].get_many(keys).items():
+            snapshots[key[len(CACHE_KEY_PREFIX) :]] = snapshot
+    snapshots[process_name() or "local"] = registry.snapshot()
+    return snapshots
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        formatted = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+        return f"{PREFIX}{name}{{{formatted}}} {value}"
+    return f"{PREFIX}{name} {value}"
+
+
+def render(snapshots):
+    """The snapshots in the Prometheus text format, with a process label."""
+    families = collections.defaultdict(list)
+    types = {}
+    for process, snapshot in sorted(snapshots.items()):
+        process_label = (("process", process),)
+        for kind in ("counters", "gauges"):
+            metric_type = "counter" if kind == "counters" else "gauge"
+            for (name, labels), value in sorted(snapshot[kind].items()):
+                if metric_type == "counter":
+                    name += "_total"
+                types[name] = metric_type
+                sample = _format_sample(name, process_label + labels, value)
+                families[name].append(sample)
+
+        for (name, labels), histogram in sorted(snapshot["histograms"].items()):
+            types[name] = "histogram"
+            labels = process_label + labels
+            cumulative = 0
+            for bound, count in zip(DEFAULT_BUCKETS + ("+Inf",), histogram[:-2]):
+                cumulative += count
+                bucket_labels = labels + (("le", str(bound)),)
+                sample = _format_sample(name + "_bucket", bucket_labels, cumulative)
+                families[name].append(sample)
+            families[name].append(_format_sample(name + "_sum", labels, histogram[-2]))
+            families[name].append(
+                _format_sample(name + "_count", labels, histogram[-1])
+            )
+
+    lines = []
+    for name in sorted(families):
+        lines.append(f"# TYPE {PREFIX}{name} {types[name]}")
+        lines.extend(families[name])
+    return "\n".join(lines) + "\n"
@@ -5,18 +5,22 @@ import json
 import random
 import atexit
 import signal
+import threading
+import collections
 import asyncio
 from pprint import pprint
+import hashlib
 import functools
-import aiohttp
 import django
+from django.core.cache import cache
 from constance import config
-import uwsgi
 import gerrit
 import slack
+import sessions
+import metrics
 from slack import MsgType, MsgSubType
 from slackbot.models import Crontab, SentMessage, ReviewRequest
-from bot import MuleMessage, wait_for_setup
+from bot import wait_for_setup
 
 
 class BotCommand(enum.Enum):
@@ -24,7 +28,284 @@ class BotCommand(enum.Enum):
     ROULETTE = ":game_die:", "rulett", "roulette"
 
 
-async def process_message(api, rtm, msg, loop):
+# a change linked in two workers at the same time is claimed by only one of them,
+# the claim is kept until the review request is surely saved
+REVIEW_CLAIM_TIMEOUT = 10 * 60
+REVIEW_CLAIM_KEY_PREFIX = "review:"
+
+
+def claim_review(query, ts):
+    """Return the ts of the message which linked the change first in any process."""
+    key = gerrit.normalize_query(query)
+    # queries can be longer than key_size in uwsgi.ini
+    cache_key = REVIEW_CLAIM_KEY_PREFIX + hashlib.sha1(key.encode()).hexdigest()
+    if cache.add(cache_key, ts, REVIEW_CLAIM_TIMEOUT):
+        return ts
+    return cache.get(cache_key, ts)
+
+
+class ReviewRequestIndex:
+    """Queued review requests, keyed by the change they are for.
+
+    The bot deletes review requests after they got +2, so every hit is checked in
+    the database. Misses are trusted only if no other process adds review requests.
+    """
+
+    def __init__(self, trust_misses=True):
+        self.trust_misses = trust_misses
+        self._lock = threading.Lock()
+        # normalized query -> {gerrit_query: ts of the message which queued it}
+        self._queued = collections.defaultdict(dict)
+        # queued, but not saved to the database yet
+        self._unsaved = set()
+
+    def load(self):
+        rows = ReviewRequest.objects.order_by("pk").values_list("gerrit_query", "ts")
+        with self._lock:
+            self._queued.clear()
+            for query, ts in rows:
+                self._queued[gerrit.normalize_query(query)].setdefault(query, ts)
+        print(f"Loaded {len(self._queued)} queued changes.")
+
+    def _queue(self, key, query, ts):
+        self._queued[key][query] = ts
+        self._unsaved.add(query)
+
+    def saved(self, gerrit_queries):
+        with self._lock:
+            self._unsaved.difference_update(gerrit_queries)
+
+    def split(self, gerrit_urls, ts):
+        """Return the urls of new changes and the queued queries for the others.
+        The new changes are queued with ts right away, so a message processed at
+        the same time finds them, even before they are saved. A change is
+        returned only once, even if it's linked multiple times.
+        """
+        new_urls, seen_keys, queued_queries = [], set(), {}
+        with self._lock:
+            for url in gerrit_urls:
+                query = parse_review_query(url)
+                key = gerrit.normalize_query(query)
+                if key in seen_keys:
+                    continue
+                seen_keys.add(key)
+                if key in self._queued:
+                    queued_queries.update(self._queued[key])
+                else:
+                    self._queue(key, query, ts)
+                    new_urls.append(url)
+        return new_urls, queued_queries
+
+    def check_existing(self, gerrit_urls, new_urls, queued_queries, ts):
+        """Check the result of split in the database: the hits might have been
+        deleted since, the misses might have been saved by another process.
+        Return the urls of the changes queued with ts and the timestamps of the
+        messages which queued the others first.
+        """
+        new_queries = {parse_review_query(url) for url in new_urls}
+        checked_queries = set(queued_queries)
+        if not self.trust_misses:
+            checked_queries.update(new_queries)
+        with self._lock:
+            # they might be saved after the query below, but they are not deleted
+            in_flight = self._unsaved & checked_queries
+        rows = (
+            ReviewRequest.objects.filter(gerrit_query__in=checked_queries)
+            .order_by("pk")
+            .values_list("gerrit_query", "ts")
+        )
+        saved_queries = {}
+        for query, saved_ts in rows:
+            saved_queries.setdefault(query, saved_ts)
+        claimed_queries = {}
+        if not self.trust_misses:
+            for query in new_queries - set(saved_queries):
+                claimed_ts = claim_review(query, ts)
+                if claimed_ts != ts:
+                    claimed_queries[query] = claimed_ts
+
+        queued_queries = dict(queued_queries)
+        with self._lock:
+            for query, saved_ts in {**saved_queries, **claimed_queries}.items():
+                key = gerrit.normalize_query(query)
+                if query in new_queries:
+                    # queued by another process first
+                    new_queries.remove(query)
+                    self._unsaved.discard(query)
+                    self._queued[key][query] = saved_ts
+                    queued_queries[query] = saved_ts
+                else:
+                    self._queued[key].setdefault(query, saved_ts)
+
+            unsaved = in_flight | self._unsaved
+            saved = set(saved_queries) | set(claimed_queries)
+            for query in set(queued_queries) - saved - unsaved:
+                # deleted since it has been queued, e.g. it got +2
+                key = gerrit.normalize_query(query)
+                self._queued[key].pop(query, None)
+                if not self._queued[key]:
+                    del self._queued[key]
+                del queued_queries[query]
+
+            new_urls = []
+            for url in gerrit_urls:
+                query = parse_review_query(url)
+                key = gerrit.normalize_query(query)
+                if key not in self._queued:
+                    claimed_ts = ts if self.trust_misses else claim_review(query, ts)
+                    if claimed_ts == ts:
+                        self._queue(key, query, ts)
+                        new_queries.add(query)
+                    else:
+                        self._queued[key][query] = claimed_ts
+                        queued_queries[query] = claimed_ts
+                if query in new_queries:
+                    new_queries.remove(query)
+                    new_urls.append(url)
+
+        return new_urls, sorted(queued_queries.values())
+
+
+class OverflowPolicy:
+    # wait until there is room, this stops reading from the connection
+    BLOCK = "block"
+    DROP_NEWEST = "drop_newest"
+    DROP_OLDEST = "drop_oldest"
+
+
+_STOP_WORKER = object()
+
+
+class MessageQueue:
+    """Bounded queue of RTM messages, processed by a fixed number of workers.
+
+    When the queue is full, unimportant messages are dropped first: a new one
+    is dropped right away, or the oldest queued one makes room for an important
+    one. The policy only decides what happens when every queued message is
+    important.
+    """
+
+    def __init__(
+        self,
+        handler,
+        maxsize=1000,
+        workers=4,
+        is_important=lambda msg: True,
+        policy=OverflowPolicy.BLOCK,
+    ):
+        self._handler = handler
+        self._maxsize = maxsize
+        self._worker_count = workers
+        self._is_important = is_important
+        self._policy = policy
+        # (time of put, message, is important)
+        self._items = collections.deque()
+        self._workers = []
+        self._not_empty = None
+        self._not_full = None
+
+        self.max_depth = 0
+        self.processed = 0
+        self.dropped = collections.Counter()
+        self._total_wait = 0
+        self.max_wait = 0
+        self._total_processing = 0
+        self.max_processing = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def start(self, loop):
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._workers = [
+            loop.create_task(self._work()) for _ in range(self._worker_count)
+        ]
+
+    async def close(self):
+        """Wait for the queued messages to be processed, then stop the workers."""
+        for _ in self._workers:
+            self._items.append((time.monotonic(), _STOP_WORKER, True))
+        self._not_empty.set()
+        await asyncio.gather(*self._workers)
+
+    async def put(self, msg):
+        important = self._is_important(msg)
+        while len(self._items) >= self._maxsize:
+            if not important:
+                self.dropped["unimportant"] += 1
+                return False
+            if self._drop_oldest(important=False):
+                self.dropped["unimportant"] += 1
+            elif self._policy == OverflowPolicy.DROP_NEWEST:
+                self.dropped["important"] += 1
+                return False
+            elif self._policy == OverflowPolicy.DROP_OLDEST:
+                self._drop_oldest(important=True)
+                self.dropped["important"] += 1
+            else:
+                self._not_full.clear()
+                await self._not_full.wait()
+
+        self._items.append((time.monotonic(), msg, important))
+        self.max_depth = max(self.max_depth, len(self._items))
+        self._not_empty.set()
+        return True
+
+    def _drop_oldest(self, important):
+        for index, item in enumerate(self._items):
+            if item[2] == important:
+                del self._items[index]
+                return True
+        return False
+
+    async def _work(self):
+        while True:
+            while not self._items:
+                self._not_empty.clear()
+                await self._not_empty.wait()
+            put_at, msg, _ = self._items.popleft()
+            self._not_full.set()
+            if msg is _STOP_WORKER:
+                return
+
+            started_at = time.monotonic()
+            try:
+                await self._handler(msg)
+            except Exception as exc:
+                print(f"Couldn't process message {msg!r}: {exc!r}")
+            finally:
+                self._add_timings(started_at - put_at, time.monotonic() - started_at)
+
+    def _add_timings(self, wait, processing):
+        metrics.observe("rtm_queue_wait_seconds", wait)
+        metrics.observe("rtm_message_processing_seconds", processing)
+        self.processed += 1
+        self._total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self._total_processing += processing
+        self.max_processing = max(self.max_processing, processing)
+
+    def stats(self):
+        processed = self.processed or 1
+        return {
+            "depth": len(self._items),
+            "max_depth": self.max_depth,
+            "processed": self.processed,
+            "dropped": dict(self.dropped),
+            "average_wait": self._total_wait / processed,
+            "max_wait": self.max_wait,
+            "average_processing": self._total_processing / processed,
+            "max_processing": self.max_processing,
+        }
+
+
+review_requests = ReviewRequestIndex()
+# set by wait_messages
+message_queue = None
+
+
+async def process_message(api, rtm, msg, loop, review_requests):
     if "ok" in msg:
         return
 
@@ -53,12 +334,23 @@ async def process_message(api, rtm, msg, loop):
         # assert iscoroutine(coro)
         # AssertionError
         # https://bugs.python.org/issue34071
-        filtered_urls, existing_requests = await loop.run_in_executor(
-            None, filter_existing_requests, gerrit_urls
-        )
-        loop.create_task(add_reaction(api, rtm, existing_requests, msg, loop))
-        await loop.run_in_executor(None, save_review_requests, msg, filtered_urls)
-        uwsgi.mule_msg(MuleMessage.RELOAD)
+        filtered_urls, queued_queries = review_requests.split(gerrit_urls, msg["ts"])
+        try:
+            existing_ts = []
+            if queued_queries or not review_requests.trust_misses:
+                filtered_urls, existing_ts = await loop.run_in_executor(
+                    None,
+                    review_requests.check_existing,
+                    gerrit_urls,
+                    filtered_urls,
+                    queued_queries,
+                    msg["ts"],
+                )
+            loop.create_task(add_reaction(api, rtm, existing_ts, msg, loop))
+            # no need to reload the bot, it reads the review requests when it runs
+            await loop.run_in_executor(None, save_review_requests, msg, filtered_urls)
+        finally:
+            review_requests.saved([parse_review_query(url) for url in filtered_urls])
 
 
 def parse_command(text):
@@ -96,23 +388,28 @@ def get_random_attachment(msg):
 
 
 def parse_gerrit_urls(text):
-    return [url for url in slack.parse_links(text) if url.startswith(config.GERRIT_URL)]
+    return [
+        url
+        for url in slack.parse_links(text)
+        if url.startswith(config.GERRIT_URL) and parse_review_query(url) is not None
+    ]
 
 
-def filter_existing_requests(gerrit_urls):
-    existing_requests = list(ReviewRequest.objects.filter(gerrit_url__in=gerrit_urls))
-    existing_urls = {rr.gerrit_url for rr in existing_requests}
-    filtered_urls = [url for url in gerrit_urls if url not in existing_urls]
-    return filtered_urls, existing_requests
+def parse_review_query(url):
+    """Gerrit query of a review link or None if it's not a link to changes."""
+    try:
+        return gerrit.parse_query(url)
+    except ValueError:
+        return None
 
 
-async def add_reaction(api, rtm, existing_requests, msg, loop):
+async def add_reaction(api, rtm, existing_ts, msg, loop):
     channel_id, ts = msg["channel"], msg["ts"]
 
-    if existing_requests:
+    if existing_ts:
         loop.create_task(api.add_reaction(channel_id, ts, "no_entry_sign"))
         # the first will always be a duplicate, we don't have to be very detailed
-        permalink = await api.get_permalink(channel_id, existing_requests[0].ts)
+        permalink = await api.get_permalink(channel_id, existing_ts[0])
         if permalink is not None:
             message = f"Vót má: {permalink}"
         else:
@@ -133,7 +430,7 @@ def save_review_requests(msg, gerrit_urls):
             slack_user_id=msg["user"],
             channel_id=channel_id,
             gerrit_url=url,
-            gerrit_query=gerrit.parse_query(url),
+            gerrit_query=parse_review_query(url),
         )
         objs.append(rr)
 
@@ -148,8 +445,38 @@ async def wait_messages(rtm, api, loop):
 
     print("Got hello")
 
-    async for msg in rtm.wait_messages():
-        loop.create_task(process_message(api, rtm, msg, loop))
+    global message_queue
+    message_queue = MessageQueue(
+        lambda msg: process_message(api, rtm, msg, loop, review_requests),
+        maxsize=config.RTM_QUEUE_SIZE,
+        workers=config.RTM_WORKERS,
+        is_important=is_important_message,
+        policy=config.RTM_OVERFLOW_POLICY,
+    )
+    message_queue.start(loop)
+    metrics.add_collector(
+        lambda: metrics.stats_gauges("rtm_queue_", message_queue.stats())
+    )
+    metrics.add_collector(
+        lambda: (
+            ("rtm_skipped_events", count, {"type": event_type})
+            for event_type, count in rtm.skipped_events.items()
+        )
+    )
+
+    # process_message throws away everything else, like typing and presence events
+    async for msg in rtm.wait_messages(event_types={MsgType.MESSAGE}):
+        metrics.inc("rtm_events", type=msg.get("type"))
+        await message_queue.put(msg)
+
+    await message_queue.close()
+    print("Skipped RTM events:", dict(rtm.skipped_events))
+    print("RTM message queue:", message_queue.stats())
+
+
+def is_important_message(msg):
+    """Messages with links or bot commands, these are kept when the queue is full."""
+    return "<" in msg.get("text", "")
 
 
 def _count_down(from_sec):
@@ -174,9 +501,13 @@ def handle_quit_signals():
 def main():
     django.setup()
     wait_for_setup()
+    review_requests.load()
 
     loop = asyncio.get_event_loop()
-    session = aiohttp.ClientSession(loop=loop)
+    executor = metrics.CountingExecutor()
+    loop.set_default_executor(executor)
+    metrics.add_collector(lambda: metrics.executor_gauges("rtm", executor))
+    session = sessions.make_session(loop)
     api = slack.AsyncApi(config.BOT_ACCESS_TOKEN, session)
 
     for sig in (signal.SIGINT, signal.SIGQUIT):
@@ -0,0 +1,271 @@
+import time
+import zlib
+import heapq
+import collections
+import asyncio
+import threading
+import itertools
+import datetime as dt
+import metrics
+
+
+def utcnow():
+    return dt.datetime.now(dt.timezone.utc)
+
+
+def shard(key, shard_count):
+    """Stable shard index of key, the same in every process and after restarts."""
+    return zlib.crc32(str(key).encode()) % shard_count
+
+
+def spread_offset(key, spread_seconds):
+    """Delay of the job with key within the spread window, always the same for a key."""
+    if spread_seconds <= 0:
+        return 0
+    # salted, so it's independent of the shard, which is also based on crc32(key)
+    millis = zlib.crc32(f"spread:{key}".encode()) % (spread_seconds * 1000)
+    return millis / 1000
+
+
+# run_at is the time the job should have been started
+DueRun = collections.namedtuple("DueRun", "key job run_at")
+
+
+# marks heap entries of removed jobs, they are thrown away when they get to the top
+_REMOVED = object()
+
+
+class Scheduler:
+    """Min-heap of jobs keyed on the next run time of their crontab.
+
+    A crontab is any object with a timezone aware "next" attribute and a
+    calc_next() method which moves "next" forward, like slackbot.models.Crontab.
+    Jobs can be added with a key, which can be used to replace or remove them later.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._heap = []
+        self._entries = {}
+        self._removed_count = 0
+        # tie breaker, so the heap never has to compare crontabs or jobs
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        return list(self._entries)
+
+    def add(self, crontab, job, key=None):
+        if key is None:
+            key = object()
+        self.remove(key)
+        entry = [crontab.next, next(self._counter), crontab, job, key]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, key):
+        """Remove the job added with key. Does nothing if there is no such job."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        entry[3] = _REMOVED
+        self._removed_count += 1
+        # don't let removed entries pile up when the same jobs are changed over and over
+        if self._removed_count > len(self._entries):
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+            self._removed_count = 0
+
+    def clear(self):
+        self._heap.clear()
+        self._entries.clear()
+        self._removed_count = 0
+
+    def _drop_removed(self):
+        while self._heap and self._heap[0][3] is _REMOVED:
+            heapq.heappop(self._heap)
+            self._removed_count -= 1
+
+    def next_run(self):
+        self._drop_removed()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """Return every job which should have run until now.
+
+        If we woke up late and a crontab missed multiple runs, the job is
+        returned only once, so the channel doesn't get spammed with the same message.
+        """
+        return [run.job for run in self.pop_due_runs(now)]
+
+    def pop_due_runs(self, now):
+        """Same as pop_due, but returns DueRuns with the key and scheduled time too."""
+        due_runs = []
+        self._drop_removed()
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            run_at, _, crontab, job, key = entry
+            due_runs.append(DueRun(key, job, run_at))
+            while crontab.next <= now:
+                crontab.calc_next()
+            entry[0] = crontab.next
+            entry[1] = next(self._counter)
+            heapq.heappush(self._heap, entry)
+            self._drop_removed()
+        return due_runs
+
+    def wakeup(self):
+        """Interrupt wait(). Can be called from any thread."""
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def wait(self, now=None):
+        """Sleep until the next job is due or until wakeup() is called."""
+        next_run = self.next_run()
+        if next_run is None:
+            timeout = None
+        else:
+            timeout = max((next_run - (now or utcnow())).total_seconds(), 0)
+
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+
+# labelled with the key of the job, see remove_job_metrics
+JOB_GAUGES = ("cronjob_last_duration_seconds", "cronjob_last_lag_seconds")
+
+
+def remove_job_metrics(key):
+    """Remove the gauges of a removed job, they would be published forever."""
+    for name in JOB_GAUGES:
+        metrics.remove(name, crontab=key)
+
+
+class Dispatcher:
+    """Starts due jobs, at most max_concurrent at the same time.
+
+    With a spread window, every job is delayed by its spread_offset, so the
+    jobs scheduled to the same minute don't hit Gerrit and Slack all at once.
+    A job is anything with an async run() method, like bot.CronJob.
+    """
+
+    def __init__(self, loop, max_concurrent=0, spread_seconds=0):
+        self._loop = loop
+        self.configure(max_concurrent, spread_seconds)
+        self.dispatched = 0
+        self.waiting = 0
+        self.running = 0
+        self.last_lag = 0
+        self.max_lag = 0
+        self._total_lag = 0
+        self._started = 0
+
+    def configure(self, max_concurrent, spread_seconds):
+        """Change the limits, the already dispatched jobs keep the old ones."""
+        self._semaphore = (
+            asyncio.Semaphore(max_concurrent) if max_concurrent > 0 else None
+        )
+        self._spread_seconds = spread_seconds
+
+    def dispatch(self, due_run):
+        self.dispatched += 1
+        return self._loop.create_task(self._run(due_run))
+
+    async def _run(self, due_run):
+        start_at = due_run.run_at + dt.timedelta(
+            seconds=spread_offset(due_run.key, self._spread_seconds)
+        )
+        semaphore = self._semaphore
+        self.waiting += 1
+        try:
+            delay = (start_at - utcnow()).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if semaphore is not None:
+                await semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        started_at = time.monotonic()
+        status = "error"
+        try:
+            lag = (utcnow() - start_at).total_seconds()
+            self._add_lag(lag, due_run.key)
+            print(f"Running job {due_run.job}, dispatch lag: {lag:.3f}s")
+            await due_run.job.run()
+            status = "ok"
+        finally:
+            self.running -= 1
+            if semaphore is not None:
+                semaphore.release()
+            duration = time.monotonic() - started_at
+            metrics.observe("cronjob_duration_seconds", duration)
+            metrics.gauge(
+                "cronjob_last_duration_seconds", duration, crontab=due_run.key
+            )
+            metrics.inc("cronjob_runs", status=status)
+
+    def _add_lag(self, lag, key):
+        metrics.observe("cronjob_lag_seconds", lag)
+        metrics.gauge("cronjob_last_lag_seconds", lag, crontab=key)
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self._total_lag += lag
+        self._started += 1
+
+    def stats(self):
+        return {
+            "dispatched": self.dispatched,
+            "waiting": self.waiting,
+            "running": self.running,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+            "average_lag": self._total_lag / self._started if self._started else 0,
+        }
+
+
+class ReloadAction:
+    SAVED = "saved"
+    DELETED = "deleted"
+    CONFIG_CHANGED = "config_changed"
+
+
+class ReloadQueue:
+    """Collects reload requests from other threads until the scheduler applies them.
+
+    Only the last action is kept for every key and a config change means everything
+    has to be reloaded anyway, so a burst of changes is applied together.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._full_reload = False
+        self._changes = {}
+
+    def __bool__(self):
+        with self._lock:
+            return self._full_reload or bool(self._changes)
+
+    def push(self, action, key=None):
+        with self._lock:
+            if action == ReloadAction.CONFIG_CHANGED:
+                self._full_reload = True
+                self._changes.clear()
+            elif not self._full_reload:
+                self._changes[key] = action
+
+    def pop_all(self):
+        """Return whether everything should be reloaded and the changed keys."""
+        with self._lock:
+            full_reload, changes = self._full_reload, self._changes
+            self._full_reload, self._changes = False, {}
+        return full_reload, changes
@@ -0,0 +1,69 @@
+"""The aiohttp session used for every Gerrit and Slack request of a process.
+
+One session per event loop is enough, it keeps the connections to Gerrit and
+Slack open between requests, so most of them don't need a new TCP and TLS
+handshake.
+"""
+import collections
+import aiohttp
+
+
+# The bot sends at most GERRIT_MAX_CONCURRENT_REQUESTS to Gerrit and a few
+# deletes to Slack at once, the rest should wait for a free connection.
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 20
+# Slack closes idle connections after about a minute
+KEEPALIVE_TIMEOUT = 30
+DNS_CACHE_TTL = 5 * 60
+# Without these a hanging Gerrit could block a crontab forever
+TIMEOUT = aiohttp.ClientTimeout(total=60, connect=10)
+
+# requests, request_errors, connections_created, connections_reused,
+# connections_queued, dns_cache_hits and dns_cache_misses in this process
+stats = collections.Counter()
+
+
+def _count(name):
+    async def on_event(session, trace_config_ctx, params):
+        stats[name] += 1
+
+    return on_event
+
+
+def make_trace_config():
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_count("requests"))
+    trace_config.on_request_exception.append(_count("request_errors"))
+    trace_config.on_connection_create_end.append(_count("connections_created"))
+    trace_config.on_connection_reuseconn.append(_count("connections_reused"))
+    trace_config.on_connection_queued_start.append(_count("connections_queued"))
+    trace_config.on_dns_cache_hit.append(_count("dns_cache_hits"))
+    trace_config.on_dns_cache_miss.append(_count("dns_cache_misses"))
+    return trace_config
+
+
+def make_session(loop=None):
+    """Session with connection pooling, DNS cache and timeouts set up.
+    Responses are gzip compressed if the server supports it, aiohttp asks for
+    it and decompresses them by default.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=CONNECTION_LIMIT,
+        limit_per_host=CONNECTION_LIMIT_PER_HOST,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        loop=loop,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=TIMEOUT,
+        trace_configs=[make_trace_config()],
+        loop=loop,
+    )
+
+
+def connection_stats():
+    rv = dict(stats)
+    opened = rv.get("connections_created", 0) + rv.get("connections_reused", 0)
+    rv["reuse_ratio"] = rv.get("connections_reused", 0) / opened if opened else 0
+    return rv
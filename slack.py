@@ -1,9 +1,18 @@
+import os
 import re
+import hmac
+import atexit
 import json
+import time
+import hashlib
 import asyncio
-from functools import lru_cache
+import threading
+import itertools
+import collections
 from urllib.parse import urlencode
 import aiohttp
+import metrics
+import sessions
 
 
 class Emoji:
@@ -17,6 +26,28 @@ class Emoji:
 
 SLACK_API_URL = "https://slack.com/api"
 SLACK_OAUTH_URL = "https://slack.com/oauth/authorize"
+DEFAULT_MAX_CONCURRENT_DELETES = 5
+
+# Requests per minute for every method we use. See: https://api.slack.com/docs/rate-limits
+TIER_1, TIER_2, TIER_3, TIER_4 = 1, 20, 50, 100
+METHOD_RATE_LIMITS = {
+    "auth.revoke": TIER_3,
+    "channels.info": TIER_3,
+    "chat.delete": TIER_3,
+    "chat.getPermalink": TIER_4,
+    "chat.update": TIER_3,
+    "conversations.list": TIER_2,
+    "reactions.add": TIER_3,
+    "rtm.connect": TIER_1,
+    "rtm.start": TIER_1,
+    "users.info": TIER_4,
+}
+DEFAULT_RATE_LIMIT = TIER_3
+# These are limited for every channel separately, not for the whole workspace,
+# chat.postMessage allows about one message per second in a channel
+CHANNEL_RATE_LIMITS = {"chat.postMessage": 60}
+# A HTTP 429 response means Slack didn't process the request, so it is safe to retry
+MAX_RATE_LIMITED_RETRIES = 3
 
 
 def escape(text):
@@ -41,12 +72,163 @@ def make_attachment(color, author_name, author_link):
     return {"color": color, "author_name": author_name, "author_link": author_link}
 
 
+def make_message(channel_id, text, attachments, thread_ts=None):
+    """Payload for chat.postMessage."""
+    # as_user is needed, so direct messages can be deleted.
+    # if DMs are sent to the user without as_user: True, they appear
+    # as if slackbot sent them and there will be no channel which
+    # can be referenced later to delete the sent messages
+    return {
+        "channel": channel_id,
+        "text": text,
+        "attachments": attachments,
+        "as_user": True,
+        "thread_ts": thread_ts,
+    }
+
+
 class ApiError(Exception):
     """Exception in case a message for Slack failed"""
 
 
+class _TokenBucket:
+    """Lets through burst number of requests at once, then one request
+    in every interval. Times are time.monotonic() seconds.
+    """
+
+    def __init__(self, per_minute, burst):
+        self._interval = 60 / per_minute
+        self._burst_time = (burst - 1) * self._interval
+        # when the next request would be allowed, if there were no bursts
+        self._theoretical_arrival = 0.0
+        self._blocked_until = 0.0
+
+    def reserve(self, now):
+        """Reserve the next free slot and return how much we need to wait for it."""
+        start = max(
+            now, self._theoretical_arrival - self._burst_time, self._blocked_until
+        )
+        self._theoretical_arrival = (
+            max(self._theoretical_arrival, start) + self._interval
+        )
+        return start - now
+
+    def block(self, until):
+        self._blocked_until = max(self._blocked_until, until)
+
+
+class RateLimitStats:
+    def __init__(self):
+        self.queued = 0
+        self.calls = 0
+        self.rate_limited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def as_dict(self):
+        return {
+            "queued": self.queued,
+            "calls": self.calls,
+            "rate_limited": self.rate_limited,
+            "total_wait": self.total_wait,
+            "max_wait": self.max_wait,
+        }
+
+
+class RateLimiter:
+    """Delays requests, so they don't go over the Slack rate limits."""
+
+    def __init__(
+        self, method_limits=None, default_limit=DEFAULT_RATE_LIMIT, channel_limits=None
+    ):
+        if method_limits is None:
+            method_limits = METHOD_RATE_LIMITS
+        if channel_limits is None:
+            channel_limits = CHANNEL_RATE_LIMITS
+        self._method_limits = method_limits
+        self._default_limit = default_limit
+        self._channel_limits = channel_limits
+        # {(method, channel or None): _TokenBucket}
+        self._buckets = {}
+        # stats are per method, even if the buckets are per channel
+        self._stats = {}
+        # the sync Api and the web workers might use it from multiple threads
+        self._lock = threading.Lock()
+
+    def _bucket_key(self, method, channel):
+        return method, channel if method in self._channel_limits else None
+
+    def _reserve(self, method, channel):
+        key = self._bucket_key(method, channel)
+        with self._lock:
+            try:
+                bucket = self._buckets[key]
+            except KeyError:
+                per_minute = self._channel_limits.get(
+                    method, self._method_limits.get(method, self._default_limit)
+                )
+                bucket = _TokenBucket(per_minute, burst=max(1, per_minute // 10))
+                self._buckets[key] = bucket
+            try:
+                stats = self._stats[method]
+            except KeyError:
+                stats = self._stats[method] = RateLimitStats()
+
+            wait = bucket.reserve(time.monotonic())
+            stats.calls += 1
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+            return wait, stats
+
+    async def acquire(self, method, channel=None):
+        wait, stats = self._reserve(method, channel)
+        if wait <= 0:
+            return
+        stats.queued += 1
+        try:
+            await asyncio.sleep(wait)
+        finally:
+            stats.queued -= 1
+
+    def retry_after(self, method, seconds, channel=None):
+        """Slack told us to slow down, nothing goes out for this method
+        (in this channel, if it's limited per channel) until then.
+        """
+        with self._lock:
+            self._buckets[self._bucket_key(method, channel)].block(
+                time.monotonic() + seconds
+            )
+            self._stats[method].rate_limited += 1
+
+    def stats(self):
+        """Queue depth and wait times for every method used so far."""
+        with self._lock:
+            return {method: s.as_dict() for method, s in self._stats.items()}
+
+
+# Slack rate limits are per workspace, so every AsyncApi with the same token
+# in the process should use the same limiter.
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(token):
+    with _rate_limiters_lock:
+        try:
+            return _rate_limiters[token]
+        except KeyError:
+            rate_limiter = _rate_limiters[token] = RateLimiter()
+            return rate_limiter
+
+
+def rate_limiters():
+    """Every RateLimiter created in this process."""
+    with _rate_limiters_lock:
+        return list(_rate_limiters.values())
+
+
 class AsyncApi:
-    def __init__(self, token, session):
+    def __init__(self, token, session, rate_limiter=None):
         self._token = token
         self._headers = {
             "Authorization": "Bearer " + token,
@@ -54,6 +236,12 @@ class AsyncApi:
             "Content-Type": "application/json; charset=utf-8",
         }
         self._session = session
+        if rate_limiter is None:
+            rate_limiter = get_rate_limiter(token)
+        self._rate_limiter = rate_limiter
+
+    def rate_limit_stats(self):
+        return self._rate_limiter.stats()
 
     def _error_message(self, res, method, body, payload):
         return (
@@ -77,11 +265,31 @@ class AsyncApi:
 
         return json_res
 
+    async def _send(self, method, payload, make_request):
+        channel = payload.get("channel") if payload else None
+        for retry in itertools.count():
+            await self._rate_limiter.acquire(method, channel)
+            with metrics.timer("slack_request_duration_seconds") as labels:
+                labels.update(method=method, status="error")
+                async with make_request() as res:
+                    labels["status"] = res.status
+                    if res.status == 429 and retry < MAX_RATE_LIMITED_RETRIES:
+                        retry_after = float(res.headers.get("Retry-After", 1))
+                        print(
+                            f"Rate limited during {method}, retry after {retry_after}s"
+                        )
+                        self._rate_limiter.retry_after(method, retry_after, channel)
+                        continue
+                    return await self._make_json_res(res, method, payload)
+
     async def _get(self, method, params=None):
         print("Request", method, params)
         url = f"{SLACK_API_URL}/{method}"
-        async with self._session.get(url, params=params, headers=self._headers) as res:
-            return await self._make_json_res(res, method, params)
+        return await self._send(
+            method,
+            params,
+            lambda: self._session.get(url, params=params, headers=self._headers),
+        )
 
     async def _get_all(self, method, field, params):
         rv = []
@@ -99,8 +307,11 @@ class AsyncApi:
     async def _post(self, method, payload):
         print("Posting to", method, payload)
         url = f"{SLACK_API_URL}/{method}"
-        async with self._session.post(url, headers=self._headers, json=payload) as res:
-            return await self._make_json_res(res, method, payload)
+        return await self._send(
+            method,
+            payload,
+            lambda: self._session.post(url, headers=self._headers, json=payload),
+        )
 
     async def add_reaction(self, channel, ts, reaction_name):
         payload = {"channel": channel, "timestamp": ts, "name": reaction_name}
@@ -115,6 +326,19 @@ class AsyncApi:
         params = {"types": "public_channel,private_channel"}
         return await self._get_all("conversations.list", "channels", params)
 
+    async def list_channels_page(self, cursor=None, limit=200):
+        """Return one page of channels and the cursor of the next one, or None
+        as cursor after the last page. Returns None if the request failed.
+        """
+        params = {"types": "public_channel,private_channel", "limit": limit}
+        if cursor:
+            params["cursor"] = cursor
+        json_res = await self._get("conversations.list", params)
+        if not json_res["ok"]:
+            return None
+        next_cursor = json_res.get("response_metadata", {}).get("next_cursor")
+        return json_res["channels"], next_cursor or None
+
     async def get_channel_id(self, channel_name):
         name = channel_name.lstrip("#")
         # TODO: make it async for
@@ -123,24 +347,39 @@ class AsyncApi:
                 return channel["id"]
 
     async def post_message(self, channel_id, text, attachments, thread_ts=None):
-        # as_user is needed, so direct messages can be deleted.
-        # if DMs are sent to the user without as_user: True, they appear
-        # as if slackbot sent them and there will be no channel which
-        # can be referenced later to delete the sent messages
+        payload = make_message(channel_id, text, attachments, thread_ts)
+        return await self._post("chat.postMessage", payload)
+
+    async def update_message(self, channel_id, ts, text, attachments):
         return await self._post(
-            "chat.postMessage",
+            "chat.update",
             {
                 "channel": channel_id,
+                "ts": ts,
                 "text": text,
                 "attachments": attachments,
                 "as_user": True,
-                "thread_ts": thread_ts,
             },
         )
 
     async def delete_message(self, channel_id, ts):
         return await self._post("chat.delete", {"channel": channel_id, "ts": ts})
 
+    async def delete_messages(
+        self, messages, max_concurrent=DEFAULT_MAX_CONCURRENT_DELETES
+    ):
+        """Delete multiple (channel_id, ts) messages concurrently.
+        Returns the responses in the same order, or the exception if a request failed.
+        """
+        semaphore = asyncio.Semaphore(max_concurrent)
+
+        async def delete(channel_id, ts):
+            async with semaphore:
+                return await self.delete_message(channel_id, ts)
+
+        coros = [delete(channel_id, ts) for channel_id, ts in messages]
+        return await asyncio.gather(*coros, return_exceptions=True)
+
     async def user_info(self, user_id):
         return await self._get("users.info", {"user": user_id})
 
@@ -148,8 +387,11 @@ class AsyncApi:
         method = "auth.revoke"
         url = f"{SLACK_API_URL}/{method}"
         # this method doesn't accept JSON body
-        async with self._session.post(url, {"token": self._token}) as res:
-            return await self._make_json_res(res, method, {"token": "XXXXXXXXXX"})
+        return await self._send(
+            method,
+            {"token": "XXXXXXXXXX"},
+            lambda: self._session.post(url, {"token": self._token}),
+        )
 
     async def channel_info(self, channel_id):
         return await self._get("channels.info", {"channel": channel_id})
@@ -192,10 +434,22 @@ class MsgSubType:
     MESSAGE_DELETED = "message_deleted"
 
 
+# Slack puts the type first in RTM events, this way we can read it without
+# decoding the whole event. Frames not matching it are decoded like before.
+EVENT_TYPE_PREFIX = re.compile(r'\s*\{\s*"type"\s*:\s*"([^"\\]*)"')
+
+
+def peek_event_type(data):
+    """Type of the RTM event in the raw data or None if it's not at the start."""
+    m = EVENT_TYPE_PREFIX.match(data)
+    return m.group(1) if m else None
+
+
 class _RealtimeApi:
     def __init__(self, bot_id, ws):
         self._bot_id = bot_id
         self._ws = ws
+        self._skipped_events = collections.Counter()
 
     @property
     def bot_id(self):
@@ -209,9 +463,27 @@ class _RealtimeApi:
         msg = await self.wait_messages().__anext__()
         return msg["type"] == MsgType.HELLO
 
-    async def wait_messages(self):
+    @property
+    def skipped_events(self):
+        """Number of events skipped by wait_messages, by event type."""
+        return collections.Counter(self._skipped_events)
+
+    async def wait_messages(self, event_types=None):
+        """Yield the decoded events. If event_types is given, other events are
+        skipped without decoding them, except goodbye, which closes the connection.
+        """
         async for msg in self._ws:
             if msg.type == aiohttp.WSMsgType.TEXT:
+                if event_types is not None:
+                    event_type = peek_event_type(msg.data)
+                    if (
+                        event_type is not None
+                        and event_type not in event_types
+                        and event_type != MsgType.GOODBYE
+                    ):
+                        self._skipped_events[event_type] += 1
+                        continue
+
                 message_json = json.loads(msg.data)
                 if message_json.get("type") == MsgType.GOODBYE:
                     await self.close()
@@ -247,27 +519,150 @@ class _RealtimeApi:
         await self._ws.send_json(message)
 
 
-class Api(AsyncApi):
-    def __init__(self, token):
+# Slack refuses requests older than 5 minutes too, this protects against replays
+MAX_SIGNATURE_AGE = 5 * 60
+
+
+def verify_signature(signing_secret, timestamp, body, signature, now=None):
+    """Check the X-Slack-Signature header of an Events API request.
+    See: https://api.slack.com/docs/verifying-requests-from-slack
+    """
+    if not signing_secret or not timestamp or not signature:
+        return False
+    try:
+        age = (now or time.time()) - int(timestamp)
+    except ValueError:
+        return False
+    if abs(age) > MAX_SIGNATURE_AGE:
+        return False
+
+    base = b"v0:" + timestamp.encode() + b":" + body
+    digest = hmac.new(signing_secret.encode(), base, hashlib.sha256).hexdigest()
+    return hmac.compare_digest("v0=" + digest, signature)
+
+
+class _EventsApi:
+    """Stands in for _RealtimeApi when messages come from the Events API,
+    so the same code can process them. Replies are sent through the Web API.
+    """
+
+    def __init__(self, bot_id, api):
+        self._bot_id = bot_id
+        self._api = api
+
+    @property
+    def bot_id(self):
+        return self._bot_id
+
+    @property
+    def bot_mention(self):
+        return f"<@{self.bot_id}>"
+
+    async def close(self):
+        # there is no connection to restart
+        pass
+
+    async def send_typing_indicator(self, channel_id):
+        # not available in the Web API
+        pass
+
+    async def reply_in_thread(self, channel_id, ts, text):
+        await self._api.post_message(channel_id, text, [], ts)
+
+
+class BackgroundLoop:
+    """Event loop running forever in a daemon thread, with one aiohttp session.
+
+    Synchronous code can submit coroutines to it from any thread, so every
+    caller in the process shares the same connection pool.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self._thread_id = None
+        self._start_error = None
+        started = threading.Event()
+        thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        thread.start()
+        started.wait()
+        if self._start_error is not None:
+            raise self._start_error
+
+    def _run(self, started):
         try:
-            self._loop = asyncio.get_event_loop()
-        except RuntimeError:
-            # when running in a thread, get_event_loop doesn't create another one
-            self._loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self._loop)
-
-        self._session = aiohttp.ClientSession(loop=self._loop)
-        super().__init__(token, self._session)
-
-    @lru_cache(maxsize=None)
-    def __getattribute__(self, name):
-        attr = super().__getattribute__(name)
+            asyncio.set_event_loop(self.loop)
+            self._thread_id = threading.get_ident()
+            self.session = self.loop.run_until_complete(self._make_session())
+        except Exception as exc:
+            # raised in the caller, the thread would die silently
+            self._start_error = exc
+            self.loop.close()
+            return
+        finally:
+            started.set()
+        self.loop.run_forever()
+
+    async def _make_session(self):
+        return sessions.make_session()
+
+    def submit(self, coro):
+        """Schedule coro on the loop and return a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """Run coro on the loop and wait for the result."""
+        if threading.get_ident() == self._thread_id:
+            coro.close()
+            # waiting for the loop in its own thread would block it forever
+            raise RuntimeError("Can't wait for the background loop in its own thread")
+        return self.submit(coro).result()
+
+    def close(self):
+        self.submit(self.session.close()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+_background_loop = None
+_background_loop_pid = None
+_background_loop_lock = threading.Lock()
+
+
+def get_background_loop():
+    """The BackgroundLoop of the process, started on first use."""
+    global _background_loop, _background_loop_pid
+    with _background_loop_lock:
+        # threads don't survive a fork, a forked uWSGI worker needs its own
+        if _background_loop is None or _background_loop_pid != os.getpid():
+            _background_loop = BackgroundLoop()
+            _background_loop_pid = os.getpid()
+        return _background_loop
+
+
+@atexit.register
+def _close_background_loop():
+    if _background_loop is not None and _background_loop_pid == os.getpid():
+        _background_loop.close()
+
+
+class Api:
+    """Synchronous facade of AsyncApi for Django views, forms and models.
+
+    The calls run on the background loop of the process, so creating an
+    instance is cheap and the connections are reused between instances.
+    """
+
+    def __init__(self, token):
+        self._background_loop = get_background_loop()
+        self._api = AsyncApi(token, self._background_loop.session)
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
         if name.startswith("_") or not asyncio.iscoroutinefunction(attr):
             return attr
 
         def call_sync(*args, **kwargs):
-            coro = attr(*args, **kwargs)
-            return self._loop.run_until_complete(coro)
+            return self._background_loop.run(attr(*args, **kwargs))
 
         return call_sync
 
@@ -281,10 +676,11 @@ class App:
         self._redirect_uri = redirect_uri
 
     def request_oauth_token(self, code):
-        loop = asyncio.get_event_loop()
-        return loop.run_until_complete(self._request_oauth_token(code))
+        background_loop = get_background_loop()
+        coro = self._request_oauth_token(background_loop.session, code)
+        return background_loop.run(coro)
 
-    async def _request_oauth_token(self, code):
+    async def _request_oauth_token(self, session, code):
         # documentation: https://api.slack.com/methods/oauth.access
         url = SLACK_API_URL + "/oauth.access"
         payload = {
@@ -293,10 +689,9 @@ class App:
             "redirect_uri": self._redirect_uri,
             "code": code,
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=payload) as res:
-                # example in slack_messages/oauth.access.json
-                return await res.json()
+        async with session.post(url, data=payload) as res:
+            # example in slack_messages/oauth.access.json
+            return await res.json()
 
     def make_button_url(self, state):
         params = {
@@ -1,7 +1,16 @@
+import re
+import json
+import pickle
+import asyncio
+from pathlib import Path
+import aiohttp
 import gerrit
 import pytest
 
 
+GERRIT_RESPONSES = Path(__file__).parent.parent / "gerrit_responses"
+
+
 @pytest.mark.parametrize(
     "url, expected_query",
     (
@@ -11,6 +20,8 @@ import pytest
         ),
         ("https://review.balabit/#/c/39170/", "39170"),
         ("https://review.balabit/39170", "39170"),
+        ("http://10.0.0.1:8080/#/c/39170/", "39170"),
+        ("https://review.balabit/gerrit/39170", "39170"),
     ),
 )
 def test_parse_url(url, expected_query):
@@ -20,9 +31,281 @@ def test_parse_url(url, expected_query):
 def test_invalid_parse_url():
     with pytest.raises(ValueError):
         gerrit.parse_query("some-invalid-url.com")
+    with pytest.raises(ValueError):
+        gerrit.parse_query("https://review.example.com/dashboard/self")
 
 
 class TestGerritClient:
     def test_changes_url(self):
         client = gerrit.AsyncApi("http://some.url", None)
         assert client.changes_url("some-query") == "http://some.url/#/q/some-query"
+
+
+class FakeResponse:
+    status = 200
+
+    def __init__(self, body):
+        self._body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def read(self):
+        return self._body.encode()
+
+
+class FakeSession:
+    """Answers every query with the changes numbered as the numbers in the query."""
+
+    def __init__(self, fail_queries=(), missing_numbers=()):
+        self.requested_urls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._fail_queries = fail_queries
+        self._missing_numbers = missing_numbers
+
+    def get(self, url, **kwargs):
+        self.requested_urls.append(url)
+        return self._respond(url)
+
+    def _respond(self, url):
+        session = self
+        query = url.split("q=", 1)[1]
+
+        class Response(FakeResponse):
+            async def __aenter__(self):
+                session.in_flight += 1
+                session.max_in_flight = max(session.max_in_flight, session.in_flight)
+                # let the other requests start
+                await asyncio.sleep(0.01)
+                session.in_flight -= 1
+                if query in session._fail_queries:
+                    raise aiohttp.ClientError(query)
+                return self
+
+        numbers = [int(n) for n in re.findall(r"[0-9]+", query)]
+        changes = [
+            make_json_change(n) for n in numbers if n not in self._missing_numbers
+        ]
+        return Response(")]}'\n" + json.dumps(changes))
+
+
+def make_json_change(number):
+    return {
+        "_number": number,
+        "subject": f"Change {number}",
+        "owner": {"username": "someone"},
+        "labels": {"Code-Review": {}, "Verified": {}},
+    }
+
+
+class TestGetChangesMany:
+    def test_results_are_in_order(self):
+        session = FakeSession()
+        api = gerrit.AsyncApi("http://some.url", session)
+        queries = ["owner:3", "owner:1", "owner:2"]
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(api.get_changes_many(queries))
+        loop.close()
+        assert [[c.url for c in r] for r in results] == [
+            ["http://some.url/#/c/3"],
+            ["http://some.url/#/c/1"],
+            ["http://some.url/#/c/2"],
+        ]
+
+    def test_failed_query_is_isolated(self):
+        session = FakeSession(fail_queries={"owner:2"})
+        api = gerrit.AsyncApi("http://some.url", session)
+        loop = asyncio.new_event_loop()
+        queries = ["owner:1", "owner:2", "owner:3"]
+        results = loop.run_until_complete(api.get_changes_many(queries))
+        loop.close()
+        assert isinstance(results[1], aiohttp.ClientError)
+        assert results[0][0].subject == "Change 1"
+        assert results[2][0].subject == "Change 3"
+
+    def test_concurrency_is_limited(self):
+        session = FakeSession()
+        api = gerrit.AsyncApi("http://some.url", session, max_concurrent_requests=3)
+        loop = asyncio.new_event_loop()
+        queries = [f"owner:{n}" for n in range(10)]
+        loop.run_until_complete(api.get_changes_many(queries))
+        loop.close()
+        assert len(session.requested_urls) == 10
+        assert session.max_in_flight == 3
+
+    def test_zero_means_no_limit(self):
+        session = FakeSession()
+        api = gerrit.AsyncApi("http://some.url", session, max_concurrent_requests=0)
+        loop = asyncio.new_event_loop()
+        queries = [f"owner:{n}" for n in range(10)]
+        results = loop.run_until_complete(
+            asyncio.wait_for(api.get_changes_many(queries), 1)
+        )
+        loop.close()
+        assert len(results) == 10
+        assert session.max_in_flight == 10
+
+    def test_change_numbers_are_batched(self):
+        session = FakeSession()
+        api = gerrit.AsyncApi("http://some.url", session)
+        queries = [str(n) for n in range(1, 121)]
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(api.get_changes_many(queries))
+        loop.close()
+        assert len(session.requested_urls) == 3
+        assert "q=change:1+OR+change:2+OR+change:3+OR+" in session.requested_urls[0]
+        assert [r[0].number for r in results] == list(range(1, 121))
+
+    def test_batched_and_other_queries_mixed(self):
+        session = FakeSession(fail_queries={"owner:5"})
+        api = gerrit.AsyncApi("http://some.url", session)
+        queries = ["2", "owner:5", "1", "owner:7", "2"]
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(api.get_changes_many(queries))
+        loop.close()
+        assert len(session.requested_urls) == 3
+        assert results[0][0].number == 2
+        assert isinstance(results[1], aiohttp.ClientError)
+        assert results[2][0].number == 1
+        assert results[3][0].number == 7
+        assert results[4][0].number == 2
+
+    def test_missing_change_number(self):
+        session = FakeSession(missing_numbers={2})
+        api = gerrit.AsyncApi("http://some.url", session)
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(api.get_changes_many(["1", "2"]))
+        loop.close()
+        assert results[0][0].number == 1
+        assert results[1] == []
+
+
+class DictCache:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+
+def test_normalize_query():
+    assert gerrit.normalize_query(" status:open+owner:self ") == (
+        "status:open owner:self"
+    )
+
+
+class TestQueryCache:
+    def test_concurrent_same_queries_are_fetched_once(self):
+        session = FakeSession()
+        api1 = gerrit.AsyncApi("http://some.url", session)
+        api2 = gerrit.AsyncApi("http://some.url", session)
+
+        async def get_both():
+            return await asyncio.gather(
+                api1.get_changes("owner:1+status:open"),
+                api2.get_changes("owner:1 status:open"),
+            )
+
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(get_both())
+        loop.close()
+        assert len(session.requested_urls) == 1
+        assert results[0][0].number == results[1][0].number == 1
+
+    def test_results_are_cached(self):
+        session = FakeSession()
+        cache = DictCache()
+        api = gerrit.AsyncApi("http://some.url", session, cache=cache)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(api.get_changes("owner:1"))
+        other_process_api = gerrit.AsyncApi("http://some.url", session, cache=cache)
+        changes = loop.run_until_complete(other_process_api.get_changes("owner:1"))
+        loop.close()
+        assert len(session.requested_urls) == 1
+        assert changes[0].number == 1
+
+    def test_failed_queries_are_not_cached(self):
+        session = FakeSession(fail_queries={"owner:1"})
+        cache = DictCache()
+        api = gerrit.AsyncApi("http://some.url", session, cache=cache)
+        loop = asyncio.new_event_loop()
+        with pytest.raises(aiohttp.ClientError):
+            loop.run_until_complete(api.get_changes("owner:1"))
+        with pytest.raises(aiohttp.ClientError):
+            loop.run_until_complete(api.get_changes("owner:1"))
+        loop.close()
+        assert len(session.requested_urls) == 2
+        assert cache.data == {}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def json_backend(request, monkeypatch):
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(gerrit, "orjson", None)
+
+
+@pytest.mark.parametrize(
+    "file_name",
+    ["1000071.json", "best_changes.json", "best_changes_DETAILED_ACCOUNTS.json"],
+)
+def test_parse_response(json_backend, file_name):
+    body = (GERRIT_RESPONSES / file_name).read_bytes()
+    text = body.decode()
+    expected = json.loads(text[4:] if text.startswith(")]}'") else text)
+    assert gerrit.parse_response(body) == expected
+
+
+def test_parse_response_without_prefix(json_backend):
+    assert gerrit.parse_response(b' [{"_number": 1}]\n') == [{"_number": 1}]
+
+
+def test_parse_invalid_response(json_backend):
+    with pytest.raises(ValueError):
+        gerrit.parse_response(b")]}'\n[1] [2]")
+
+
+class TestChange:
+    def load_changes(self, file_name):
+        body = (GERRIT_RESPONSES / file_name).read_bytes()
+        json_changes = gerrit.parse_response(body)
+        return [gerrit.Change("http://some.url", c) for c in json_changes]
+
+    def test_fields(self):
+        change = self.load_changes("best_changes_DETAILED_ACCOUNTS.json")[0]
+        assert change.number == 33339
+        assert change.url == "http://some.url/#/c/33339"
+        assert change.username == "vlaci"
+        assert change.subject == (
+            "zorp-core/tests: adding missing entry for RADIUS test dictionary"
+        )
+        assert isinstance(change.code_review, gerrit.CodeReview)
+        assert isinstance(change.verified, gerrit.Verified)
+
+    def test_immutable(self):
+        change = gerrit.Change("http://some.url", make_json_change(1))
+        with pytest.raises(AttributeError):
+            change.subject = "other"
+        with pytest.raises(AttributeError):
+            change.extra = "field"
+        with pytest.raises(AttributeError):
+            del change.subject
+
+    def test_doesnt_keep_json(self):
+        change = gerrit.Change("http://some.url", make_json_change(1))
+        assert not hasattr(change, "__dict__")
+
+    def test_pickle(self):
+        changes = self.load_changes("best_changes_DETAILED_ACCOUNTS.json")
+        unpickled = pickle.loads(pickle.dumps(changes, pickle.HIGHEST_PROTOCOL))
+        assert [c.__getstate__() for c in unpickled] == [
+            c.__getstate__() for c in changes
+        ]
@@ -0,0 +1,105 @@
+import time
+import threading
+import metrics
+
+
+def test_snapshot():
+    registry = metrics.Registry()
+    registry.inc("runs", status="ok")
+    registry.inc("runs", 2, status="ok")
+    registry.gauge("depth", 5)
+    registry.add_collector(lambda: [("queue_depth", 3, {"queue": "rtm"})])
+    snapshot = registry.snapshot()
+    assert snapshot["counters"] == {("runs", (("status", "ok"),)): 3}
+    assert snapshot["gauges"] == {
+        ("depth", ()): 5,
+        ("queue_depth", (("queue", "rtm"),)): 3,
+    }
+
+
+def test_histogram_buckets():
+    registry = metrics.Registry()
+    for value in (0.001, 0.005, 0.3, 100):
+        registry.observe("latency", value, method="chat.delete")
+    histogram = registry.snapshot()["histograms"][
+        "latency", (("method", "chat.delete"),)
+    ]
+    # every value in the first bucket it fits, 100 is only in +Inf
+    assert histogram[0] == 2
+    assert histogram[metrics.DEFAULT_BUCKETS.index(0.5)] == 1
+    assert histogram[len(metrics.DEFAULT_BUCKETS)] == 1
+    assert histogram[-2:] == [100.306, 4]
+
+
+def test_timer_labels_can_be_changed():
+    registry = metrics.Registry()
+    with registry.timer("request", status="error") as labels:
+        labels["status"] = 200
+    assert ("request", (("status", "200"),)) in registry.snapshot()["histograms"]
+
+
+def test_failing_collector_is_skipped():
+    registry = metrics.Registry()
+    registry.add_collector(lambda: 1 / 0)
+    registry.add_collector(lambda: [("ok", 1, {})])
+    assert registry.snapshot()["gauges"] == {("ok", ()): 1}
+
+
+def test_remove():
+    registry = metrics.Registry()
+    registry.gauge("lag", 1, crontab=1)
+    registry.gauge("lag", 2, crontab=2)
+    registry.remove("lag", crontab=1)
+    registry.remove("lag", crontab=3)
+    assert registry.snapshot()["gauges"] == {("lag", (("crontab", "2"),)): 2}
+
+
+def test_stats_gauges():
+    stats = {"depth": 1, "dropped": {"important": 2}, "max_items": None, "x": "y"}
+    assert list(metrics.stats_gauges("queue_", stats)) == [
+        ("queue_depth", 1, {}),
+        ("queue_dropped", 2, {"kind": "important"}),
+    ]
+
+
+def test_counting_executor():
+    executor = metrics.CountingExecutor(max_workers=1)
+    release = threading.Event()
+    running = executor.submit(release.wait)
+    waiting = executor.submit(sum, [1, 2])
+    # the first call has to start before its numbers are checked
+    while executor.started == 0:
+        time.sleep(0.001)
+    gauges = list(metrics.executor_gauges("bot", executor))
+    assert ("executor_queue_depth", 1, {"executor": "bot"}) in gauges
+    assert ("executor_running", 1, {"executor": "bot"}) in gauges
+
+    release.set()
+    assert running.result(timeout=1) is True
+    assert waiting.result(timeout=1) == 3
+    executor.shutdown()
+    assert executor.stats() == {"queue_depth": 0, "running": 0, "finished": 2}
+
+
+def test_render():
+    registry = metrics.Registry()
+    registry.inc("runs", status="ok")
+    registry.gauge("depth", 2)
+    registry.observe("latency", 0.2)
+    text = metrics.render({"mule1": registry.snapshot()})
+    lines = text.splitlines()
+    assert "# TYPE slackbot_runs_total counter" in lines
+    assert 'slackbot_runs_total{process="mule1",status="ok"} 1' in lines
+    assert 'slackbot_depth{process="mule1"} 2' in lines
+    assert "# TYPE slackbot_latency histogram" in lines
+    assert 'slackbot_latency_bucket{process="mule1",le="0.1"} 0' in lines
+    assert 'slackbot_latency_bucket{process="mule1",le="0.25"} 1' in lines
+    assert 'slackbot_latency_bucket{process="mule1",le="+Inf"} 1' in lines
+    assert 'slackbot_latency_count{process="mule1"} 1' in lines
+
+
+def test_render_escapes_label_values():
+    registry = metrics.Registry()
+    registry.inc("events", type='say "hi"\n')
+    text = metrics.render({"worker1": registry.snapshot()})
+    assert r'type="say \"hi\"\n"' in text
@@ -0,0 +1,257 @@
+import asyncio
+import datetime as dt
+import metrics
+import scheduler
+
+START = dt.datetime(2019, 1, 30, 9, 0, tzinfo=dt.timezone.utc)
+
+
+class FakeCrontab:
+    def __init__(self, first_run, every_minutes):
+        self.next = first_run
+        self._every = dt.timedelta(minutes=every_minutes)
+
+    def calc_next(self):
+        self.next += self._every
+
+
+def make_scheduler():
+    return scheduler.Scheduler(asyncio.new_event_loop())
+
+
+def test_nothing_due_before_next_run():
+    s = make_scheduler()
+    s.add(FakeCrontab(START, 5), "job")
+    assert s.pop_due(START - dt.timedelta(seconds=1)) == []
+    assert s.next_run() == START
+
+
+def test_pop_due_in_next_run_order():
+    s = make_scheduler()
+    s.add(FakeCrontab(START + dt.timedelta(minutes=2), 60), "later")
+    s.add(FakeCrontab(START, 60), "first")
+    s.add(FakeCrontab(START + dt.timedelta(minutes=3), 60), "not yet")
+    assert s.pop_due(START + dt.timedelta(minutes=2)) == ["first", "later"]
+    assert s.next_run() == START + dt.timedelta(minutes=3)
+
+
+def test_same_time_jobs_are_all_dispatched():
+    s = make_scheduler()
+    for n in range(100):
+        s.add(FakeCrontab(START, 60), n)
+    assert s.pop_due(START) == list(range(100))
+    assert len(s) == 100
+    assert s.next_run() == START + dt.timedelta(minutes=60)
+
+
+def test_late_wakeup_catches_up_only_once():
+    s = make_scheduler()
+    crontab = FakeCrontab(START, 1)
+    s.add(crontab, "job")
+    late = START + dt.timedelta(minutes=10, seconds=30)
+    assert s.pop_due(late) == ["job"]
+    assert crontab.next == START + dt.timedelta(minutes=11)
+    assert s.pop_due(late) == []
+
+
+def test_clear():
+    s = make_scheduler()
+    s.add(FakeCrontab(START, 1), "job")
+    s.clear()
+    assert len(s) == 0
+    assert s.next_run() is None
+
+
+def test_remove_by_key():
+    s = make_scheduler()
+    s.add(FakeCrontab(START, 1), "removed", key=1)
+    s.add(FakeCrontab(START + dt.timedelta(minutes=1), 1), "kept", key=2)
+    s.remove(1)
+    s.remove("not there")
+    assert len(s) == 1 and 1 not in s and 2 in s
+    assert s.next_run() == START + dt.timedelta(minutes=1)
+    assert s.pop_due(START + dt.timedelta(minutes=1)) == ["kept"]
+
+
+def test_add_with_same_key_replaces_job():
+    s = make_scheduler()
+    s.add(FakeCrontab(START, 1), "old", key=1)
+    s.add(FakeCrontab(START + dt.timedelta(minutes=5), 1), "new", key=1)
+    assert len(s) == 1
+    assert s.pop_due(START + dt.timedelta(minutes=1)) == []
+    assert s.pop_due(START + dt.timedelta(minutes=5)) == ["new"]
+
+
+def test_replaced_jobs_dont_pile_up_in_heap():
+    s = make_scheduler()
+    s.add(FakeCrontab(START, 1), "other", key="other")
+    for n in range(1000):
+        s.add(FakeCrontab(START + dt.timedelta(days=1), 1), n, key="edited")
+    assert len(s) == 2
+    assert len(s._heap) <= 4
+
+
+class TestReloadQueue:
+    def test_keeps_last_action_per_key(self):
+        reloads = scheduler.ReloadQueue()
+        assert not reloads
+        reloads.push(scheduler.ReloadAction.SAVED, 1)
+        reloads.push(scheduler.ReloadAction.SAVED, 2)
+        reloads.push(scheduler.ReloadAction.SAVED, 1)
+        reloads.push(scheduler.ReloadAction.DELETED, 2)
+        assert reloads
+        assert reloads.pop_all() == (
+            False,
+            {1: scheduler.ReloadAction.SAVED, 2: scheduler.ReloadAction.DELETED},
+        )
+        assert not reloads
+        assert reloads.pop_all() == (False, {})
+
+    def test_config_change_reloads_everything(self):
+        reloads = scheduler.ReloadQueue()
+        reloads.push(scheduler.ReloadAction.SAVED, 1)
+        reloads.push(scheduler.ReloadAction.CONFIG_CHANGED)
+        reloads.push(scheduler.ReloadAction.DELETED, 2)
+        assert reloads.pop_all() == (True, {})
+
+
+class TestWait:
+    def test_wait_returns_when_due(self):
+        loop = asyncio.new_event_loop()
+        s = scheduler.Scheduler(loop)
+        s.add(FakeCrontab(START, 1), "job")
+        now = START - dt.timedelta(seconds=0.01)
+        loop.run_until_complete(asyncio.wait_for(s.wait(now), 1))
+        loop.close()
+
+    def test_wakeup_interrupts_wait(self):
+        loop = asyncio.new_event_loop()
+        s = scheduler.Scheduler(loop)
+        loop.call_later(0.01, s.wakeup)
+        loop.run_until_complete(asyncio.wait_for(s.wait(), 1))
+        loop.close()
+
+
+def test_shard_is_stable():
+    # crc32 doesn't depend on PYTHONHASHSEED, every process agrees on the owner
+    assert [scheduler.shard(pk, 3) for pk in range(5)] == [2, 2, 1, 1, 1]
+    assert scheduler.shard(42, 4) == scheduler.shard("42", 4)
+
+
+def test_shard_spreads_keys():
+    shards = [scheduler.shard(pk, 4) for pk in range(1, 1001)]
+    assert set(shards) == {0, 1, 2, 3}
+    assert all(200 < shards.count(n) < 300 for n in range(4))
+
+
+def test_single_shard_owns_everything():
+    assert {scheduler.shard(pk, 1) for pk in range(100)} == {0}
+
+
+def test_pop_due_runs_have_key_and_scheduled_time():
+    s = make_scheduler()
+    s.add(FakeCrontab(START, 60), "job", key=7)
+    runs = s.pop_due_runs(START + dt.timedelta(seconds=30))
+    assert runs == [scheduler.DueRun(7, "job", START)]
+
+
+def test_spread_offset():
+    assert scheduler.spread_offset(1, 0) == 0
+    offsets = [scheduler.spread_offset(pk, 60) for pk in range(1000)]
+    assert offsets == [scheduler.spread_offset(pk, 60) for pk in range(1000)]
+    assert all(0 <= offset < 60 for offset in offsets)
+    # spread over the whole window, not clumped together
+    assert len({int(offset) for offset in offsets}) == 60
+
+
+class FakeJob:
+    def __init__(self, tracker):
+        self._tracker = tracker
+
+    async def run(self):
+        self._tracker.append(1)
+        self._tracker.max = max(self._tracker.max, len(self._tracker))
+        await asyncio.sleep(0.01)
+        self._tracker.pop()
+
+
+class Tracker(list):
+    max = 0
+
+
+class TestDispatcher:
+    def test_limits_concurrent_jobs(self):
+        loop = asyncio.new_event_loop()
+        tracker = Tracker()
+
+        async def dispatch_all():
+            dispatcher = scheduler.Dispatcher(loop, max_concurrent=3)
+            now = scheduler.utcnow()
+            tasks = [
+                dispatcher.dispatch(scheduler.DueRun(n, FakeJob(tracker), now))
+                for n in range(10)
+            ]
+            await asyncio.gather(*tasks)
+            return dispatcher.stats()
+
+        stats = loop.run_until_complete(dispatch_all())
+        loop.close()
+        assert tracker.max == 3
+        assert stats["dispatched"] == 10
+        assert stats["waiting"] == stats["running"] == 0
+        # the last ones had to wait for two rounds of jobs before them
+        assert stats["max_lag"] >= 0.02
+
+    def test_spreads_start_times(self):
+        loop = asyncio.new_event_loop()
+        started = {}
+
+        class Job:
+            def __init__(self, key):
+                self.key = key
+
+            async def run(self):
+                started[self.key] = scheduler.utcnow()
+
+        async def dispatch_all(now):
+            dispatcher = scheduler.Dispatcher(loop, spread_seconds=1)
+            await asyncio.gather(
+                *(dispatcher.dispatch(scheduler.DueRun(k, Job(k), now)) for k in (1, 2))
+            )
+
+        now = scheduler.utcnow()
+        loop.run_until_complete(dispatch_all(now))
+        loop.close()
+        for key in (1, 2):
+            expected = now + dt.timedelta(seconds=scheduler.spread_offset(key, 1))
+            assert started[key] >= expected
+            assert started[key] - expected < dt.timedelta(seconds=0.1)
+
+    def test_removed_job_metrics_disappear(self):
+        loop = asyncio.new_event_loop()
+
+        async def dispatch_all():
+            dispatcher = scheduler.Dispatcher(loop)
+            now = scheduler.utcnow()
+            await asyncio.gather(
+                *(
+                    dispatcher.dispatch(scheduler.DueRun(n, FakeJob(Tracker()), now))
+                    for n in ("removed", "kept")
+                )
+            )
+
+        def crontab_labels():
+            gauges = metrics.registry.snapshot()["gauges"]
+            return {
+                name: {dict(labels)["crontab"] for n, labels in gauges if n == name}
+                & {"removed", "kept"}
+                for name in scheduler.JOB_GAUGES
+            }
+
+        loop.run_until_complete(dispatch_all())
+        loop.close()
+        assert crontab_labels() == {
+            name: {"removed", "kept"} for name in scheduler.JOB_GAUGES
+        }
+        scheduler.remove_job_metrics("removed")
+        assert crontab_labels() == {name: {"kept"} for name in scheduler.JOB_GAUGES}
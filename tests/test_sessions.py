@@ -0,0 +1,24 @@
+import asyncio
+import sessions
+
+
+def test_connection_stats(monkeypatch):
+    monkeypatch.setattr(sessions, "stats", sessions.collections.Counter())
+    trace_config = sessions.make_trace_config()
+    loop = asyncio.new_event_loop()
+    for callback in trace_config.on_connection_create_end:
+        loop.run_until_complete(callback(None, None, None))
+    for _ in range(3):
+        for callback in trace_config.on_connection_reuseconn:
+            loop.run_until_complete(callback(None, None, None))
+    loop.close()
+    assert sessions.connection_stats() == {
+        "connections_created": 1,
+        "connections_reused": 3,
+        "reuse_ratio": 0.75,
+    }
+
+
+def test_no_connections_yet(monkeypatch):
+    monkeypatch.setattr(sessions, "stats", sessions.collections.Counter())
+    assert sessions.connection_stats() == {"reuse_ratio": 0}
@@ -1,4 +1,7 @@
+import json
+import asyncio
 import pytest
+import aiohttp
 import slack
 
 
@@ -18,3 +21,388 @@ import slack
 )
 def test_parse_links(url, expected):
     assert slack.parse_links(url) == expected
+
+
+class FakeResponse:
+    def __init__(self, status, json_res, headers):
+        self.status = status
+        self.method = "POST"
+        self.headers = headers
+        self._json_res = json_res
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def json(self):
+        return self._json_res
+
+    async def text(self):
+        return json.dumps(self._json_res)
+
+
+class FakeSession:
+    def __init__(self, responses=None):
+        self.posted = []
+        self.requested = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # {(method, ts): [(status, json_res, headers), ...]}, the last one is repeated
+        # for GET requests, the cursor is used instead of ts
+        self._responses = responses or {}
+
+    def get(self, url, params=None, headers=None):
+        method = url.rsplit("/", 1)[1]
+        self.requested.append((method, params))
+        status, json_res, headers = self._responses[(method, params.get("cursor"))][0]
+        return FakeResponse(status, json_res, headers)
+
+    def post(self, url, headers=None, json=None):
+        method = url.rsplit("/", 1)[1]
+        self.posted.append((method, json))
+        responses = self._responses.get((method, json.get("ts")))
+        if not responses:
+            responses = [(200, {"ok": True, "ts": json.get("ts")}, {})]
+        if len(responses) > 1:
+            status, json_res, headers = responses.pop(0)
+        else:
+            status, json_res, headers = responses[0]
+        session = self
+
+        class Response(FakeResponse):
+            async def __aenter__(self):
+                session.in_flight += 1
+                session.max_in_flight = max(session.max_in_flight, session.in_flight)
+                await asyncio.sleep(0.01)
+                session.in_flight -= 1
+                return self
+
+        return Response(status, json_res, headers)
+
+
+RATE_LIMITED = (429, {"ok": False, "error": "ratelimited"}, {"Retry-After": "0"})
+
+
+def make_api(session):
+    # so the tests don't have to wait for the real rate limits
+    rate_limiter = slack.RateLimiter(
+        method_limits={}, default_limit=60000, channel_limits={}
+    )
+    return slack.AsyncApi("xoxb-token", session, rate_limiter)
+
+
+class TestDeleteMessages:
+    def test_results_are_in_order(self):
+        not_found = (200, {"ok": False, "error": "message_not_found"}, {})
+        session = FakeSession({("chat.delete", "2"): [not_found]})
+        api = make_api(session)
+        messages = [("C1", "1"), ("C1", "2"), ("C2", "3")]
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(api.delete_messages(messages))
+        loop.close()
+        assert [r["ok"] for r in results] == [True, False, True]
+        assert [r.get("ts") for r in results] == ["1", None, "3"]
+
+    def test_failed_request_is_isolated(self):
+        session = FakeSession({("chat.delete", "2"): [(500, {}, {})]})
+        api = make_api(session)
+        messages = [("C1", "1"), ("C1", "2"), ("C1", "3")]
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(api.delete_messages(messages))
+        loop.close()
+        assert isinstance(results[1], slack.ApiError)
+        assert results[0]["ok"] and results[2]["ok"]
+
+    def test_concurrency_is_limited(self):
+        session = FakeSession()
+        api = make_api(session)
+        messages = [("C1", str(ts)) for ts in range(10)]
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(api.delete_messages(messages, max_concurrent=2))
+        loop.close()
+        assert len(session.posted) == 10
+        assert session.max_in_flight == 2
+
+
+class TestTokenBucket:
+    def test_burst_then_one_per_interval(self):
+        bucket = slack._TokenBucket(per_minute=60, burst=3)
+        waits = [bucket.reserve(100.0) for _ in range(5)]
+        assert waits == [0, 0, 0, 1, 2]
+
+    def test_refills_over_time(self):
+        bucket = slack._TokenBucket(per_minute=60, burst=2)
+        assert bucket.reserve(100.0) == 0
+        assert bucket.reserve(100.0) == 0
+        assert bucket.reserve(100.0) == 1
+        assert bucket.reserve(110.0) == 0
+        assert bucket.reserve(110.0) == 0
+
+    def test_block(self):
+        bucket = slack._TokenBucket(per_minute=60, burst=5)
+        bucket.block(130.0)
+        assert bucket.reserve(100.0) == 30
+
+
+class TestRateLimiting:
+    def test_retry_after_429(self):
+        ok = (200, {"ok": True, "ts": "1"}, {})
+        session = FakeSession({("chat.delete", "1"): [RATE_LIMITED, RATE_LIMITED, ok]})
+        api = make_api(session)
+        loop = asyncio.new_event_loop()
+        res = loop.run_until_complete(api.delete_message("C1", "1"))
+        loop.close()
+        assert res["ok"]
+        assert len(session.posted) == 3
+        stats = api.rate_limit_stats()["chat.delete"]
+        assert stats["calls"] == 3
+        assert stats["rate_limited"] == 2
+        assert stats["queued"] == 0
+
+    def test_gives_up_after_max_retries(self):
+        session = FakeSession({("chat.delete", "1"): [RATE_LIMITED]})
+        api = make_api(session)
+        loop = asyncio.new_event_loop()
+        with pytest.raises(slack.ApiError):
+            loop.run_until_complete(api.delete_message("C1", "1"))
+        loop.close()
+        assert len(session.posted) == slack.MAX_RATE_LIMITED_RETRIES + 1
+
+    def test_requests_wait_for_their_turn(self):
+        session = FakeSession()
+        rate_limiter = slack.RateLimiter(method_limits={"chat.delete": 600})
+        api = slack.AsyncApi("xoxb-token", session, rate_limiter)
+        messages = [("C1", str(ts)) for ts in range(63)]
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(api.delete_messages(messages, max_concurrent=100))
+        loop.close()
+        stats = api.rate_limit_stats()["chat.delete"]
+        # 60 goes out at once, then one in every 0.1 seconds
+        assert stats["max_wait"] == pytest.approx(0.3, abs=0.05)
+
+    def test_channels_dont_wait_for_each_other(self):
+        session = FakeSession()
+        rate_limiter = slack.RateLimiter(channel_limits={"chat.postMessage": 600})
+        api = slack.AsyncApi("xoxb-token", session, rate_limiter)
+
+        async def post_messages():
+            await asyncio.gather(
+                *(
+                    api.post_message(channel_id, str(n), [])
+                    for n in range(61)
+                    for channel_id in ("C1", "C2")
+                )
+            )
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(post_messages())
+        loop.close()
+        stats = api.rate_limit_stats()["chat.postMessage"]
+        assert stats["calls"] == 122
+        # 60 goes out at once in both channels, then one more 0.1 seconds later
+        assert stats["max_wait"] == pytest.approx(0.1, abs=0.05)
+
+    def test_retry_after_blocks_only_the_channel(self):
+        rate_limiter = slack.RateLimiter(channel_limits={"chat.postMessage": 600})
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(rate_limiter.acquire("chat.postMessage", "C1"))
+        loop.close()
+        rate_limiter.retry_after("chat.postMessage", 30, "C1")
+        assert rate_limiter._reserve("chat.postMessage", "C1")[0] > 29
+        assert rate_limiter._reserve("chat.postMessage", "C2")[0] == 0
+
+
+@pytest.mark.parametrize(
+    "data, expected",
+    (
+        ('{"type": "user_typing", "channel": "C1"}', "user_typing"),
+        ('{"type":"message","text":"{\\"type\\": \\"x\\"}"}', "message"),
+        (' {\n  "type" : "presence_change"}', "presence_change"),
+        ('{"channel": "C1", "type": "message"}', None),
+        ('{"ok": true, "reply_to": 1}', None),
+    ),
+)
+def test_peek_event_type(data, expected):
+    assert slack.peek_event_type(data) == expected
+
+
+class FakeWebSocket:
+    def __init__(self, events):
+        self._frames = [
+            aiohttp.WSMessage(aiohttp.WSMsgType.TEXT, json.dumps(e), None)
+            for e in events
+        ]
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._frames:
+            raise StopAsyncIteration
+        return self._frames.pop(0)
+
+    async def close(self):
+        self.closed = True
+
+
+class TestRealtimeApi:
+    def _receive(self, events, event_types):
+        ws = FakeWebSocket(events)
+        rtm = slack._RealtimeApi("UBOT", ws)
+
+        async def receive():
+            return [msg async for msg in rtm.wait_messages(event_types)]
+
+        loop = asyncio.new_event_loop()
+        messages = loop.run_until_complete(receive())
+        loop.close()
+        return rtm, ws, messages
+
+    def test_skips_other_event_types(self):
+        events = [
+            {"type": "user_typing", "channel": "C1"},
+            {"type": "message", "text": "hi"},
+            {"ok": True, "reply_to": 1},
+            {"type": "user_typing", "channel": "C2"},
+            {"type": "presence_change", "user": "U1"},
+        ]
+        rtm, _, messages = self._receive(events, {"message"})
+        assert messages == [
+            {"type": "message", "text": "hi"},
+            {"ok": True, "reply_to": 1},
+        ]
+        assert rtm.skipped_events == {"user_typing": 2, "presence_change": 1}
+
+    def test_yields_everything_without_event_types(self):
+        events = [{"type": "user_typing"}, {"type": "message"}]
+        rtm, _, messages = self._receive(events, None)
+        assert messages == events
+        assert not rtm.skipped_events
+
+    def test_goodbye_is_never_skipped(self):
+        events = [{"type": "goodbye"}, {"type": "message"}]
+        _, ws, messages = self._receive(events, {"message"})
+        assert messages == []
+        assert ws.closed
+
+
+class TestVerifySignature:
+    SECRET = "8f742231b10e8888abcd99yyyzzz85a5"
+    TIMESTAMP = "1531420618"
+    BODY = (
+        b"token=xyzz0WbapA4vBCDEFasx0q6G&team_id=T1DC2JH3J&team_domain=testteamnow"
+        b"&channel_id=G8PSS9T3V&channel_name=foobar&user_id=U2CERLKJA"
+        b"&user_name=roadrunner&command=%2Fwebhook-collect&text="
+        b"&response_url=https%3A%2F%2Fhooks.slack.com%2Fcommands%2FT1DC2JH3J"
+        b"%2F397700885554%2F96rGlfmibIGlgcZRskXaIFfN"
+        b"&trigger_id=398738663015.47445629121.803a0bc887a14d10d2c447fce8b6703c"
+    )
+    # the example from https://api.slack.com/docs/verifying-requests-from-slack
+    SIGNATURE = "v0=a2114d57b48eac39b9ad189dd8316235a7b4a8d21a10bd27519666489c69b503"
+    NOW = 1531420618 + 10
+
+    def test_valid(self):
+        assert slack.verify_signature(
+            self.SECRET, self.TIMESTAMP, self.BODY, self.SIGNATURE, self.NOW
+        )
+
+    def test_tampered_body(self):
+        body = self.BODY.replace(b"roadrunner", b"coyote")
+        assert not slack.verify_signature(
+            self.SECRET, self.TIMESTAMP, body, self.SIGNATURE, self.NOW
+        )
+
+    def test_old_request(self):
+        now = self.NOW + slack.MAX_SIGNATURE_AGE
+        assert not slack.verify_signature(
+            self.SECRET, self.TIMESTAMP, self.BODY, self.SIGNATURE, now
+        )
+
+    @pytest.mark.parametrize(
+        "secret, timestamp, signature",
+        (("", TIMESTAMP, SIGNATURE), (SECRET, None, SIGNATURE), (SECRET, "x", "v0=")),
+    )
+    def test_missing_values(self, secret, timestamp, signature):
+        assert not slack.verify_signature(
+            secret, timestamp, self.BODY, signature, self.NOW
+        )
+
+
+def test_events_api_replies_in_thread():
+    session = FakeSession()
+    events_api = slack._EventsApi("UBOT", make_api(session))
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(events_api.reply_in_thread("C1", "1.5", "hello"))
+    loop.close()
+    assert events_api.bot_mention == "<@UBOT>"
+    method, payload = session.posted[0]
+    assert method == "chat.postMessage"
+    assert payload["thread_ts"] == "1.5"
+    assert payload["text"] == "hello"
+
+
+class TestListChannelsPage:
+    def _list(self, session, cursor=None):
+        loop = asyncio.new_event_loop()
+        res = loop.run_until_complete(make_api(session).list_channels_page(cursor))
+        loop.close()
+        return res
+
+    def test_pages(self):
+        first = {
+            "ok": True,
+            "channels": [{"id": "C1", "name": "general"}],
+            "response_metadata": {"next_cursor": "abc"},
+        }
+        last = {
+            "ok": True,
+            "channels": [{"id": "C2", "name": "random"}],
+            "response_metadata": {"next_cursor": ""},
+        }
+        session = FakeSession(
+            {
+                ("conversations.list", None): [(200, first, {})],
+                ("conversations.list", "abc"): [(200, last, {})],
+            }
+        )
+        assert self._list(session) == ([{"id": "C1", "name": "general"}], "abc")
+        assert self._list(session, "abc") == ([{"id": "C2", "name": "random"}], None)
+
+    def test_error(self):
+        error = {"ok": False, "error": "invalid_auth"}
+        session = FakeSession({("conversations.list", None): [(200, error, {})]})
+        assert self._list(session) is None
+
+
+class TestSyncApi:
+    def test_calls_run_on_the_background_loop(self):
+        api = slack.Api("xoxb-token")
+        background_loop = slack.get_background_loop()
+        # every instance shares the loop and the session
+        assert slack.Api("xoxb-other")._api._session is api._api._session
+        assert api.rate_limit_stats() == {}
+
+        async def loop_of_call():
+            return asyncio.get_event_loop()
+
+        assert background_loop.run(loop_of_call()) is background_loop.loop
+
+    def test_cant_wait_in_the_loop_thread(self):
+        background_loop = slack.get_background_loop()
+
+        async def wait_for_itself():
+            return background_loop.run(asyncio.sleep(0))
+
+        with pytest.raises(RuntimeError):
+            background_loop.submit(wait_for_itself()).result(timeout=1)
+
+    def test_start_errors_are_raised(self):
+        class BrokenLoop(slack.BackgroundLoop):
+            async def _make_session(self):
+                raise OSError("no session")
+
+        with pytest.raises(OSError, match="no session"):
+            BrokenLoop()
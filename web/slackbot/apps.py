@@ -1,5 +1,7 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 from django.db.models.signals import post_save, post_delete
+from constance.signals import config_updated
 
 try:
     import uwsgi
@@ -8,17 +10,73 @@ try:
 except ImportError:
     is_uwsgi_running = False
 
+# milliseconds to wait for the other processes to finish writing
+SQLITE_BUSY_TIMEOUT = 20000
 
-def reload_mule(sender, **kwargs):
-    from bot import MuleMessage
 
-    uwsgi.mule_msg(MuleMessage.RELOAD)
+def setup_sqlite(sender, connection, **kwargs):
+    """The web workers and the mules write the same database file. In WAL mode
+    the readers don't block the writer and it doesn't block them either.
+    """
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # safe in WAL mode, only the last commits can be lost on power failure
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+
+
+def reload_saved_crontab(sender, instance, **kwargs):
+    import bot
+
+    bot.send_reload(instance.pk, bot.ReloadAction.SAVED)
+
+
+def reload_deleted_crontab(sender, instance, **kwargs):
+    import bot
+
+    bot.send_reload(instance.pk, bot.ReloadAction.DELETED)
+
+
+def reload_config(sender, key, **kwargs):
+    import bot
+
+    bot.send_reload_all()
+
+
+def collect_process_metrics():
+    """Stats kept by the modules used in every process, see metrics.py"""
+    from django.core.cache import caches
+    import metrics
+    import sessions
+    import slack
+    from . import channels
+
+    yield from metrics.stats_gauges("channel_lookups_", channels.stats)
+    yield from metrics.stats_gauges("http_", sessions.connection_stats())
+    for name in ("default", "gerrit"):
+        cache = caches[name]
+        # the LocMemCache fallback outside of uWSGI has no stats
+        if hasattr(cache, "stats"):
+            for key, value, labels in metrics.stats_gauges("cache_", cache.stats()):
+                yield key, value, dict(labels, cache=name)
+    # only the bot token is used, reading it from the config would query the database
+    for rate_limiter in slack.rate_limiters():
+        for method, stats in rate_limiter.stats().items():
+            for key, value, labels in metrics.stats_gauges("slack_rate_limit_", stats):
+                yield key, value, dict(labels, method=method)
 
 
 class SlackbotConfig(AppConfig):
     name = "slackbot"
 
     def ready(self):
+        import metrics
+
+        connection_created.connect(setup_sqlite)
+        metrics.add_collector(collect_process_metrics)
         if is_uwsgi_running:
-            post_save.connect(reload_mule, sender="slackbot.Crontab")
-            post_delete.connect(reload_mule, sender="slackbot.Crontab")
+            post_save.connect(reload_saved_crontab, sender="slackbot.Crontab")
+            post_delete.connect(reload_deleted_crontab, sender="slackbot.Crontab")
+            config_updated.connect(reload_config)
@@ -1,18 +1,93 @@
+import time
+import hashlib
+import threading
+import collections
 from django.core.cache import cache
 from constance import config
 import slack
 
 
-def cache_channels():
-    slack_api = slack.Api(config.BOT_ACCESS_TOKEN)
-    all_channels = slack_api.list_all_channels()
-    cache.set_many({c["name"]: c for c in all_channels})
+# Channels are rarely renamed, but a missing one can be created any time
+CHANNEL_TIMEOUT = 24 * 60 * 60
+NOT_FOUND_TIMEOUT = 60
+# cached for names which are not channels
+NOT_FOUND = ""
+REFRESH_LOCK_KEY = "channels:refreshing"
+REFRESH_LOCK_TIMEOUT = 60
+
+# hits, not_found_hits, misses, refreshes, pages in this process
+stats = collections.Counter()
+_refresh_lock = threading.Lock()
+
+
+def _channel_key(channel_name):
+    # channel names can be 80 characters long, keys have to fit key_size in uwsgi.ini
+    return "channel:" + hashlib.sha1(channel_name.encode()).hexdigest()
+
+
+def _get_cached(channel_name):
+    channel_id = cache.get(_channel_key(channel_name))
+    if channel_id == NOT_FOUND:
+        stats["not_found_hits"] += 1
+    elif channel_id is not None:
+        stats["hits"] += 1
+    return channel_id
 
 
 def get_channel_id(channel_name):
     channel_name = channel_name.lstrip("#")
-    if cache.get(channel_name) is None:
-        cache_channels()
-    channel = cache.get(channel_name)
-    print("Got channel from cache", channel)
-    return channel["id"] if channel is not None else None
+    channel_id = _get_cached(channel_name)
+    if channel_id is None:
+        stats["misses"] += 1
+        channel_id = refresh_channels(channel_name)
+    print("Got channel from cache", channel_name, channel_id, dict(stats))
+    return channel_id or None
+
+
+def refresh_channels(channel_name):
+    """Download the channels page by page until channel_name is found.
+    Only one refresh runs at a time, the others wait for it, then check the cache.
+    """
+    with _refresh_lock:
+        deadline = time.monotonic() + REFRESH_LOCK_TIMEOUT
+        # the lock is in the cache, so the other uWSGI processes respect it too
+        while True:
+            locked = cache.add(REFRESH_LOCK_KEY, True, REFRESH_LOCK_TIMEOUT)
+            if locked or time.monotonic() > deadline:
+                break
+            time.sleep(0.2)
+
+        try:
+            # it might have been found by the refresh we were waiting for
+            channel_id = _get_cached(channel_name)
+            if channel_id is not None:
+                return channel_id
+            return _find_channel(channel_name)
+        finally:
+            # after the timeout, the lock might be held by another refresh
+            if locked:
+                cache.delete(REFRESH_LOCK_KEY)
+
+
+def _find_channel(channel_name):
+    stats["refreshes"] += 1
+    slack_api = slack.Api(config.BOT_ACCESS_TOKEN)
+    cursor = None
+    while True:
+        res = slack_api.list_channels_page(cursor)
+        if res is None:
+            # Slack error, don't remember it as missing
+            return None
+        channels, cursor = res
+        stats["pages"] += 1
+        cache.set_many(
+            {_channel_key(c["name"]): c["id"] for c in channels}, CHANNEL_TIMEOUT
+        )
+        for channel in channels:
+            if channel["name"] == channel_name:
+                return channel["id"]
+        if cursor is None:
+            break
+
+    cache.set(_channel_key(channel_name), NOT_FOUND, NOT_FOUND_TIMEOUT)
+    return NOT_FOUND
@@ -18,7 +18,13 @@ class CrontabFieldMixin:
 class CrontabCreateForm(CrontabFieldMixin, forms.ModelForm):
     class Meta:
         model = m.Crontab
-        fields = ("channel_name", "channel_id", "gerrit_query", "crontab")
+        fields = (
+            "channel_name",
+            "channel_id",
+            "gerrit_query",
+            "crontab",
+            "update_in_place",
+        )
 
     def clean(self):
         cleaned_data = super().clean()
@@ -68,4 +74,4 @@ class CrontabCreateForm(CrontabFieldMixin, forms.ModelForm):
 class CrontabEditForm(CrontabFieldMixin, forms.ModelForm):
     class Meta:
         model = m.Crontab
-        fields = ("gerrit_query", "crontab")
+        fields = ("gerrit_query", "crontab", "update_in_place")
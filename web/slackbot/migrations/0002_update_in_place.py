@@ -0,0 +1,23 @@
+# Generated by Django 2.1.5 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slackbot', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crontab',
+            name='update_in_place',
+            field=models.BooleanField(default=False, help_text='Update the previous message instead of deleting it and posting a new one to the bottom of the channel'),
+        ),
+        migrations.AddField(
+            model_name='sentmessage',
+            name='kind',
+            field=models.CharField(blank=True, choices=[('crontab', 'Changes for the crontab query'), ('review_requests', 'Changes for review requests')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.1.5 on 2026-10-18 15:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slackbot', '0002_update_in_place'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='crontab',
+            name='channel_id',
+            field=models.CharField(db_index=True, help_text='Slack internal channel ID, will be automatically set based on channel_name', max_length=30),
+        ),
+        migrations.AlterField(
+            model_name='reviewrequest',
+            name='channel_id',
+            field=models.CharField(db_index=True, help_text='The channel where this requests is sent to originally', max_length=30),
+        ),
+        migrations.AlterField(
+            model_name='reviewrequest',
+            name='gerrit_query',
+            field=models.CharField(blank=True, db_index=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='sentmessage',
+            name='channel_id',
+            field=models.CharField(db_index=True, max_length=30),
+        ),
+    ]
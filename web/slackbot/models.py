@@ -1,4 +1,6 @@
 import datetime as dt
+import copy
+import functools
 from django.db import models
 from django.utils import timezone
 from croniter import croniter
@@ -7,10 +9,34 @@ import slack
 import gerrit
 
 
+@functools.lru_cache(maxsize=1024)
+def _expand_cron(method_name, *args, **kwargs):
+    return getattr(croniter, method_name)(*args, **kwargs)
+
+
+def _copy_expanded(method_name, *args, **kwargs):
+    # croniter modifies the parsed fields in place, every instance needs its own copy
+    return copy.deepcopy(_expand_cron(method_name, *args, **kwargs))
+
+
+class CachedCroniter(croniter):
+    """croniter which parses the same cron expression only once per process."""
+
+    @classmethod
+    def expand(cls, *args, **kwargs):
+        return _copy_expanded("expand", *args, **kwargs)
+
+    # newer croniter versions call this directly from __init__
+    @classmethod
+    def _expand(cls, *args, **kwargs):
+        return _copy_expanded("_expand", *args, **kwargs)
+
+
 class Crontab(models.Model):
     channel_name = models.CharField(max_length=100, blank=True)
     channel_id = models.CharField(
         max_length=30,
+        db_index=True,
         help_text="Slack internal channel ID, will be "
         "automatically set based on channel_name",
     )
@@ -19,24 +45,31 @@ class Crontab(models.Model):
         max_length=255,
         help_text='Examples: <a href="https://crontab.guru/" target="_blank">crontab.guru<a>',
     )
+    update_in_place = models.BooleanField(
+        default=False,
+        help_text="Update the previous message instead of deleting it and "
+        "posting a new one to the bottom of the channel",
+    )
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        # This is a new, empty object, there is no crontab value set yet
-        if self.pk is None:
-            self._cron = None
-            self.next = None
-        else:
-            # This way, we will miss this very minute at startup to avoid sending the same message twice
-            self._cron = croniter(self.crontab, start_time=timezone.localtime())
-            self.calc_next()
+    _cron = None
+    _next = None
 
     def __str__(self):
         return f"{self.crontab}: {self.gerrit_query} -> {self.channel_name}"
 
+    @property
+    def next(self):
+        """Calculated on first use, so loading crontabs for the web pages is cheap."""
+        # This is a new, empty object, there is no crontab value set yet
+        if self._next is None and self.pk is not None:
+            # This way, we will miss this very minute at startup to avoid sending the same message twice
+            self._cron = CachedCroniter(self.crontab, start_time=timezone.localtime())
+            self.calc_next()
+        return self._next
+
     def calc_next(self):
         next_dt = self._cron.get_next(dt.datetime)
-        self.next = next_dt.astimezone(dt.timezone.utc)
+        self._next = next_dt.astimezone(dt.timezone.utc)
 
     @property
     def for_review_request_only(self):
@@ -44,7 +77,55 @@ class Crontab(models.Model):
         return not self.gerrit_query
 
 
+def delete_sent_message_rows(sent_messages, results):
+    """Delete the rows of the messages which have been deleted from Slack.
+    results are the responses from slack.AsyncApi.delete_messages.
+    """
+    deleted_pks = []
+    for sent_message, result in zip(sent_messages, results):
+        # Same as SentMessage.delete: if we couldn't reach Slack, we keep the row
+        # and try again later, but if Slack answered, e.g. "message_not_found",
+        # there is no reason to keep it.
+        if isinstance(result, Exception):
+            print(f"Couldn't delete message {sent_message.ts}: {result!r}")
+        else:
+            deleted_pks.append(sent_message.pk)
+    return SentMessage.objects.filter(pk__in=deleted_pks).delete_rows()
+
+
+class SentMessageQuerySet(models.QuerySet):
+    def delete(self):
+        """Delete the messages from Slack too, all at once.
+        Rows of the messages which couldn't be deleted from Slack are kept.
+        """
+        sent_messages = list(self)
+        print(f"Deleting {len(sent_messages)} messages")
+        slack_api = slack.Api(config.BOT_ACCESS_TOKEN)
+        results = slack_api.delete_messages(
+            [(sm.channel_id, sm.ts) for sm in sent_messages]
+        )
+        return delete_sent_message_rows(sent_messages, results)
+
+    # like QuerySet.delete, so SentMessage.objects.delete() can't delete everything
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def delete_rows(self):
+        """Delete from the database only."""
+        return super().delete()
+
+    delete_rows.alters_data = True
+    delete_rows.queryset_only = True
+
+
 class SentMessage(models.Model):
+    CRONTAB = "crontab"
+    REVIEW_REQUESTS = "review_requests"
+    KIND_CHOICES = (
+        (CRONTAB, "Changes for the crontab query"),
+        (REVIEW_REQUESTS, "Changes for review requests"),
+    )
+
     crontab = models.ForeignKey(
         Crontab,
         on_delete=models.SET_NULL,
@@ -53,12 +134,15 @@ class SentMessage(models.Model):
         null=True,
     )
 
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, blank=True)
     ts = models.CharField(max_length=30)
-    channel_id = models.CharField(max_length=30)
+    channel_id = models.CharField(max_length=30, db_index=True)
     message = models.TextField(
         help_text='JSON serialized slack response "message" field to a chat.PostMessage'
     )
 
+    objects = SentMessageQuerySet.as_manager()
+
     def __str__(self):
         return self.ts
 
@@ -95,10 +179,12 @@ class ReviewRequest(models.Model):
         max_length=30, help_text="The Slack user who sent the request"
     )
     channel_id = models.CharField(
-        max_length=30, help_text="The channel where this requests is sent to originally"
+        max_length=30,
+        db_index=True,
+        help_text="The channel where this requests is sent to originally",
     )
     gerrit_url = models.URLField()
-    gerrit_query = models.CharField(max_length=255, blank=True)
+    gerrit_query = models.CharField(max_length=255, blank=True, db_index=True)
 
     def __str__(self):
         return self.gerrit_url
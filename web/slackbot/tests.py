@@ -1,3 +1,1013 @@
-from django.test import TestCase
+import os
+import sys
+import hmac
+import json
+import time
+import asyncio
+import datetime as dt
+import hashlib
+import threading
+import collections
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from croniter import croniter
+from django.urls import reverse
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from constance import config
+from constance.test import override_config
+from loadtest import fake_uwsgi
 
-# Create your tests here.
+# bot.py needs the uwsgi module, which is only available in uWSGI processes
+sys.modules.setdefault("uwsgi", fake_uwsgi)
+# CronJob queries the database in the event loop, newer Django versions refuse it
+os.environ.setdefault("DJANGO_ALLOW_ASYNC_UNSAFE", "true")
+
+import bot  # noqa: E402
+import gerrit  # noqa: E402
+import rtm  # noqa: E402
+import slack  # noqa: E402
+import events  # noqa: E402
+import metrics  # noqa: E402
+import scheduler  # noqa: E402
+from scheduler import ReloadAction  # noqa: E402
+import uwsgicache  # noqa: E402
+from . import channels  # noqa: E402
+from .models import (  # noqa: E402
+    Crontab,
+    SentMessage,
+    ReviewRequest,
+    CachedCroniter,
+)
+
+
+def make_change(number, code_review=None):
+    cr = {} if code_review is None else {"value": code_review}
+    json_change = {
+        "_number": number,
+        "subject": f"Change {number}",
+        "owner": {"username": "someone"},
+        "labels": {"Code-Review": cr, "Verified": {}},
+    }
+    return gerrit.Change("https://review.example.com", json_change)
+
+
+class FakeGerrit:
+    def __init__(self, changes):
+        self.changes = changes
+
+    async def get_changes(self, gerrit_query):
+        return list(self.changes)
+
+    async def get_changes_many(self, gerrit_queries):
+        return [list(self.changes) for _ in gerrit_queries]
+
+
+class FakeSlack:
+    """Answers like Slack, which sends back the colors without "#"."""
+
+    def __init__(self, update_ok=True):
+        self.calls = []
+        self._update_ok = update_ok
+        self._next_ts = 100
+
+    def _message(self, ts, text, attachments):
+        attachments = [dict(a, color=a["color"].lstrip("#")) for a in attachments]
+        return {"ts": ts, "text": text, "attachments": attachments}
+
+    async def post_message(self, channel_id, text, attachments, thread_ts=None):
+        self.calls.append(("post", channel_id))
+        self._next_ts += 1
+        ts = f"{self._next_ts}.000100"
+        message = self._message(ts, text, attachments)
+        return {"ok": True, "channel": channel_id, "ts": ts, "message": message}
+
+    async def update_message(self, channel_id, ts, text, attachments):
+        self.calls.append(("update", ts))
+        if not self._update_ok:
+            return {"ok": False, "error": "message_not_found"}
+        message = self._message(ts, text, attachments)
+        return {"ok": True, "channel": channel_id, "ts": ts, "message": message}
+
+    async def delete_messages(self, messages):
+        self.calls.extend(("delete", ts) for _, ts in messages)
+        return [{"ok": True} for _ in messages]
+
+
+# CronJob uses the database from coroutines, which might get another connection
+# than the test, so it can't run in the transaction of a TestCase
+class CronJobUpdateInPlaceTest(TransactionTestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.crontab = Crontab.objects.create(
+            channel_id="C1",
+            gerrit_query="status:open",
+            crontab="0 9 * * *",
+            update_in_place=True,
+        )
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _run(self, changes, update_ok=True):
+        cronjob = bot.CronJob(
+            "https://review.example.com",
+            "xoxb-token",
+            self.crontab,
+            self.loop,
+            session=None,
+        )
+        cronjob._gerrit = FakeGerrit(changes)
+        cronjob._slack = FakeSlack(update_ok)
+        self.loop.run_until_complete(cronjob.run())
+        return cronjob._slack.calls
+
+    def _sent_messages(self):
+        return list(
+            SentMessage.objects.filter(crontab=self.crontab)
+            .order_by("pk")
+            .values_list("kind", "ts")
+        )
+
+    def test_posts_without_previous_message(self):
+        calls = self._run([make_change(1)])
+        self.assertEqual(calls, [("post", "C1")])
+        self.assertEqual(self._sent_messages(), [(SentMessage.CRONTAB, "101.000100")])
+
+    def test_same_message_is_not_sent_again(self):
+        self._run([make_change(1)])
+        calls = self._run([make_change(1)])
+        self.assertEqual(calls, [])
+        self.assertEqual(self._sent_messages(), [(SentMessage.CRONTAB, "101.000100")])
+
+    def test_changed_message_is_updated(self):
+        self._run([make_change(1)])
+        calls = self._run([make_change(1, code_review=1), make_change(2)])
+        self.assertEqual(calls, [("update", "101.000100")])
+        sent_message = SentMessage.objects.get(crontab=self.crontab)
+        attachments = json.loads(sent_message.message)["attachments"]
+        self.assertEqual(len(attachments), 2)
+
+    def test_failed_update_deletes_and_posts_again(self):
+        self._run([make_change(1)])
+        first_pk = SentMessage.objects.get(crontab=self.crontab).pk
+        calls = self._run([make_change(2)], update_ok=False)
+        self.assertEqual(
+            calls, [("update", "101.000100"), ("delete", "101.000100"), ("post", "C1")]
+        )
+        sent_message = SentMessage.objects.get(crontab=self.crontab)
+        self.assertNotEqual(sent_message.pk, first_pk)
+        self.assertEqual(sent_message.kind, SentMessage.CRONTAB)
+
+    def test_message_without_changes_is_deleted(self):
+        self._run([make_change(1)])
+        calls = self._run([])
+        self.assertEqual(calls, [("delete", "101.000100")])
+        self.assertEqual(self._sent_messages(), [])
+
+    def test_message_is_deleted_when_the_query_is_cleared(self):
+        self._run([make_change(1)])
+        self.crontab.gerrit_query = ""
+        self.crontab.save()
+        calls = self._run([make_change(1)])
+        self.assertEqual(calls, [("delete", "101.000100")])
+        self.assertEqual(self._sent_messages(), [])
+
+    def test_older_messages_of_the_same_kind_are_deleted(self):
+        for ts in ("1.000100", "2.000100"):
+            SentMessage.objects.create(
+                crontab=self.crontab,
+                kind=SentMessage.CRONTAB,
+                ts=ts,
+                channel_id="C1",
+                message=json.dumps({"text": "old", "attachments": []}),
+            )
+        # sent before update_in_place has been turned on
+        SentMessage.objects.create(
+            crontab=self.crontab, ts="3.000100", channel_id="C1", message="{}"
+        )
+        calls = self._run([make_change(1)])
+        self.assertEqual(
+            calls,
+            [("delete", "1.000100"), ("delete", "3.000100"), ("update", "2.000100")],
+        )
+        self.assertEqual(self._sent_messages(), [(SentMessage.CRONTAB, "2.000100")])
+
+
+class CachedCroniterTest(SimpleTestCase):
+    def test_instances_advance_independently(self):
+        expression = "*/20 9-17 * * 1-5"
+        starts = [
+            dt.datetime(2019, 3, 1, 8, 0, tzinfo=dt.timezone.utc),
+            dt.datetime(2019, 3, 2, 12, 30, tzinfo=dt.timezone.utc),
+        ]
+        cached = [CachedCroniter(expression, start_time=start) for start in starts]
+        plain = [croniter(expression, start_time=start) for start in starts]
+        for _ in range(5):
+            # interleaved, so a shared parse result would show up
+            for cached_iter, plain_iter in zip(cached, plain):
+                self.assertEqual(
+                    cached_iter.get_next(dt.datetime), plain_iter.get_next(dt.datetime)
+                )
+        self.assertNotEqual(cached[0].get_current(), cached[1].get_current())
+
+
+class SentMessageManagerTest(SimpleTestCase):
+    def test_delete_is_queryset_only(self):
+        # SentMessage.objects.delete() would delete every message from Slack
+        self.assertFalse(hasattr(SentMessage.objects, "delete"))
+        self.assertFalse(hasattr(SentMessage.objects, "delete_rows"))
+        self.assertTrue(hasattr(SentMessage.objects.all(), "delete_rows"))
+
+
+class IsSameMessageTest(SimpleTestCase):
+    ATTACHMENT = {
+        "color": "#EC1313",
+        "author_name": "CR: :exclamation: V:  someone: Change 1",
+        "author_link": "https://review.example.com/#/c/1",
+    }
+
+    def _sent_message(self, text, attachments):
+        message = json.dumps({"text": text, "attachments": attachments})
+        return SentMessage(message=message)
+
+    def test_colors_are_normalized(self):
+        sent_attachment = dict(self.ATTACHMENT, color="ec1313", id=1, fallback="x")
+        sent_message = self._sent_message("text", [sent_attachment])
+        self.assertTrue(bot.is_same_message(sent_message, "text", [self.ATTACHMENT]))
+
+    def test_different_text(self):
+        sent_message = self._sent_message("text", [self.ATTACHMENT])
+        self.assertFalse(bot.is_same_message(sent_message, "new", [self.ATTACHMENT]))
+
+    def test_different_attachments(self):
+        sent_message = self._sent_message("text", [self.ATTACHMENT])
+        attachment = dict(self.ATTACHMENT, color="#36a64f")
+        self.assertFalse(bot.is_same_message(sent_message, "text", [attachment]))
+        self.assertFalse(bot.is_same_message(sent_message, "text", []))
+
+    def test_attachment_fields(self):
+        self.assertEqual(
+            bot._attachment_fields(self.ATTACHMENT),
+            ("ec1313", self.ATTACHMENT["author_name"], self.ATTACHMENT["author_link"]),
+        )
+        self.assertEqual(bot._attachment_fields({}), ("", None, None))
+
+
+class ApplyReloadsTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.cron_scheduler = scheduler.Scheduler(self.loop)
+        self.reloads = scheduler.ReloadQueue()
+
+    def _crontab(self, **kwargs):
+        fields = dict(channel_id="C1", gerrit_query="status:open", crontab="0 9 * * *")
+        fields.update(kwargs)
+        return Crontab.objects.create(**fields)
+
+    def _apply(self, *reloads):
+        for reload in reloads:
+            self.reloads.push(*reload)
+        return bot.apply_reloads(
+            self.loop, None, self.cron_scheduler, self.reloads, 0, 1
+        )
+
+    def _scheduled_queries(self):
+        far_future = scheduler.utcnow() + dt.timedelta(days=400)
+        return {
+            due_run.key: due_run.job._crontab.gerrit_query
+            for due_run in self.cron_scheduler.pop_due_runs(far_future)
+        }
+
+    def test_saved_crontab_is_replaced(self):
+        crontab = self._crontab()
+        other = self._crontab(gerrit_query="is:starred")
+        self._apply((ReloadAction.CONFIG_CHANGED,))
+        crontab.gerrit_query = "owner:self"
+        crontab.save()
+        self.assertFalse(self._apply((ReloadAction.SAVED, crontab.pk)))
+        self.assertEqual(
+            self._scheduled_queries(),
+            {crontab.pk: "owner:self", other.pk: "is:starred"},
+        )
+
+    def test_deleted_crontab_is_removed(self):
+        crontab = self._crontab()
+        self._apply((ReloadAction.CONFIG_CHANGED,))
+        metrics.gauge("cronjob_last_lag_seconds", 1, crontab=crontab.pk)
+        pk = crontab.pk
+        crontab.delete()
+        self._apply((ReloadAction.DELETED, pk))
+        self.assertNotIn(pk, self.cron_scheduler)
+        gauges = metrics.registry.snapshot()["gauges"]
+        self.assertNotIn(("cronjob_last_lag_seconds", (("crontab", str(pk)),)), gauges)
+
+    def test_saved_then_deleted_crontab_is_removed(self):
+        crontab = self._crontab()
+        self._apply((ReloadAction.CONFIG_CHANGED,))
+        pk = crontab.pk
+        crontab.delete()
+        # the save message arrived after the crontab had been deleted
+        self._apply((ReloadAction.SAVED, pk))
+        self.assertEqual(len(self.cron_scheduler), 0)
+
+    def test_config_change_rebuilds_every_job(self):
+        crontab = self._crontab()
+        self.cron_scheduler.add(crontab, "stale job", crontab.pk)
+        self.cron_scheduler.add(crontab, "deleted crontab", -1)
+        new = self._crontab(gerrit_query="is:starred")
+        full_reload = self._apply(
+            (ReloadAction.SAVED, crontab.pk), (ReloadAction.CONFIG_CHANGED,)
+        )
+        self.assertTrue(full_reload)
+        self.assertEqual(
+            self._scheduled_queries(),
+            {crontab.pk: "status:open", new.pk: "is:starred"},
+        )
+
+
+class ReloadMessageTest(SimpleTestCase):
+    def test_round_trip(self):
+        message = bot.make_reload_message(ReloadAction.SAVED, 5)
+        self.assertEqual(bot.parse_reload_message(message), (ReloadAction.SAVED, 5))
+
+    def test_legacy_reload_is_a_full_reload(self):
+        self.assertEqual(
+            bot.parse_reload_message(b"reload"), (ReloadAction.CONFIG_CHANGED, None)
+        )
+
+    def test_other_messages_are_ignored(self):
+        for message in (b"pause", b"[]", b'{"crontab": 1}'):
+            with self.subTest(message=message):
+                self.assertIsNone(bot.parse_reload_message(message))
+
+    def test_burst_of_messages_is_merged(self):
+        messages = [
+            bot.make_reload_message(ReloadAction.SAVED, 1),
+            b"pause",
+            bot.make_reload_message(ReloadAction.SAVED, 2),
+            bot.make_reload_message(ReloadAction.DELETED, 1),
+        ]
+        cron_scheduler = mock.Mock()
+        reloads = scheduler.ReloadQueue()
+        thread = bot.WaitForMessages(cron_scheduler, reloads)
+        # the thread waits for messages forever, stop it after the last one
+        get_msg = mock.Mock(side_effect=messages + [SystemExit])
+        with mock.patch.object(fake_uwsgi, "mule_get_msg", get_msg):
+            with self.assertRaises(SystemExit):
+                thread.run()
+        self.assertEqual(
+            reloads.pop_all(),
+            (False, {1: ReloadAction.DELETED, 2: ReloadAction.SAVED}),
+        )
+        self.assertEqual(cron_scheduler.wakeup.call_count, 3)
+
+        with mock.patch.object(
+            fake_uwsgi, "mule_get_msg", mock.Mock(side_effect=[b"reload", SystemExit])
+        ):
+            with self.assertRaises(SystemExit):
+                thread.run()
+        self.assertEqual(reloads.pop_all(), (True, {}))
+
+
+class MuleRoutingTest(SimpleTestCase):
+    def setUp(self):
+        fake_uwsgi.mule_messages.clear()
+        self.addCleanup(fake_uwsgi.mule_messages.clear)
+
+    def _farm(self, farm, mule_id=1):
+        opt = {"farm": farm} if farm is not None else {}
+        patchers = (
+            mock.patch.object(fake_uwsgi, "opt", opt),
+            mock.patch.object(fake_uwsgi, "mule_id", return_value=mule_id),
+        )
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_single_farm(self):
+        self._farm(b"bot:2,3", mule_id=3)
+        self.assertEqual(bot.bot_mule_ids(), [2, 3])
+        self.assertEqual(bot.get_shard(), (1, 2))
+
+    def test_several_farms(self):
+        self._farm([b"rtm:1", b"bot:2,3,4"], mule_id=2)
+        self.assertEqual(bot.bot_mule_ids(), [2, 3, 4])
+        self.assertEqual(bot.get_shard(), (0, 3))
+
+    def test_single_mule(self):
+        self._farm(None)
+        self.assertIsNone(bot.bot_mule_ids())
+        self.assertEqual(bot.get_shard(), (0, 1))
+
+    def test_mule_outside_of_the_farm(self):
+        self._farm([b"rtm:1", b"bot:2,3"], mule_id=1)
+        self.assertEqual(bot.get_shard(), (0, 1))
+
+    def test_save_is_sent_to_the_owner(self):
+        self._farm([b"rtm:1", b"bot:2,3,4"])
+        for pk in range(20):
+            bot.send_reload(pk, ReloadAction.SAVED)
+        owners = [mule_id for mule_id, _ in fake_uwsgi.mule_messages]
+        expected = [[2, 3, 4][scheduler.shard(pk, 3)] for pk in range(20)]
+        self.assertEqual(owners, expected)
+        self.assertEqual(set(owners), {2, 3, 4})
+        message = fake_uwsgi.mule_messages[5][1]
+        self.assertEqual(bot.parse_reload_message(message), (ReloadAction.SAVED, 5))
+
+    def test_save_without_farm_goes_to_any_mule(self):
+        self._farm(None)
+        bot.send_reload(5, ReloadAction.DELETED)
+        self.assertEqual(
+            fake_uwsgi.mule_messages,
+            [(None, bot.make_reload_message(ReloadAction.DELETED, 5))],
+        )
+
+    def test_config_change_is_broadcast(self):
+        self._farm([b"rtm:1", b"bot:2,3"])
+        bot.send_reload_all()
+        message = bot.make_reload_message(ReloadAction.CONFIG_CHANGED)
+        self.assertEqual(fake_uwsgi.mule_messages, [(2, message), (3, message)])
+
+
+def review_url(query):
+    return f"{config.GERRIT_URL}/#/q/{query}"
+
+
+class ReviewRequestIndexTest(TestCase):
+    def setUp(self):
+        # the changes claimed by the other tests
+        cache.clear()
+
+    def _save(self, query, ts):
+        return ReviewRequest.objects.create(
+            ts=ts,
+            slack_user_id="U1",
+            channel_id="C1",
+            gerrit_url=review_url(query),
+            gerrit_query=query,
+        )
+
+    def test_new_changes_are_queued_by_split(self):
+        index = rtm.ReviewRequestIndex()
+        url = review_url("owner:a+status:open")
+        self.assertEqual(index.split([url], "1.0"), ([url], {}))
+        self.assertEqual(
+            index.split([url], "2.0"), ([], {"owner:a+status:open": "1.0"})
+        )
+
+    def test_same_change_is_returned_once(self):
+        index = rtm.ReviewRequestIndex()
+        urls = [
+            review_url("owner:a+status:open"),
+            review_url("owner:a++status:open"),
+            f"{config.GERRIT_URL}/#/c/123/",
+            f"{config.GERRIT_URL}/123",
+        ]
+        new_urls, queued_queries = index.split(urls, "1.0")
+        self.assertEqual(new_urls, [urls[0], urls[2]])
+        self.assertEqual(queued_queries, {})
+        new_urls, queued_queries = index.split(urls[1:2], "2.0")
+        self.assertEqual(new_urls, [])
+        self.assertEqual(queued_queries, {"owner:a+status:open": "1.0"})
+
+    def test_load(self):
+        self._save("owner:a", "1.0")
+        self._save("owner:a", "2.0")
+        index = rtm.ReviewRequestIndex()
+        index.load()
+        self.assertEqual(
+            index.split([review_url("owner:a")], "3.0"), ([], {"owner:a": "1.0"})
+        )
+
+    def test_deleted_hits_are_new(self):
+        rr = self._save("owner:a", "1.0")
+        index = rtm.ReviewRequestIndex()
+        index.load()
+        # got +2 since it has been loaded
+        rr.delete()
+        url = review_url("owner:a")
+        new_urls, queued_queries = index.split([url], "2.0")
+        self.assertEqual(
+            index.check_existing([url], new_urls, queued_queries, "2.0"), ([url], [])
+        )
+        self.assertEqual(index.split([url], "3.0"), ([], {"owner:a": "2.0"}))
+
+    def test_unsaved_hits_are_kept(self):
+        index = rtm.ReviewRequestIndex()
+        url = review_url("owner:a")
+        index.split([url], "1.0")
+        new_urls, queued_queries = index.split([url], "2.0")
+        self.assertEqual(
+            index.check_existing([url], new_urls, queued_queries, "2.0"), ([], ["1.0"])
+        )
+
+    def test_misses_saved_by_another_process(self):
+        index = rtm.ReviewRequestIndex(trust_misses=False)
+        self._save("owner:a", "1.0")
+        url = review_url("owner:a")
+        new_urls, queued_queries = index.split([url], "2.0")
+        self.assertEqual((new_urls, queued_queries), ([url], {}))
+        self.assertEqual(
+            index.check_existing([url], new_urls, queued_queries, "2.0"), ([], ["1.0"])
+        )
+        self.assertEqual(index.split([url], "3.0"), ([], {"owner:a": "1.0"}))
+
+
+class FakeRealtimeApi:
+    bot_id = "UBOT"
+    bot_mention = "<@UBOT>"
+
+    def __init__(self):
+        self.replies = []
+
+    async def reply_in_thread(self, channel_id, ts, text):
+        self.replies.append((ts, text))
+
+
+class FakeReactionsApi:
+    def __init__(self):
+        self.reactions = []
+
+    async def add_reaction(self, channel_id, ts, reaction_name):
+        self.reactions.append((ts, reaction_name))
+
+    async def get_permalink(self, channel_id, ts):
+        return f"https://example.slack.com/archives/{channel_id}/p{ts}"
+
+
+# the review requests are saved in another thread, which can't see the
+# transaction of a TestCase
+class ProcessMessageTest(TransactionTestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor()
+        self.loop.set_default_executor(executor)
+        self.addCleanup(executor.shutdown)
+        self.addCleanup(self.loop.close)
+        cache.clear()
+
+    def _process(self, index, *messages):
+        return self._process_in([(index, msg) for msg in messages])
+
+    def _process_in(self, indexes_and_messages):
+        api, realtime_api = FakeReactionsApi(), FakeRealtimeApi()
+
+        async def process():
+            await asyncio.gather(
+                *(
+                    rtm.process_message(api, realtime_api, msg, self.loop, index)
+                    for index, msg in indexes_and_messages
+                )
+            )
+            # let the reactions finish
+            await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(process())
+        return sorted(api.reactions)
+
+    def _message(self, ts, query):
+        text = f"please review <{review_url(query)}>"
+        return {
+            "type": "message",
+            "user": "U1",
+            "channel": "C1",
+            "ts": ts,
+            "text": text,
+        }
+
+    def test_same_link_at_the_same_time_is_saved_once(self):
+        # the misses are checked in the database, there is an await between
+        # the lookup and saving the review request
+        index = rtm.ReviewRequestIndex(trust_misses=False)
+        reactions = self._process(
+            index, self._message("1.0", "owner:a"), self._message("2.0", "owner:a")
+        )
+        self.assertEqual(reactions, [("1.0", "review"), ("2.0", "no_entry_sign")])
+        self.assertEqual(
+            list(ReviewRequest.objects.values_list("ts", "gerrit_query")),
+            [("1.0", "owner:a")],
+        )
+
+    def test_same_link_in_two_workers_is_saved_once(self):
+        # every worker has its own processor, only the cache is shared
+        indexes = [events.EventProcessor()._review_requests for _ in range(2)]
+        check_existing = rtm.ReviewRequestIndex.check_existing
+        both_checking = threading.Barrier(2, timeout=5)
+
+        def check_at_the_same_time(index, *args):
+            # neither of them can see the review request saved by the other
+            both_checking.wait()
+            return check_existing(index, *args)
+
+        with mock.patch.object(
+            rtm.ReviewRequestIndex, "check_existing", check_at_the_same_time
+        ):
+            reactions = self._process_in(
+                [
+                    (indexes[0], self._message("1.0", "owner:a")),
+                    (indexes[1], self._message("2.0", "owner:a")),
+                ]
+            )
+        self.assertEqual(
+            sorted(reaction for _, reaction in reactions), ["no_entry_sign", "review"]
+        )
+        self.assertEqual(ReviewRequest.objects.count(), 1)
+
+    def test_different_links_are_saved(self):
+        index = rtm.ReviewRequestIndex()
+        reactions = self._process(
+            index, self._message("1.0", "owner:a"), self._message("2.0", "owner:b")
+        )
+        self.assertEqual(reactions, [("1.0", "review"), ("2.0", "review")])
+        self.assertEqual(ReviewRequest.objects.count(), 2)
+        # nothing is left unsaved
+        self.assertEqual(index._unsaved, set())
+
+
+class MessageQueueTest(SimpleTestCase):
+    def _run(self, coro_func):
+        loop = asyncio.new_event_loop()
+        result = loop.run_until_complete(coro_func(loop))
+        loop.close()
+        return result
+
+    def _make_queue(self, handled, policy=rtm.OverflowPolicy.BLOCK, **kwargs):
+        async def handle(msg):
+            await asyncio.sleep(0.001)
+            handled.append(msg)
+
+        return rtm.MessageQueue(
+            handle,
+            is_important=lambda msg: msg.startswith("link"),
+            policy=policy,
+            **kwargs,
+        )
+
+    @staticmethod
+    async def _start(queue, loop):
+        queue.start(loop)
+
+    @staticmethod
+    def _put_now(queue, msg):
+        """Run put() to completion without an event loop, it must not wait."""
+        coro = queue.put(msg)
+        try:
+            coro.send(None)
+        except StopIteration as stop:
+            return stop.value
+        raise AssertionError("put() had to wait")
+
+    def test_processes_everything_in_order(self):
+        handled = []
+
+        async def run(loop):
+            queue = self._make_queue(handled, maxsize=10, workers=1)
+            queue.start(loop)
+            for n in range(30):
+                await queue.put(f"link {n}")
+            await queue.close()
+            return queue.stats()
+
+        stats = self._run(run)
+        self.assertEqual(handled, [f"link {n}" for n in range(30)])
+        self.assertEqual(stats["processed"], 30)
+        self.assertEqual(stats["max_depth"], 10)
+        self.assertEqual(stats["depth"], 0)
+        self.assertEqual(stats["dropped"], {})
+
+    def test_limits_concurrency(self):
+        running = []
+        max_running = 0
+
+        async def handle(msg):
+            nonlocal max_running
+            running.append(msg)
+            max_running = max(max_running, len(running))
+            await asyncio.sleep(0.001)
+            running.remove(msg)
+
+        async def run(loop):
+            queue = rtm.MessageQueue(handle, workers=3)
+            queue.start(loop)
+            for n in range(20):
+                await queue.put(n)
+            await queue.close()
+
+        self._run(run)
+        self.assertEqual(max_running, 3)
+
+    def test_drops_unimportant_messages_first(self):
+        queue = self._make_queue([], maxsize=3, workers=0)
+        self._run(lambda loop: self._start(queue, loop))
+        results = [
+            self._put_now(queue, msg)
+            for msg in ("noise 1", "link 1", "noise 2", "link 2", "noise 3", "link 3")
+        ]
+        self.assertEqual(results, [True, True, True, True, False, True])
+        self.assertEqual(
+            [item[1] for item in queue._items], ["link 1", "link 2", "link 3"]
+        )
+        self.assertEqual(queue.dropped, {"unimportant": 3})
+
+    def test_drop_policies(self):
+        for policy, accepted, kept in (
+            (rtm.OverflowPolicy.DROP_NEWEST, False, ["link 1", "link 2"]),
+            (rtm.OverflowPolicy.DROP_OLDEST, True, ["link 2", "link 3"]),
+        ):
+            with self.subTest(policy=policy):
+                queue = self._make_queue([], policy=policy, maxsize=2, workers=0)
+                self._run(lambda loop: self._start(queue, loop))
+                self.assertTrue(self._put_now(queue, "link 1"))
+                self.assertTrue(self._put_now(queue, "link 2"))
+                self.assertIs(self._put_now(queue, "link 3"), accepted)
+                self.assertEqual([item[1] for item in queue._items], kept)
+                self.assertEqual(queue.dropped, {"important": 1})
+
+    def test_block_policy_waits_for_room(self):
+        handled = []
+
+        async def run(loop):
+            queue = self._make_queue(handled, maxsize=1, workers=1)
+            queue.start(loop)
+            await queue.put("link 1")
+            await queue.put("link 2")
+            await queue.put("link 3")
+            await queue.close()
+            return queue.stats()
+
+        stats = self._run(run)
+        self.assertEqual(handled, ["link 1", "link 2", "link 3"])
+        self.assertEqual(stats["dropped"], {})
+
+
+SIGNING_SECRET = "8f742231b10e8888abcd99yyyzzz85a5"
+
+
+@override_config(SLACK_SIGNING_SECRET=SIGNING_SECRET)
+class SlackEventsViewTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.processed = []
+        processor = events.EventProcessor()
+
+        async def process(api, events_api, event):
+            self.processed.append(event)
+
+        processor._process = process
+        patcher = mock.patch.object(events, "_processor", processor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _post(self, payload, secret=SIGNING_SECRET, **headers):
+        body = json.dumps(payload).encode()
+        timestamp = str(int(time.time()))
+        base = b"v0:" + timestamp.encode() + b":" + body
+        digest = hmac.new(secret.encode(), base, hashlib.sha256).hexdigest()
+        res = self.client.post(
+            reverse("slack_events"),
+            body,
+            content_type="application/json",
+            HTTP_X_SLACK_REQUEST_TIMESTAMP=timestamp,
+            HTTP_X_SLACK_SIGNATURE="v0=" + digest,
+            **headers,
+        )
+        # wait for the events submitted to the background loop
+        slack.get_background_loop().run(asyncio.sleep(0))
+        return res
+
+    def _event_callback(self, event_id, text="hi"):
+        event = {"type": "message", "user": "U1", "channel": "C1", "text": text}
+        return {"type": "event_callback", "event_id": event_id, "event": event}
+
+    def test_invalid_signature(self):
+        res = self._post(self._event_callback("Ev1"), secret="wrong")
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(self.processed, [])
+
+    def test_url_verification(self):
+        res = self._post({"type": "url_verification", "challenge": "abc123"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.content, b"abc123")
+
+    def test_event_is_processed(self):
+        res = self._post(self._event_callback("Ev1"))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([e["text"] for e in self.processed], ["hi"])
+
+    def test_retries_are_processed_once(self):
+        self._post(self._event_callback("Ev1"))
+        res = self._post(self._event_callback("Ev1"), HTTP_X_SLACK_RETRY_NUM="1")
+        self.assertEqual(res.status_code, 200)
+        self._post(self._event_callback("Ev2", "hello"))
+        self.assertEqual([e["text"] for e in self.processed], ["hi", "hello"])
+
+    def test_event_ids_are_shared_between_workers(self):
+        self.assertTrue(events.is_new_event("Ev1"))
+        # another worker has its own processor, but the same cache
+        self.assertFalse(events.is_new_event("Ev1"))
+
+
+class DictCache:
+    """The parts of the cache API used by channels, timeouts are only recorded."""
+
+    def __init__(self):
+        self.data = {}
+        self.timeouts = {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value, timeout=None):
+        self.data[key] = value
+        self.timeouts[key] = timeout
+
+    def set_many(self, data, timeout=None):
+        for key, value in data.items():
+            self.set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        if key in self.data:
+            return False
+        self.set(key, value, timeout)
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class FakeChannelsApi:
+    def __init__(self, pages):
+        # {cursor: (channels, next cursor)}
+        self.pages = pages
+        self.requested = []
+
+    def list_channels_page(self, cursor=None):
+        self.requested.append(cursor)
+        return self.pages.get(cursor)
+
+
+class ChannelsTest(SimpleTestCase):
+    PAGES = {
+        None: ([{"name": "general", "id": "C1"}, {"name": "random", "id": "C2"}], "2"),
+        "2": ([{"name": "reviews", "id": "C3"}], None),
+    }
+
+    def setUp(self):
+        self.cache = DictCache()
+        self.api = FakeChannelsApi(self.PAGES)
+        for patcher in (
+            mock.patch.object(channels, "cache", self.cache),
+            mock.patch.object(channels, "config", mock.Mock(BOT_ACCESS_TOKEN="xoxb")),
+            mock.patch.object(channels.slack, "Api", return_value=self.api),
+            mock.patch.object(channels, "stats", collections.Counter()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_keys_are_hashed(self):
+        long_name = "a" * 80
+        key = channels._channel_key(long_name)
+        self.assertEqual(len(key), len("channel:") + 40)
+        self.assertNotEqual(key, channels._channel_key(long_name + "b"))
+
+    def test_pages_are_downloaded_until_found(self):
+        self.assertEqual(channels.get_channel_id("#random"), "C2")
+        self.assertEqual(self.api.requested, [None])
+        self.assertEqual(self.cache.get(channels._channel_key("general")), "C1")
+        self.assertIsNone(self.cache.get(channels._channel_key("reviews")))
+
+        self.assertEqual(channels.get_channel_id("reviews"), "C3")
+        self.assertEqual(self.api.requested, [None, None, "2"])
+        self.assertEqual(
+            self.cache.timeouts[channels._channel_key("reviews")],
+            channels.CHANNEL_TIMEOUT,
+        )
+
+    def test_cached_channels_are_not_downloaded(self):
+        channels.get_channel_id("general")
+        self.assertEqual(channels.get_channel_id("#general"), "C1")
+        self.assertEqual(self.api.requested, [None])
+        self.assertEqual(channels.stats["hits"], 1)
+        self.assertEqual(channels.stats["misses"], 1)
+
+    def test_missing_channels_are_cached(self):
+        self.assertIsNone(channels.get_channel_id("missing"))
+        key = channels._channel_key("missing")
+        self.assertEqual(self.cache.get(key), channels.NOT_FOUND)
+        self.assertEqual(self.cache.timeouts[key], channels.NOT_FOUND_TIMEOUT)
+
+        self.assertIsNone(channels.get_channel_id("missing"))
+        self.assertEqual(self.api.requested, [None, "2"])
+        self.assertEqual(channels.stats["not_found_hits"], 1)
+
+    def test_slack_errors_are_not_cached(self):
+        self.api.pages = {}
+        self.assertIsNone(channels.get_channel_id("general"))
+        self.assertEqual(self.cache.data, {})
+
+    def test_lock_is_released(self):
+        channels.get_channel_id("general")
+        self.assertNotIn(channels.REFRESH_LOCK_KEY, self.cache.data)
+
+    def test_waits_for_the_running_refresh(self):
+        self.cache.add(channels.REFRESH_LOCK_KEY, True)
+
+        def finish_refresh(seconds):
+            self.cache.set(channels._channel_key("general"), "C1")
+            self.cache.delete(channels.REFRESH_LOCK_KEY)
+
+        with mock.patch.object(channels.time, "sleep", side_effect=finish_refresh):
+            self.assertEqual(channels.get_channel_id("general"), "C1")
+        self.assertEqual(self.api.requested, [])
+        self.assertNotIn(channels.REFRESH_LOCK_KEY, self.cache.data)
+
+    def test_lock_of_another_refresh_is_kept_after_timeout(self):
+        self.cache.add(channels.REFRESH_LOCK_KEY, "other")
+        with mock.patch.object(channels, "REFRESH_LOCK_TIMEOUT", 0), mock.patch.object(
+            channels.time, "sleep"
+        ):
+            self.assertEqual(channels.get_channel_id("general"), "C1")
+        self.assertEqual(self.cache.get(channels.REFRESH_LOCK_KEY), "other")
+
+
+class UWSGICacheSerializationTest(SimpleTestCase):
+    def test_small_values_are_not_compressed(self):
+        value = {"id": "C1"}
+        data = uwsgicache.dumps(value)
+        self.assertFalse(data.startswith(uwsgicache.COMPRESSED_PREFIX))
+        self.assertEqual(uwsgicache.loads(data), value)
+
+    def test_big_values_are_compressed(self):
+        value = ["change"] * 1000
+        data = uwsgicache.dumps(value)
+        self.assertTrue(data.startswith(uwsgicache.COMPRESSED_PREFIX))
+        self.assertLess(len(data), uwsgicache.COMPRESS_MIN_LENGTH)
+        self.assertEqual(uwsgicache.loads(data), value)
+
+    def test_incompressible_values_are_kept(self):
+        value = os.urandom(2 * uwsgicache.COMPRESS_MIN_LENGTH)
+        data = uwsgicache.dumps(value)
+        self.assertFalse(data.startswith(uwsgicache.COMPRESSED_PREFIX))
+        self.assertEqual(uwsgicache.loads(data), value)
+
+    def test_parse_cache2_options(self):
+        options = [b"name=channels,items=100", "name=gerrit,items=10,blocksize=4096"]
+        self.assertEqual(
+            uwsgicache.parse_cache2_options(options, "gerrit"),
+            {"name": "gerrit", "items": "10", "blocksize": "4096"},
+        )
+        self.assertEqual(
+            uwsgicache.parse_cache2_options("name=channels,items=100", "channels"),
+            {"name": "channels", "items": "100"},
+        )
+        self.assertEqual(uwsgicache.parse_cache2_options(options, "metrics"), {})
+
+    def test_max_value_size(self):
+        self.assertEqual(uwsgicache.max_value_size({}), 65536)
+        self.assertEqual(uwsgicache.max_value_size({"blocksize": "4096"}), 4096)
+        bitmap = {"bitmap": "1", "blocksize": "4096", "items": "10"}
+        self.assertEqual(uwsgicache.max_value_size(bitmap), 40960)
+        self.assertEqual(uwsgicache.max_value_size(dict(bitmap, blocks="20")), 81920)
+
+
+class UWSGICacheTest(SimpleTestCase):
+    def setUp(self):
+        cache2 = "name=test,items=100,blocksize=4096"
+        with mock.patch.dict(fake_uwsgi.opt, {"cache2": cache2}):
+            self.cache = uwsgicache.UWSGICache("test", {})
+        self.addCleanup(self.cache.clear)
+
+    def test_many(self):
+        self.assertEqual(self.cache.set_many({"a": 1, "b": [2] * 1000}), [])
+        self.assertEqual(
+            self.cache.get_many(["a", "b", "c"]), {"a": 1, "b": [2] * 1000}
+        )
+        self.cache.delete_many(["a", "c"])
+        self.assertEqual(self.cache.get_many(["a", "b"]), {"b": [2] * 1000})
+
+    def test_add_keeps_the_existing_value(self):
+        self.assertTrue(self.cache.add("lock", "first"))
+        self.assertFalse(self.cache.add("lock", "second"))
+        self.assertEqual(self.cache.get("lock"), "first")
+        self.assertNotIn("set_failures", self.cache.stats())
+
+    def test_failed_sets(self):
+        with mock.patch.object(fake_uwsgi, "cache_update", return_value=None):
+            self.assertEqual(self.cache.set_many({"a": 1}), ["a"])
+        with mock.patch.object(fake_uwsgi, "cache_set", return_value=None):
+            self.assertFalse(self.cache.add("b", 2))
+        self.assertEqual(self.cache.stats()["set_failures"], 2)
+
+    def test_stats(self):
+        self.cache.set("a", 1)
+        self.cache.get("a")
+        self.cache.get("b")
+        stats = self.cache.stats()
+        self.assertEqual(stats["sets"], 1)
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["items"], 1)
+        self.assertEqual(stats["max_items"], 100)
+        self.assertEqual(stats["max_value_size"], 4096)
@@ -1,18 +1,21 @@
-import asyncio
+import json
 from django.views import generic
 from django.db import transaction
 from django.contrib import messages
 from django.shortcuts import redirect
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.views.decorators.csrf import csrf_exempt
 from django.core.exceptions import SuspiciousOperation
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
 from constance import config
-import aiohttp
 import slack
+import metrics
 from . import models as m
 from . import forms as f
 
 try:
     import bot
+    import events
 except ImportError:
     # manage.py commands need to run without uwsgi
     pass
@@ -113,13 +116,43 @@ def slack_oauth(request):
 @require_POST
 def run_crontab(request, crontab_id):
     crontab = m.Crontab.objects.get(pk=crontab_id)
-    loop = asyncio.get_event_loop()
-    session = aiohttp.ClientSession(loop=loop)
-    cronjob = bot.CronJob(
-        config.GERRIT_URL, config.BOT_ACCESS_TOKEN, crontab, loop, session
-    )
-    loop.run_until_complete(cronjob.run())
-    loop.run_until_complete(session.close())
+    background_loop = slack.get_background_loop()
+    cronjob = bot.make_cronjob(background_loop.loop, background_loop.session, crontab)
+    background_loop.run(cronjob.run())
 
     messages.success(request, "Patch set updated.")
     return redirect("/")
+
+
+@csrf_exempt
+@require_POST
+def slack_events(request):
+    """Endpoint for the Slack Events API, see events.py"""
+    is_valid = slack.verify_signature(
+        config.SLACK_SIGNING_SECRET,
+        request.META.get("HTTP_X_SLACK_REQUEST_TIMESTAMP"),
+        request.body,
+        request.META.get("HTTP_X_SLACK_SIGNATURE"),
+    )
+    if not is_valid:
+        return HttpResponseForbidden("Invalid signature")
+
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid JSON")
+
+    # sent once, when the URL is set on the Slack app's Event Subscriptions page
+    if payload.get("type") == "url_verification":
+        return HttpResponse(payload["challenge"], content_type="text/plain")
+
+    if payload.get("type") == "event_callback":
+        events.get_processor().submit(payload["event_id"], payload["event"])
+    return HttpResponse()
+
+
+@require_GET
+def prometheus_metrics(request):
+    """Metrics of every worker and mule in the Prometheus text format, see metrics.py"""
+    text = metrics.render(metrics.load_snapshots())
+    return HttpResponse(text, content_type="text/plain; version=0.0.4")
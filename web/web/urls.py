@@ -24,6 +24,8 @@ urlpatterns = [
     path("edit/<int:pk>/", views.CrontabEditView.as_view(), name="edit"),
     path("delete/<int:pk>/", views.CrontabDeleteView.as_view(), name="delete"),
     path("slack-oauth/", views.slack_oauth, name="slack_oauth"),
+    path("slack-events/", views.slack_events, name="slack_events"),
+    path("metrics", views.prometheus_metrics, name="metrics"),
     path("usage/", views.UsageView.as_view(), name="usage"),
     path("pause/", views.pause_bot, name="pause"),
     path("resume/", views.resume_bot, name="resume"),